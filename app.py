@@ -1,6 +1,8 @@
+import os
 from app import create_app,db
 
-app = create_app()
+# APP_CONFIG=config.ProductionConfig selects the production database profile
+app = create_app(os.environ.get('APP_CONFIG', 'config.Config'))
 
 
 if __name__ == '__main__':
@@ -2,33 +2,82 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager,current_user
 from flask_migrate import Migrate
-from flask_session import Session
+from app.database import RoutingSession, init_database
 
 
 
-# Initialize database
-db = SQLAlchemy()
+# Initialize database; reads of GET requests may go to a read-only bind
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 # Initialize login manager
 login_manager = LoginManager()
 
-def create_app():
+def create_app(config='config.Config'):
     app = Flask(__name__)
-    app.config.from_object('config.Config')
+    app.config.from_object(config)
     app.config['UPLOADED_PHOTOS_DEST'] = 'static/uploads'
 
     
     db.init_app(app)
+    init_database(app, db)
+
+    # Per-request query counts and N+1 detection, sent as headers in debug mode
+    from app.instrumentation import SQLInstrumentation
+    SQLInstrumentation(app, db)
+
+    # Request counts, latency histograms and cache hit ratios at /metrics
+    from app.metrics import Metrics
+    Metrics(app)
+
     migrate = Migrate(app, db)
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'  # Update this as per your Blueprint
-    Session(app)
+    from app.sessions import init_sessions
+    init_sessions(app)
 
 
     from app.blueprint.pnr.filters import strip_html, truncate_words
     app.jinja_env.filters['strip_html'] = strip_html
     app.jinja_env.filters['truncate_words'] = truncate_words
 
+    # Buffer post view counts in memory and write them in batches
+    from app.blueprint.pnr.counters import ViewCounter, view_count
+    ViewCounter(app)
+    app.jinja_env.globals['view_count'] = view_count
+
+    # In-process publish/subscribe behind the live notification stream
+    from app.events import EventBus
+    EventBus(app)
+
+    # Full-page cache for anonymous visitors
+    from app.cache import PageCache
+    PageCache(app)
+
+    # Gzip for HTML pages and JSON
+    from app.compression import Compression
+    Compression(app)
+
+    # Static files linked by content hash and cached by browsers for a year
+    from app.assets import StaticAssets
+    StaticAssets(app)
+
+    # Uploaded profile pictures and their thumbnails
+    from app.avatars import AvatarStore
+    AvatarStore(app)
+
+    # Car news, cached with a background refresh
+    from app.blueprint.pnr.news import NewsCache
+    NewsCache(app)
+
+    # Chatbot completion settings
+    from app.blueprint.pnr.chatbot import init_chatbot
+    init_chatbot(app)
+
+    # Helpers used by the shared pagination macro
+    from app.pagination import page_url, max_numbered_pages
+    app.jinja_env.globals['page_url'] = page_url
+    app.jinja_env.globals['max_numbered_pages'] = max_numbered_pages
+
 
     from app.blueprint.auth import auth as auth_blueprint
     app.register_blueprint(auth_blueprint)
@@ -41,18 +90,19 @@ def create_app():
  
 
     
-    # Load the user with the login manager
-    from app.models import User
+    # Load the user with the login manager, through the identity cache
+    from app.identity import IdentityCache
+    identity_cache = IdentityCache(app)
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return identity_cache.load(int(user_id))
     
     # Context Processor for Notifications Count
-    from app.models.models import Notification
+    # Reads the counter kept on the user row, so rendering costs no query
     @app.context_processor
     def inject_notification_count():
         if current_user.is_authenticated:
-            new_notifications_count = Notification.query.filter_by(user_id=current_user.id, is_read=False).count()
+            new_notifications_count = current_user.unread_notifications or 0
         else:
             new_notifications_count = 0
         return dict(new_notifications_count=new_notifications_count)
@@ -0,0 +1,161 @@
+# assets.py
+# Fingerprinted static files. At startup every file of the static folder is
+# hashed, and url_for('static') links the hashed name (css/style.<hash>.css).
+# Hashed names are served with a year-long immutable Cache-Control: a changed
+# file gets a new name, so browsers never revalidate. Text files are also
+# compressed once with gzip, and with brotli when it is installed, and the
+# variant the client accepts is sent instead of compressing every response.
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+from flask import request, send_file
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip variants are served without it
+    brotli = None
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.txt', '.map', '.otf', '.ttf')
+
+# A name produced by hashed_name: the stem, 12 hex digits, then the extension
+_HASHED = re.compile(r'^(.+)\.[0-9a-f]{12}(\.[^./]+)?$')
+
+
+def hashed_name(filename, digest):
+    stem, ext = os.path.splitext(filename)
+    return '%s.%s%s' % (stem, digest[:12], ext)
+
+
+def _compressors():
+    # (Content-Encoding, file suffix, compress), in order of preference
+    compressors = []
+    if brotli is not None:
+        compressors.append(('br', '.br', lambda data: brotli.compress(data, quality=11)))
+    compressors.append(('gzip', '.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0)))
+    return compressors
+
+
+class StaticAssets:
+    """Manifest of content-hashed static files, with precompressed variants."""
+
+    def __init__(self, app=None):
+        # filename: (hashed name, mtime); hashed name: filename
+        self.hashed = {}
+        self.originals = {}
+        # hashed name: [(Content-Encoding, path)]
+        self.variants = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('STATIC_ASSETS_ENABLED', True)
+        # Uploads are not fingerprinted: they are replaced under the same name
+        # or, for avatars, already named by content
+        app.config.setdefault('STATIC_ASSETS_EXCLUDE', ('uploads', 'avatars'))
+        app.config.setdefault('STATIC_ASSETS_CACHE_DIR', os.path.join(app.instance_path, 'static-assets'))
+        # Files smaller than this are sent as they are
+        app.config.setdefault('STATIC_ASSETS_MIN_COMPRESS_SIZE', 512)
+        app.extensions['static_assets'] = self
+        self.app = app
+        self.build()
+        app.url_defaults(self._link_hashed)
+        app.view_functions['static'] = self.send_static
+
+    def build(self):
+        """Hash every static file and write compressed copies of the text files."""
+        static = self.app.static_folder
+        excluded = set(self.app.config['STATIC_ASSETS_EXCLUDE'])
+        hashed, variants = {}, {}
+        for root, dirs, files in os.walk(static):
+            if root == static:
+                dirs[:] = [name for name in dirs if name not in excluded]
+            dirs[:] = [name for name in dirs if not name.startswith('.')]
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                filename = os.path.relpath(os.path.join(root, name), static).replace(os.sep, '/')
+                entry = self._hash(filename)
+                hashed[filename] = entry
+                variants[entry[0]] = self._compress(filename, entry[0])
+        self.hashed = hashed
+        self.originals = {name: filename for filename, (name, _) in hashed.items()}
+        self.variants = variants
+
+    def _hash(self, filename):
+        path = os.path.join(self.app.static_folder, filename)
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(64 * 1024), b''):
+                digest.update(chunk)
+        return hashed_name(filename, digest.hexdigest()), os.path.getmtime(path)
+
+    def _compress(self, filename, name):
+        path = os.path.join(self.app.static_folder, filename)
+        if (os.path.splitext(filename)[1].lower() not in COMPRESSIBLE
+                or os.path.getsize(path) < self.app.config['STATIC_ASSETS_MIN_COMPRESS_SIZE']):
+            return []
+        cache = self.app.config['STATIC_ASSETS_CACHE_DIR']
+        data = None
+        variants = []
+        for encoding, suffix, compress in _compressors():
+            target = os.path.join(cache, name + suffix)
+            if not os.path.exists(target):
+                if data is None:
+                    with open(path, 'rb') as file:
+                        data = file.read()
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # Written aside and renamed, so a concurrent start never sends a partial file
+                with open(target + '.part', 'wb') as out:
+                    out.write(compress(data))
+                os.replace(target + '.part', target)
+            variants.append((encoding, target))
+        return variants
+
+    def _entry(self, filename):
+        entry = self.hashed.get(filename)
+        # While debugging, files edited since startup get a fresh hash
+        if entry is not None and self.app.debug:
+            path = os.path.join(self.app.static_folder, filename)
+            if os.path.exists(path) and os.path.getmtime(path) != entry[1]:
+                # The old name now falls back to a non-immutable response
+                self.originals.pop(entry[0], None)
+                entry = self.hashed[filename] = self._hash(filename)
+                self.originals[entry[0]] = filename
+                self.variants[entry[0]] = self._compress(filename, entry[0])
+        return entry
+
+    def _link_hashed(self, endpoint, values):
+        if endpoint == 'static' and self.app.config['STATIC_ASSETS_ENABLED']:
+            entry = self._entry(values.get('filename'))
+            if entry is not None:
+                values['filename'] = entry[0]
+
+    def send_static(self, filename):
+        original = self.originals.get(filename)
+        if original is None:
+            # A hash from before the file changed, linked by a page cached
+            # somewhere: send the current file, but not as immutable
+            match = _HASHED.match(filename)
+            if match and match.group(1) + (match.group(2) or '') in self.hashed:
+                filename = match.group(1) + (match.group(2) or '')
+            return self.app.send_static_file(filename)
+
+        response = None
+        variants = self.variants.get(filename, [])
+        for encoding, path in variants:
+            if request.accept_encodings[encoding] and os.path.exists(path):
+                mimetype = mimetypes.guess_type(original)[0] or 'application/octet-stream'
+                response = send_file(path, mimetype=mimetype, conditional=True)
+                response.headers['Content-Encoding'] = encoding
+                break
+        if response is None:
+            response = self.app.send_static_file(original)
+        response.headers['Cache-Control'] = IMMUTABLE
+        if variants:
+            response.vary.add('Accept-Encoding')
+        return response
@@ -0,0 +1,248 @@
+# avatars.py
+# Profile pictures. An upload is copied to disk in chunks, up to
+# AVATAR_MAX_BYTES, and stored under a hash of its content, so a picture
+# uploaded twice is kept once. Square JPEG thumbnails in each of AVATAR_SIZES
+# are cut by a background worker; until they exist pages show the upload.
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import with_appcontext
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from app import db
+from app.identity import forget_users
+from app.models.models import User
+
+logger = logging.getLogger(__name__)
+
+CHUNK = 64 * 1024
+
+# Accepted image formats and the extension their upload is stored under
+FORMATS = {'JPEG': '.jpg', 'PNG': '.png'}
+
+# Users who never uploaded a picture keep the column default
+DEFAULT_IMAGE_URL = '/static/uploads/default_user.jpg'
+
+
+class AvatarRejected(Exception):
+    """An upload that is not stored, with the message to show the user."""
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class AvatarStore:
+    """Content-addressed store of uploaded pictures and their thumbnails."""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = set()
+        # Key of the default picture, and whether its thumbnails are on disk
+        self._default_key = None
+        self._default_ready = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AVATAR_SIZES', (48, 100, 200))
+        app.config.setdefault('AVATAR_MAX_BYTES', 4 * 1024 * 1024)
+        app.config.setdefault('AVATAR_MAX_PIXELS', 40_000_000)
+        # Must be the avatars folder of the static folder, which serves the files
+        app.config.setdefault('AVATAR_DIR', os.path.join(app.static_folder, 'avatars'))
+        app.config.setdefault('AVATAR_DEFAULT_IMAGE', os.path.join(app.static_folder, 'uploads', 'default_user.jpg'))
+        # Thumbnails are cut inline when this is 0
+        app.config.setdefault('AVATAR_WORKERS', 1)
+        app.extensions['avatars'] = self
+        app.jinja_env.filters['avatar'] = avatar_url
+        app.cli.add_command(backfill_avatars)
+        self.app = app
+
+    def _path(self, filename):
+        return os.path.join(self.app.config['AVATAR_DIR'], filename)
+
+    def _url(self, filename):
+        return '%s/avatars/%s' % (self.app.static_url_path, filename)
+
+    def thumbnail_name(self, key, size):
+        return '%s-%d.jpg' % (key, size)
+
+    def has_thumbnails(self, key):
+        return all(os.path.exists(self._path(self.thumbnail_name(key, size)))
+                   for size in self.app.config['AVATAR_SIZES'])
+
+    def store(self, stream):
+        """Copy an uploaded stream into the store and return (key, filename).
+
+        Raises AvatarRejected if the upload is larger than AVATAR_MAX_BYTES or
+        is not a JPEG or PNG image.
+        """
+        directory = self.app.config['AVATAR_DIR']
+        os.makedirs(directory, exist_ok=True)
+        limit = self.app.config['AVATAR_MAX_BYTES']
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp = tempfile.mkstemp(dir=directory, suffix='.upload')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in iter(lambda: stream.read(CHUNK), b''):
+                    size += len(chunk)
+                    if size > limit:
+                        raise AvatarRejected('Pictures can be at most %d KB.' % (limit // 1024))
+                    digest.update(chunk)
+                    out.write(chunk)
+            key = digest.hexdigest()[:32]
+            filename = key + FORMATS[self._image_format(temp)]
+            if os.path.exists(self._path(filename)):
+                os.remove(temp)
+            else:
+                os.replace(temp, self._path(filename))
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        return key, filename
+
+    def _image_format(self, path):
+        try:
+            with Image.open(path) as image:
+                too_large = image.width * image.height > self.app.config['AVATAR_MAX_PIXELS']
+                image_format = image.format
+                image.verify()
+        except (UnidentifiedImageError, OSError, SyntaxError, Image.DecompressionBombError):
+            raise AvatarRejected('The file is not a picture.')
+        if image_format not in FORMATS:
+            raise AvatarRejected('Pictures must be JPEG or PNG images.')
+        if too_large:
+            raise AvatarRejected('The picture is too large.')
+        return image_format
+
+    def make_thumbnails(self, key, source):
+        """Write a square thumbnail of source for each of AVATAR_SIZES."""
+        with Image.open(source) as image:
+            image = ImageOps.exif_transpose(image)
+            if image.mode != 'RGB':
+                # Transparent areas become white, as JPEG has no alpha channel
+                rgba = image.convert('RGBA')
+                image = Image.new('RGB', rgba.size, (255, 255, 255))
+                image.paste(rgba, mask=rgba.getchannel('A'))
+            for size in self.app.config['AVATAR_SIZES']:
+                thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+                path = self._path(self.thumbnail_name(key, size))
+                # Written aside and renamed, so a page never links a partial file
+                thumbnail.save(path + '.part', 'JPEG', quality=85, optimize=True, progressive=True)
+                os.replace(path + '.part', path)
+
+    def update_avatar(self, user, file_storage):
+        """Store an uploaded picture as user's avatar, committing, and have its thumbnails cut."""
+        key, filename = self.store(file_storage.stream)
+        url = self._url(filename)
+        ready = self.has_thumbnails(key)
+        user.profile_image_url = url
+        user.avatar_key = key if ready else None
+        db.session.commit()
+        if not ready:
+            self._submit(self._process_upload, user.id, key, self._path(filename), url)
+        return key
+
+    def _process_upload(self, user_id, key, source, url):
+        self.make_thumbnails(key, source)
+        with self.app.app_context():
+            # Unless the user uploaded another picture in the meantime
+            db.session.execute(sa.update(User).where(User.id == user_id, User.profile_image_url == url)
+                               .values(avatar_key=key))
+            db.session.commit()
+            forget_users([user_id])
+
+    def _submit(self, job, *args):
+        if not self.app.config['AVATAR_WORKERS']:
+            self._run(job, *args)
+            return
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.app.config['AVATAR_WORKERS'], thread_name_prefix='avatars')
+            future = self._executor.submit(self._run, job, *args)
+            self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+
+    def _run(self, job, *args):
+        try:
+            job(*args)
+        except Exception:
+            logger.exception('Could not make avatar thumbnails')
+
+    def wait(self):
+        """Block until every queued thumbnail job has finished."""
+        wait(list(self._pending))
+
+    def _default_thumbnails(self):
+        # The default picture is hashed once per process; its thumbnails are
+        # cut in the background the first time a page shows it
+        if self._default_key is None:
+            start = False
+            with self._lock:
+                if self._default_key is None:
+                    with open(self.app.config['AVATAR_DEFAULT_IMAGE'], 'rb') as image:
+                        self._default_key = hashlib.sha256(image.read()).hexdigest()[:32]
+                    self._default_ready = self.has_thumbnails(self._default_key)
+                    start = not self._default_ready
+            if start:
+                self._submit(self._process_default)
+        return self._default_key if self._default_ready else None
+
+    def _process_default(self):
+        os.makedirs(self.app.config['AVATAR_DIR'], exist_ok=True)
+        self.make_thumbnails(self._default_key, self.app.config['AVATAR_DEFAULT_IMAGE'])
+        self._default_ready = True
+
+    def url(self, user, size):
+        """Return the URL of user's smallest thumbnail at least size pixels wide."""
+        image_url = user.profile_image_url if user is not None else DEFAULT_IMAGE_URL
+        key = user.avatar_key if user is not None else None
+        if key is None and image_url == DEFAULT_IMAGE_URL:
+            key = self._default_thumbnails()
+        if key is None:
+            return image_url
+        sizes = sorted(self.app.config['AVATAR_SIZES'])
+        variant = next((candidate for candidate in sizes if candidate >= size), sizes[-1])
+        return self._url(self.thumbnail_name(key, variant))
+
+
+def avatar_url(user, size=100):
+    """URL of the picture to show for user at size x size pixels; the default one when there is no user."""
+    return current_app.extensions['avatars'].url(user, size)
+
+
+@click.command('backfill-avatars')
+@with_appcontext
+def backfill_avatars():
+    """Move pictures uploaded before thumbnails existed into the avatar store."""
+    store = current_app.extensions['avatars']
+    uploads = os.path.join(current_app.static_folder, 'uploads')
+    users = User.query.filter(User.avatar_key.is_(None), User.profile_image_url.like('/static/uploads/%'),
+                              User.profile_image_url != DEFAULT_IMAGE_URL).all()
+    moved = 0
+    for user in users:
+        path = os.path.join(uploads, os.path.basename(user.profile_image_url))
+        try:
+            with open(path, 'rb') as stream:
+                key, filename = store.store(stream)
+            if not store.has_thumbnails(key):
+                store.make_thumbnails(key, store._path(filename))
+        except (OSError, AvatarRejected) as exc:
+            click.echo('Skipped %s: %s' % (user.username, exc))
+            continue
+        user.profile_image_url = store._url(filename)
+        user.avatar_key = key
+        moved += 1
+    db.session.commit()
+    forget_users()
+    click.echo('%d avatars moved.' % moved)
@@ -3,6 +3,7 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import login_user,login_required, logout_user,current_user
 from . import auth
 from app.models.models import User, db, LoginHistory
+from app.cache import cache_page
 from datetime import datetime
 import re
 
@@ -12,6 +13,7 @@ def is_valid_email(email):
     return re.match(r"[^@]+@[^@]+\.[^@]+", email)
 
 @auth.route('/')
+@cache_page(lambda: ['page:index'])
 def index():
     return render_template('introduction.html')
 
@@ -1,27 +1,35 @@
 # notifications/routes.py
-from flask import render_template, redirect, url_for, flash, jsonify
+import click
+from flask import current_app, render_template, redirect, url_for, flash, jsonify
 from flask_login import login_required, current_user
 from . import notifications_bp
 from app.models.models import Notification,db, User
+from sqlalchemy import delete, update
+from sqlalchemy.orm import joinedload
+from app.avatars import avatar_url
+from app.cache import conditional_page
+from app.events import sse_event
+from .utils import adjust_unread_count, notification_summary, reconcile_unread_counts
 
 
 @notifications_bp.route('/')
 @login_required
 def notifications():
-    notifications = Notification.query.filter_by(user_id=current_user.id).all()
+    # Actors are joined in; only the post id is needed, so posts are not loaded
+    notifications = Notification.query.options(joinedload(Notification.actor)).filter_by(user_id=current_user.id).all()
+
     notifications_data = []
     for notification in notifications:
         actor = notification.actor  # The user who performed the action
-        post = notification.post  # The post where the action happened
         notifications_data.append({
             'id': notification.id,
             'message': notification.message[:30] + '...',  # Display part of the content
             'created_at': notification.created_at,
             'is_read': notification.is_read,
             'actor_name': actor.username,
-            'actor_image': actor.profile_image_url,
+            'actor_image': avatar_url(actor, 48),
             'notification_type': notification.notification_type,
-            'post_id': post.id
+            'post_id': notification.post_id  # The post where the action happened
         })
     return render_template('notifications/notifications.html', notifications=notifications_data)
 
@@ -31,7 +39,14 @@ def notifications():
 def mark_as_read(notification_id):
     notification = Notification.query.get(notification_id)
     if notification and notification.user_id == current_user.id:
-        notification.is_read = True
+        # Only the request that flips the flag decrements the unread count
+        marked = db.session.execute(
+            update(Notification)
+            .where(Notification.id == notification.id, Notification.is_read.is_(False))
+            .values(is_read=True)
+        ).rowcount
+        if marked:
+            adjust_unread_count([current_user.id], -1)
         db.session.commit()
     return redirect(url_for('notifications.notifications'))
 
@@ -40,9 +55,14 @@ def mark_as_read(notification_id):
 @notifications_bp.route('/delete/<int:notification_id>')
 @login_required
 def delete_notification(notification_id):
-    notification = Notification.query.get(notification_id)
-    if notification and notification.user_id == current_user.id:
-        db.session.delete(notification)
+    owned = (Notification.id == notification_id, Notification.user_id == current_user.id)
+    # Like mark_as_read, only the request that removes an unread row decrements
+    # the unread count, whatever concurrent deletes or reads did first
+    unread = db.session.execute(delete(Notification).where(*owned, Notification.is_read.is_(False))).rowcount
+    deleted = unread or db.session.execute(delete(Notification).where(*owned)).rowcount
+    if unread:
+        adjust_unread_count([current_user.id], -1)
+    if deleted:
         db.session.commit()
         flash('Notification deleted.', 'success')
     return redirect(url_for('notifications.notifications'))
@@ -52,11 +72,50 @@ def delete_notification(notification_id):
 # Showing latest notification
 @notifications_bp.route('/latest')
 @login_required
+@conditional_page(lambda: ['notifications:%d' % current_user.id])
 def latest_notifications():
     notifications = Notification.query.filter_by(user_id=current_user.id, is_read=False).order_by(Notification.created_at.desc()).limit(3).all()
-    return jsonify([{
-        'id': n.id,
-        'message': n.message,
-        'created_at': n.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-        'is_read': n.is_read
-    } for n in notifications])
+    return jsonify([notification_summary(n.id, n.message, n.created_at, n.is_read) for n in notifications])
+
+
+# Live notifications as Server-Sent Events: new notifications and unread
+# count changes are pushed from the event bus, so an idle stream runs no query
+@notifications_bp.route('/stream')
+@login_required
+def stream():
+    subscription = current_app.extensions['event_bus'].subscribe('user:%d' % current_user.id)
+    if subscription is None:
+        return jsonify({'success': False, 'error': 'Too many open streams'}), 503
+    heartbeat = current_app.config['EVENTS_HEARTBEAT']
+    unread = current_user.unread_notifications
+
+    # Runs after the request has ended and released its database session
+    def events():
+        yield sse_event({'count': unread}, event='unread')
+        while True:
+            item = subscription.get(heartbeat)
+            if subscription.take_overflow():
+                # Older events were dropped; the client refetches the latest instead
+                yield sse_event({}, event='resync')
+            if item is None:
+                # SSE comment line; writing it is how a dropped client is noticed
+                yield ': heartbeat\n\n'
+                continue
+            name, data = item
+            yield sse_event(data, event=name)
+
+    response = current_app.response_class(events(), mimetype='text/event-stream')
+    # The server closes the response when the client goes away, even before the first event
+    response.call_on_close(subscription.close)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Don't let a proxy buffer the stream
+    return response
+
+
+# Recompute every user's cached unread count, e.g. from a periodic job
+@notifications_bp.cli.command('reconcile-unread')
+def reconcile_unread():
+    """Recompute cached unread notification counts for all users."""
+    updated = reconcile_unread_counts()
+    db.session.commit()
+    click.echo('Reconciled unread counts for %d users.' % updated)
@@ -1,20 +1,119 @@
 # notifications/utils.py
-from app.models.models import Notification,db
+import re
+
+from sqlalchemy import func, insert, select, update
+
+from app.cache import bump_versions
+from app.events import publish_on_commit
+from app.identity import forget_users_on_commit
+from app.models.models import Notification, User, db
+
 
 def create_notification(user_id, actor_id, post_id=None, reply_id=None, message='', notification_type=''):
-    notification = Notification(
-        user_id=user_id,
-        actor_id=actor_id,
-        post_id=post_id,
-        reply_id=reply_id,
-        message=message,
-        notification_type=notification_type
-    )
-    db.session.add(notification)
+    create_notifications(actor_id, {user_id: notification_type}, post_id=post_id, reply_id=reply_id, message=message)
     db.session.commit()
 
 
+def create_notifications(actor_id, recipients, post_id=None, reply_id=None, message=''):
+    """Insert notifications for many users in one statement, without committing.
+
+    recipients maps each receiving user id to its notification type, so the
+    rows become part of the caller's transaction.
+    """
+    rows = [
+        {
+            'user_id': user_id,
+            'actor_id': actor_id,
+            'post_id': post_id,
+            'reply_id': reply_id,
+            'message': message,
+            'notification_type': notification_type,
+        }
+        for user_id, notification_type in recipients.items()
+    ]
+    if rows:
+        created = db.session.execute(
+            insert(Notification).returning(Notification.id, Notification.user_id, Notification.created_at), rows)
+        # Pushed to the recipients' open notification streams once committed
+        for notification_id, user_id, created_at in created:
+            publish_on_commit(db.session, 'user:%d' % user_id, 'notification',
+                              notification_summary(notification_id, message, created_at))
+        adjust_unread_count(list(recipients), 1)
+    return len(rows)
+
+
+def notification_summary(notification_id, message, created_at, is_read=False):
+    """The JSON form of a notification sent to the navbar bell."""
+    return {
+        'id': notification_id,
+        'message': message,
+        'created_at': created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'is_read': is_read,
+    }
+
+
+def adjust_unread_count(user_ids, delta):
+    """Add delta to the cached unread count of the given users, never going below zero."""
+    if not user_ids:
+        return
+    statement = update(User).where(User.id.in_(user_ids))
+    if delta < 0:
+        statement = statement.where(User.unread_notifications >= -delta)
+    counts = db.session.execute(
+        statement.values(unread_notifications=User.unread_notifications + delta)
+        .returning(User.id, User.unread_notifications)).all()
+    for user_id, count in counts:
+        publish_on_commit(db.session, 'user:%d' % user_id, 'unread', {'count': count})
+    # Every change to a user's unread notifications passes through here
+    bump_versions(*['notifications:%d' % user_id for user_id in user_ids])
+    forget_users_on_commit(db.session, user_ids)
+
+
+def reconcile_unread_counts(user_ids=None):
+    """Recompute cached unread counts from the notification table in one statement."""
+    unread = (
+        select(func.count(Notification.id))
+        .where(Notification.user_id == User.id, Notification.is_read.is_(False))
+        .scalar_subquery()
+    )
+    statement = update(User).values(unread_notifications=unread)
+    if user_ids is not None:
+        statement = statement.where(User.id.in_(user_ids))
+    updated = db.session.execute(statement, execution_options={'synchronize_session': False}).rowcount
+    forget_users_on_commit(db.session, user_ids)
+    return updated
+
+
+def resolve_mentions(content):
+    """Return {username: user_id} for every existing user @mentioned in content, using one query."""
+    usernames = extract_mentions(content)
+    if not usernames:
+        return {}
+    return dict(db.session.execute(select(User.username, User.id).where(User.username.in_(usernames))).all())
+
+
+def notify_activity(actor_id, content, post, reply=None):
+    """Notify everyone a new post or reply concerns, inside the caller's transaction.
+
+    For a reply the post author gets a 'new_reply' notification; every other
+    mentioned user gets a 'mention'. The actor is never notified and nobody
+    is notified twice.
+    """
+    recipients = {}
+    if reply is not None and post.user_id is not None:
+        recipients[post.user_id] = 'new_reply'
+    for user_id in resolve_mentions(content).values():
+        recipients.setdefault(user_id, 'mention')
+    recipients.pop(actor_id, None)
+    return create_notifications(
+        actor_id,
+        recipients,
+        post_id=post.id,
+        reply_id=reply.id if reply is not None else None,
+        message=content[:50] + '...',
+    )
+
+
 def extract_mentions(content):
-    import re
     mentions = re.findall(r'@(\w+)', content)
     return list(set(mentions))  # Return unique mentions
@@ -0,0 +1,316 @@
+# chatbot.py
+# OpenAI chat completions for the chatbot page. Streaming answers are read
+# from the upstream by a worker thread and handed to the request through a
+# queue, so the response can relay tokens as Server-Sent Events, enforce its
+# own timeouts and stop the upstream call as soon as the browser goes away.
+import hashlib
+import json
+import logging
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import openai
+import sqlalchemy as sa
+from flask import current_app, session
+from flask_login import current_user
+
+from app.events import sse_event
+from app.models.models import ChatConversation, ChatMessage, db
+
+logger = logging.getLogger(__name__)
+
+# Put on the token queue by the worker thread once the answer is complete
+_DONE = object()
+
+
+class ChatTimeout(Exception):
+    """The upstream stopped sending tokens or took too long overall."""
+
+
+class ChatResponseCache:
+    """LRU of chatbot answers with a TTL and hit/miss counters.
+
+    Answers are keyed on the model, the sampling parameters and the prompt
+    with each message normalized, so repeated questions that differ only in
+    case, spacing or trailing punctuation share one entry.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CHAT_CACHE_ENABLED', True)
+        app.config.setdefault('CHAT_CACHE_TTL', 24 * 60 * 60)
+        app.config.setdefault('CHAT_CACHE_MAX_ENTRIES', 1000)
+        app.config.setdefault('CHAT_CACHE_MAX_MESSAGES', 3)
+        app.extensions['chat_cache'] = self
+        self.app = app
+
+    def key(self, messages):
+        """Return the cache key of a prompt, or None if it is too long to be worth caching."""
+        config = self.app.config
+        if not config['CHAT_CACHE_ENABLED'] or len(messages) > config['CHAT_CACHE_MAX_MESSAGES']:
+            return None
+        payload = [config['OPENAI_MODEL'], config['CHAT_TEMPERATURE'], config['CHAT_MAX_TOKENS'],
+                   [(message['role'], normalize_question(message['content'])) for message in messages]]
+        return hashlib.sha256(json.dumps(payload).encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, answer):
+        with self._lock:
+            self._entries[key] = (answer, time.monotonic() + self.app.config['CHAT_CACHE_TTL'])
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.app.config['CHAT_CACHE_MAX_ENTRIES']:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+def normalize_question(text):
+    """Lower-case a message, collapse whitespace and drop trailing punctuation."""
+    return re.sub(r'\s+', ' ', text).strip().lower().rstrip('?!. ')
+
+
+def cached_answer(messages):
+    """Return (key, answer) for a prompt; answer is None on a miss and key None if uncacheable."""
+    cache = current_app.extensions['chat_cache']
+    key = cache.key(messages)
+    return key, (cache.get(key) if key is not None else None)
+
+
+def remember_answer(key, answer):
+    if key is not None and answer:
+        current_app.extensions['chat_cache'].set(key, answer)
+
+
+def _completion_params(messages, config):
+    params = {
+        'model': config['OPENAI_MODEL'],
+        'messages': messages,
+        'temperature': config['CHAT_TEMPERATURE'],
+        'max_tokens': config['CHAT_MAX_TOKENS'],
+        'request_timeout': config['CHAT_REQUEST_TIMEOUT'],
+    }
+    # A key or endpoint set in config wins over the module-wide openai settings
+    if config.get('OPENAI_API_KEY'):
+        params['api_key'] = config['OPENAI_API_KEY']
+    if config.get('OPENAI_API_BASE'):
+        params['api_base'] = config['OPENAI_API_BASE']
+    return params
+
+
+def init_chatbot(app):
+    app.config.setdefault('OPENAI_MODEL', 'gpt-3.5-turbo')
+    app.config.setdefault('OPENAI_API_KEY', None)
+    app.config.setdefault('OPENAI_API_BASE', None)
+    app.config.setdefault('CHAT_TEMPERATURE', 0.6)
+    app.config.setdefault('CHAT_MAX_TOKENS', 1000)
+    app.config.setdefault('CHAT_REQUEST_TIMEOUT', 30)
+    app.config.setdefault('CHAT_IDLE_TIMEOUT', 30)
+    app.config.setdefault('CHAT_MAX_DURATION', 120)
+    app.config.setdefault('CHAT_KEEPALIVE_INTERVAL', 10)
+    app.config.setdefault('CHAT_HISTORY_TOKEN_BUDGET', 3000)
+    app.config.setdefault('CHAT_HISTORY_MAX_MESSAGES', 100)
+    ChatResponseCache(app)
+
+
+def estimate_tokens(text):
+    """Rough prompt token count: about four characters per token plus per-message overhead."""
+    return len(text) // 4 + 4
+
+
+def current_conversation(create=True):
+    """Return the id of the user's chat conversation, starting one if needed.
+
+    Only the id lives in the session; it is ignored unless the conversation
+    belongs to the logged-in user.
+    """
+    session.pop('chat_history', None)  # History kept in the session by older versions
+    conversation_id = session.get('chat_conversation_id')
+    if conversation_id is not None:
+        owner = db.session.execute(
+            sa.select(ChatConversation.user_id).where(ChatConversation.id == conversation_id)
+        ).scalar()
+        if owner == current_user.id:
+            return conversation_id
+    if not create:
+        return None
+    conversation = ChatConversation(user_id=current_user.id)
+    db.session.add(conversation)
+    db.session.flush()
+    session['chat_conversation_id'] = conversation.id
+    return conversation.id
+
+
+def add_message(conversation_id, role, content):
+    """Append a message to a conversation, without committing."""
+    db.session.add(ChatMessage(conversation_id=conversation_id, role=role, content=content,
+                               tokens=estimate_tokens(content)))
+
+
+def conversation_messages(conversation_id):
+    """Return the latest CHAT_HISTORY_MAX_MESSAGES messages of a conversation, oldest first."""
+    if conversation_id is None:
+        return []
+    messages = (ChatMessage.query.filter_by(conversation_id=conversation_id)
+                .order_by(ChatMessage.id.desc())
+                .limit(current_app.config['CHAT_HISTORY_MAX_MESSAGES'])
+                .all())
+    messages.reverse()
+    return messages
+
+
+def build_prompt(conversation_id, budget=None):
+    """Assemble the messages sent upstream: the newest turns that fit the token budget.
+
+    Older turns are dropped once CHAT_HISTORY_TOKEN_BUDGET is used up, so the
+    prompt stays the same size however long the conversation gets. The newest
+    message is always included.
+    """
+    config = current_app.config
+    budget = config['CHAT_HISTORY_TOKEN_BUDGET'] if budget is None else budget
+    rows = db.session.execute(
+        sa.select(ChatMessage.role, ChatMessage.content, ChatMessage.tokens)
+        .where(ChatMessage.conversation_id == conversation_id)
+        .order_by(ChatMessage.id.desc())
+        .limit(config['CHAT_HISTORY_MAX_MESSAGES'])
+    )
+    prompt = []
+    used = 0
+    for role, content, tokens in rows:
+        if prompt and used + tokens > budget:
+            break
+        prompt.append({'role': role, 'content': content})
+        used += tokens
+    prompt.reverse()
+    return prompt
+
+
+def complete_chat(messages):
+    """Return the full answer to a conversation in one blocking call, using the response cache."""
+    key, answer = cached_answer(messages)
+    if answer is not None:
+        return answer
+    response = openai.ChatCompletion.create(**_completion_params(messages, current_app.config))
+    answer = response.choices[0].message['content']
+    remember_answer(key, answer)
+    return answer
+
+
+def _read_stream(params, tokens, cancelled):
+    # Runs on the worker thread: push every content delta onto the queue
+    try:
+        for chunk in openai.ChatCompletion.create(stream=True, **params):
+            if cancelled.is_set():
+                logger.info('Chat stream cancelled by the client')
+                return
+            content = chunk['choices'][0].get('delta', {}).get('content')
+            if content:
+                tokens.put(content)
+        tokens.put(_DONE)
+    except Exception as exc:
+        tokens.put(exc)
+
+
+def stream_chat(messages, keepalive=False):
+    """Yield the answer to a conversation piece by piece as the upstream produces it.
+
+    With keepalive, None is yielded whenever no token has arrived for
+    CHAT_KEEPALIVE_INTERVAL seconds, so the caller can probe the connection.
+    Raises ChatTimeout when CHAT_IDLE_TIMEOUT passes without a token or the
+    answer takes longer than CHAT_MAX_DURATION. Closing the generator early
+    cancels the upstream call.
+    """
+    config = current_app.config
+    tokens = queue.Queue()
+    cancelled = threading.Event()
+    worker = threading.Thread(target=_read_stream, args=(_completion_params(messages, config), tokens, cancelled),
+                              name='chat-stream', daemon=True)
+    worker.start()
+
+    started = last_token = time.monotonic()
+    try:
+        while True:
+            now = time.monotonic()
+            if now - started >= config['CHAT_MAX_DURATION']:
+                raise ChatTimeout('The answer took too long')
+            if now - last_token >= config['CHAT_IDLE_TIMEOUT']:
+                raise ChatTimeout('The assistant stopped responding')
+            wait = min(config['CHAT_KEEPALIVE_INTERVAL'], config['CHAT_IDLE_TIMEOUT'] - (now - last_token))
+            try:
+                token = tokens.get(timeout=max(wait, 0))
+            except queue.Empty:
+                if keepalive:
+                    yield None
+                continue
+            if token is _DONE:
+                return
+            if isinstance(token, Exception):
+                raise token
+            last_token = time.monotonic()
+            yield token
+    finally:
+        # Also reached through GeneratorExit when the client disconnects
+        cancelled.set()
+
+
+def stream_answer_events(messages, on_complete=None):
+    """Relay an answer as Server-Sent Events: token events, then done or error.
+
+    on_complete is called with the full answer once it has been streamed.
+    A cached answer is sent as a single token event.
+    """
+    key, answer = cached_answer(messages)
+    if answer is not None:
+        if on_complete is not None:
+            on_complete(answer)
+        yield sse_event({'token': answer})
+        yield sse_event({'answer': answer}, event='done')
+        return
+
+    parts = []
+    try:
+        for token in stream_chat(messages, keepalive=True):
+            if token is None:
+                # SSE comment line; writing it is how a dropped client is noticed
+                yield ': keepalive\n\n'
+                continue
+            parts.append(token)
+            yield sse_event({'token': token})
+    except ChatTimeout as exc:
+        yield sse_event({'error': str(exc)}, event='error')
+        return
+    except Exception:
+        logger.exception('Chat stream failed')
+        yield sse_event({'error': 'The assistant is unavailable, please try again.'}, event='error')
+        return
+
+    answer = ''.join(parts)
+    remember_answer(key, answer)
+    if on_complete is not None:
+        on_complete(answer)
+    yield sse_event({'answer': answer}, event='done')
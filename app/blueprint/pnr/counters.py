@@ -0,0 +1,128 @@
+# counters.py
+# Write-behind buffer for post view counts. Page views are added up in memory
+# and written as one batched UPDATE per flush, so reading a thread no longer
+# needs a write transaction of its own.
+import atexit
+import logging
+import threading
+import time
+import weakref
+
+import sqlalchemy as sa
+from flask import current_app
+
+from app.cache import bump_versions
+from app.models.models import Post, db
+
+logger = logging.getLogger(__name__)
+
+
+class ViewCounter:
+    """Aggregates post view increments and flushes them in batches.
+
+    A flush happens when VIEW_COUNT_FLUSH_THRESHOLD views are pending, at
+    most VIEW_COUNT_FLUSH_INTERVAL seconds after a view was buffered, and
+    once more when the process exits.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        # Views taken by a flush whose UPDATE has not committed yet
+        self._inflight = {}
+        self._total = 0
+        self._last_flush = time.monotonic()
+        self._timer = None
+        self._exit_hook = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('VIEW_COUNT_FLUSH_INTERVAL', 10)
+        app.config.setdefault('VIEW_COUNT_FLUSH_THRESHOLD', 100)
+        app.extensions['view_counter'] = self
+        self.app = app
+        if not self._exit_hook:
+            # Through a weak reference, so the hook does not keep the app alive
+            counter = weakref.ref(self)
+            atexit.register(lambda: counter() is not None and counter().flush())
+            self._exit_hook = True
+
+    def add(self, post_id, count=1):
+        """Record views for a post, flushing if a limit has been reached."""
+        with self._lock:
+            self._pending[post_id] = self._pending.get(post_id, 0) + count
+            self._total += count
+            due = (self._total >= self.app.config['VIEW_COUNT_FLUSH_THRESHOLD']
+                   or time.monotonic() - self._last_flush >= self.app.config['VIEW_COUNT_FLUSH_INTERVAL'])
+            if not due:
+                self._arm_timer()
+        if due:
+            self.flush()
+
+    def _arm_timer(self):
+        # Called with the lock held; the views are written even if no further view comes in
+        if self._timer is None:
+            self._timer = threading.Timer(self.app.config['VIEW_COUNT_FLUSH_INTERVAL'], self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def pending(self, post_id):
+        """Return the number of views not yet written for a post."""
+        return self._pending.get(post_id, 0) + self._inflight.get(post_id, 0)
+
+    def flush(self):
+        """Write all pending views with one UPDATE per post in a single transaction."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._total = 0
+            self._last_flush = time.monotonic()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._add_counts(self._inflight, pending)
+        if not pending:
+            return 0
+
+        post = Post.__table__
+        statement = (
+            sa.update(post)
+            .where(post.c.id == sa.bindparam('b_post_id'))
+            .values(views=sa.func.coalesce(post.c.views, 0) + sa.bindparam('b_count'))
+        )
+        rows = [{'b_post_id': post_id, 'b_count': count} for post_id, count in pending.items()]
+        try:
+            with self.app.app_context(), db.engine.begin() as connection:
+                connection.execute(statement, rows)
+                # Thread lists show view counts
+                bump_versions('views', connection=connection)
+        except sa.exc.SQLAlchemyError:
+            # Put the views back and arm the timer, so they are retried even on a quiet site
+            logger.exception('Failed to flush %d post view counts', len(rows))
+            with self._lock:
+                self._add_counts(self._pending, pending)
+                self._total += sum(pending.values())
+                self._add_counts(self._inflight, pending, -1)
+                self._arm_timer()
+            return 0
+        with self._lock:
+            self._add_counts(self._inflight, pending, -1)
+        return len(rows)
+
+    @staticmethod
+    def _add_counts(counts, changes, sign=1):
+        for post_id, count in changes.items():
+            counts[post_id] = counts.get(post_id, 0) + sign * count
+            if not counts[post_id]:
+                del counts[post_id]
+
+
+def record_view(post_id):
+    """Count a view of a post through the app's view counter."""
+    current_app.extensions['view_counter'].add(post_id)
+
+
+def view_count(post):
+    """Return the stored view count of a post plus any views not yet flushed."""
+    return (post.views or 0) + current_app.extensions['view_counter'].pending(post.id)
@@ -0,0 +1,152 @@
+# news.py
+# Cached NewsAPI client. Articles are kept for NEWS_CACHE_TTL seconds; once
+# they go stale they are still served while a single background thread
+# fetches fresh ones, so a slow or failing upstream never holds up a page.
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+
+from .utils import fetch_car_news
+
+logger = logging.getLogger(__name__)
+
+
+class NewsCache:
+    """Stale-while-revalidate cache of NewsAPI articles.
+
+    Only the very first request of a cold cache waits for the upstream. When
+    NEWS_CACHE_FILE is set the articles are also written to disk, so a
+    restarted process starts warm.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._articles = None
+        self._fetched_at = 0.0
+        self._retry_at = 0.0
+        self._refreshing = False
+        self._loaded = False
+        # A hit is an answer served without waiting for the upstream
+        self.hits = 0
+        self.misses = 0
+        self._session = requests.Session()
+        # Reuse connections to the news host across refreshes
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('NEWS_API_KEY', None)
+        app.config.setdefault('NEWS_API_URL', 'https://newsapi.org/v2/everything')
+        app.config.setdefault('NEWS_QUERY', 'car')
+        app.config.setdefault('NEWS_CACHE_TTL', 900)
+        app.config.setdefault('NEWS_CACHE_RETRY', 60)
+        app.config.setdefault('NEWS_REQUEST_TIMEOUT', 5)
+        app.config.setdefault('NEWS_CACHE_FILE', None)
+        app.extensions['news_cache'] = self
+        self.app = app
+
+    def articles(self):
+        """Return the cached articles, refreshing them first only if there are none."""
+        self._load()
+        now = time.time()
+        with self._lock:
+            articles = self._articles
+            stale = now - self._fetched_at >= self.app.config['NEWS_CACHE_TTL']
+            start = stale and not self._refreshing and now >= self._retry_at
+            if start:
+                self._refreshing = True
+            if articles is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if articles is None:
+            if start:
+                self._refresh()
+            return self._articles or []
+        if start:
+            threading.Thread(target=self._refresh, name='news-refresh', daemon=True).start()
+        return articles
+
+    def refresh(self):
+        """Fetch the articles now, blocking until the upstream answers or times out."""
+        with self._lock:
+            self._refreshing = True
+        self._refresh()
+        return self._articles or []
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'articles': len(self._articles or [])}
+
+    def clear(self):
+        with self._lock:
+            self._articles = None
+            self._fetched_at = self._retry_at = 0.0
+            self._loaded = True
+
+    def _refresh(self):
+        config = self.app.config
+        try:
+            articles = fetch_car_news(config['NEWS_API_KEY'], session=self._session, url=config['NEWS_API_URL'],
+                                      query=config['NEWS_QUERY'], timeout=config['NEWS_REQUEST_TIMEOUT'])
+        except (requests.RequestException, ValueError):
+            # Keep serving what we have and leave the upstream alone for a while
+            logger.warning('Failed to refresh news articles', exc_info=True)
+            with self._lock:
+                self._retry_at = time.time() + config['NEWS_CACHE_RETRY']
+                self._refreshing = False
+            return
+
+        with self._lock:
+            self._articles = articles
+            self._fetched_at = time.time()
+            self._retry_at = 0.0
+            self._refreshing = False
+        self._save(articles)
+
+    def _load(self):
+        # Warm start from disk, once, on first use
+        if self._loaded:
+            return
+        path = self.app.config['NEWS_CACHE_FILE']
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            if not path or not os.path.exists(path):
+                return
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                self._articles = data['articles']
+                self._fetched_at = data['fetched_at']
+            except (OSError, ValueError, KeyError):
+                logger.warning('Ignoring unreadable news cache file %s', path, exc_info=True)
+
+    def _save(self, articles):
+        path = self.app.config['NEWS_CACHE_FILE']
+        if not path:
+            return
+        try:
+            # Write then rename, so readers never see a half-written file
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'fetched_at': self._fetched_at, 'articles': articles}, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.warning('Failed to write news cache file %s', path, exc_info=True)
+
+
+def latest_news():
+    """Return the car news articles through the app's news cache."""
+    return current_app.extensions['news_cache'].articles()
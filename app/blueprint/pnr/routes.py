@@ -1,13 +1,22 @@
-from flask import render_template, request,jsonify, redirect, url_for, flash, session,g
+from flask import render_template, request,jsonify, redirect, url_for, flash, session,g, current_app, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import current_user, login_required, login_user
 from . import pr
 from app.models.models import Post, Reply, db, User, Vote
+from sqlalchemy.orm import joinedload
 from datetime import datetime
 from .forms import PostForm
 import openai
-from app.blueprint.notifications.utils import create_notification, extract_mentions
-from .utils import fetch_car_news
+from app.blueprint.notifications.utils import notify_activity
+from .news import latest_news
+from .chatbot import (add_message, build_prompt, complete_chat, conversation_messages, current_conversation,
+                      stream_answer_events)
+from .search import build_match, highlight, index_available, search_posts
+from .counters import record_view
+from .votes import VoteRejected, cast_vote, vote_states
+from .threads import load_reply_tree, top_level_replies
+from app.pagination import paginate
+from app.cache import bump_versions, cache_page, purge_pages, thread_list_keys
 from dotenv import load_dotenv
 import os
 
@@ -25,32 +34,25 @@ def before_request():
 
 # Route for the post page
 @pr.route('/view_posts')
+# 'views' is bumped whenever buffered view counts are written
+@cache_page(lambda: ['list:%s' % (request.args.get('tag') or 'all'), 'views'])
 def view_post():
     tag = request.args.get('tag')
-    page = request.args.get('page', 1, type=int)
     per_page = 10  # Number of posts per page
 
     # user can select the tag to filter post
+    # author and last replier are joined in so the page renders from one query
+    posts_query = Post.query.options(joinedload(Post.user), joinedload(Post.last_replier))
     if tag:
-        posts = Post.query.filter_by(category=tag).order_by(Post.last_reply_date.desc()).paginate(page=page, per_page=per_page)
-    else:
-        posts = Post.query.order_by(Post.last_reply_date.desc()).paginate(page=page, per_page=per_page)
-
+        posts_query = posts_query.filter_by(category=tag)
+    posts = paginate(posts_query, (Post.last_reply_date, Post.id), per_page=per_page)
 
     user = current_user
-    for post in posts.items:
-        last_reply = Reply.query.filter_by(post_id=post.id).order_by(Reply.created_at.desc()).first()
-        if last_reply:  # Check if there is a reply
-            post.last_replier_username = last_reply.user.username
-            post.last_reply_date = last_reply.created_at
-        else:
-            post.last_replier_username = 'No replies'
-            post.last_reply_date = post.created_at  # Use the post creation date if no replies
-
     return render_template('posts/view_posts.html', posts = posts, user = user)
 
 # Route for the main page
 @pr.route('/forums')
+@cache_page(lambda: ['page:forums'])
 def forums():
     return render_template('forums.html')
 
@@ -67,22 +69,17 @@ def create_post():
     if form.validate_on_submit():
         new_post = Post(title=form.title.data, category=form.category.data, content=form.content.data, user_id=current_user.id)
         db.session.add(new_post)
-        db.session.commit()
+        db.session.flush()
 
-        # 1.1 new feature: check for mentions and create notification
-        mentions = extract_mentions(form.content.data) # Extract mentions from the post content
-        for username in mentions:
-            user = User.query.filter_by(username=username).first()
-            if user:
-                create_notification(
-                    user_id=user.id, 
-                    actor_id=current_user.id,
-                    post_id=new_post.id, 
-                    message=form.content.data[:50] + '...',
-                    notification_type='mention'
-                )
+        # 1.1 new feature: notify mentioned users in the same transaction as the post
+        notify_activity(current_user.id, form.content.data, new_post)
+        bump_versions(*thread_list_keys(new_post.category))
+        db.session.commit()
         # -end- 1.1
 
+        # Drop cached thread lists the new post appears on
+        purge_pages(*thread_list_keys(new_post.category))
+
         flash('Your post has been created!', 'success')
         return redirect(url_for('pr.view_post'))  # Redirect to posts page
     return render_template('posts/create_post.html', form=form,user=current_user)
@@ -90,18 +87,37 @@ def create_post():
 
 
 @pr.route('/detail/<int:post_id>')
+@cache_page(lambda post_id: ['post:%d' % post_id], on_hit=record_view)
 def details(post_id):
-    page = request.args.get('page', 1, type=int)
     per_page = 6  # Number of replies per page
 
     post = Post.query.get_or_404(post_id)  # Fetch the post or return 404 if not found
 
-    # Fetch replies with pagination
-    replies = Reply.query.filter_by(post_id=post.id).order_by(Reply.created_at.asc()).paginate(page=page, per_page=per_page)
+    # Paginate by top-level reply; the replies beneath them, with their
+    # authors, come from one tree query however deep the thread goes, and
+    # only for the top-level replies flagged as having any
+    replies = paginate(top_level_replies(post.id), (Reply.created_at, Reply.id), per_page=per_page, descending=False)
+    thread = load_reply_tree([reply for reply, has_children in replies.items],
+                             parents={reply.id for reply, has_children in replies.items if has_children})
     
-    post.views += 1  # Increment the view count
-    db.session.commit()
-    return render_template('posts/detail.html', post=post,replies=replies)
+    record_view(post.id)  # Buffered, written in batches by the view counter
+    # The viewer's votes on everything on the page, for highlighting the thumbs
+    user_id = current_user.id if current_user.is_authenticated else None
+    reply_ids = [node.reply.id for root in thread for node in root.walk()]
+    votes = vote_states(user_id, [post.id], reply_ids)
+    reply_to = request.args.get('reply_to', type=int)  # Set by the Reply link of a reply
+    return render_template('posts/detail.html', post=post, replies=replies, thread=thread, votes=votes,
+                           reply_to=reply_to)
+
+
+# A branch cut off by the depth limit of the thread page, continued from one reply
+@pr.route('/reply/<int:reply_id>/thread')
+def reply_thread(reply_id):
+    reply = Reply.query.get_or_404(reply_id)
+    thread = load_reply_tree([reply])
+    user_id = current_user.id if current_user.is_authenticated else None
+    votes = vote_states(user_id, reply_ids=[node.reply.id for node in thread[0].walk()])
+    return render_template('posts/reply_thread.html', post=reply.post, thread=thread, votes=votes)
 
 
 # Handle submit reply
@@ -115,45 +131,32 @@ def submit_reply(post_id):
 
     post = Post.query.get_or_404(post_id)  # Make sure the post exists
     reply_content = request.form['reply_content']
+    # Answering another reply nests under it; it has to belong to the same thread
+    parent_id = request.form.get('parent_id', type=int)
+    if parent_id is not None:
+        parent = db.session.get(Reply, parent_id)
+        if parent is None or parent.post_id != post.id:
+            parent_id = None
     if reply_content:
-        reply = Reply(content=reply_content, post_id=post.id, user_id=current_user.id)
+        reply = Reply(content=reply_content, post_id=post.id, user_id=current_user.id, parent_id=parent_id)
         db.session.add(reply)
-        db.session.commit()
+        db.session.flush()
 
         #Increment the reply count
         post.replies_count += 1 
-        db.session.commit()
-        # Update the last reply date
-        post.last_reply_date = datetime.utcnow() 
-        db.session.commit()
+        # Update the last reply pointer and date
+        post.set_last_reply(reply)
 
         #####################1.1 new feature
-        # Create notification for the post author
-        if current_user.id != post.user_id:  # Avoid notifying the user themselves
-            create_notification(
-                user_id=post.user_id, # the one who receives the notification
-                actor_id=current_user.id, # the one who performs the notification
-                post_id=post.id, 
-                reply_id=reply.id, 
-                message=reply_content[:50] + '...',
-                notification_type='new_reply'
-            )
-        
-        # Check for mentions and create notifications
-        mentions = extract_mentions(reply_content)  # Extract mentions from the reply content
-        for username in mentions:
-            user = User.query.filter_by(username=username).first()
-            if user and user.id != post.user_id:  # Avoid duplicate notification to the post author
-                create_notification(
-                    user_id=user.id, 
-                    actor_id=current_user.id,
-                    post_id=post.id, 
-                    reply_id=reply.id, 
-                    message=reply_content[:50] + '...',
-                    notification_type='mention'
-                )
+        # Notify the post author and mentioned users in the same transaction as the reply
+        notify_activity(current_user.id, reply_content, post, reply)
+        bump_versions('post:%d' % post.id, *thread_list_keys(post.category))
+        db.session.commit()
         #######################1.1 end
 
+        # Drop the cached thread page and the lists it is bumped to the top of
+        purge_pages('post:%d' % post.id, *thread_list_keys(post.category))
+
         flash('Your reply has been posted.', 'success')
     else:
         flash('Reply cannot be empty.', 'error')
@@ -167,39 +170,55 @@ def chat():
         flash('You must be logged in to use the chatbot.', 'warning')
         return redirect(url_for('auth.login'))
 
-    # Initialize chat history if not present in the session
-    if 'chat_history' not in session:
-        session['chat_history'] = []
-
     if request.method == "POST":
         # Extract the question from the form data
         question = request.form["question"]
         
-        # Append the user's question to the chat history
-        session['chat_history'].append({'role': 'user', 'content': question})
-        
-        # Generate a response using the GPT-3.5 Turbo model
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=session['chat_history'],  # Send the entire chat history
-            temperature=0.6, 
-            max_tokens=1000, 
-        )
-        answer = response.choices[0].message['content']
-        
-        # Append the bot's answer to the chat history
-        session['chat_history'].append({'role': 'assistant', 'content': answer})
+        # Append the user's question to the stored conversation, committed
+        # before the upstream call so no write transaction waits on it
+        conversation_id = current_conversation()
+        add_message(conversation_id, 'user', question)
+        prompt = build_prompt(conversation_id)  # The recent turns that fit the token budget
+        db.session.commit()
+
+        answer = complete_chat(prompt)
+
+        # Append the bot's answer to the conversation in a second short transaction
+        add_message(conversation_id, 'assistant', answer)
+        db.session.commit()
         
         # Redirect to the same page to display the updated chat history
         return redirect(url_for("pr.chat"))
 
-    # Retrieve the chat history from the session
-    chat_history = session.get('chat_history', [])
+    # Retrieve the chat history of the current conversation
+    chat_history = conversation_messages(current_conversation(create=False))
     
     # Render the chatbot template with the chat history
     return render_template("posts/chatbot.html", chat_history=chat_history, user=current_user) #define user
 
 
+# Streaming chatbot: the answer is relayed token by token as Server-Sent Events
+@pr.route("/chat/stream", methods=["POST"])
+@login_required
+def chat_stream():
+    question = request.form.get("question", "").strip()
+    if not question:
+        return jsonify({'success': False, 'error': 'Question cannot be empty'}), 400
+
+    conversation_id = current_conversation()
+    add_message(conversation_id, 'user', question)
+    db.session.commit()
+
+    def save_answer(answer):
+        add_message(conversation_id, 'assistant', answer)
+        db.session.commit()
+
+    events = stream_answer_events(build_prompt(conversation_id), on_complete=save_answer)
+    response = current_app.response_class(stream_with_context(events), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Don't let a proxy buffer the stream
+    return response
+
 
 
 
@@ -208,7 +227,7 @@ def chat():
 def search():
     query = request.args.get('q')
     search_type = request.args.get('search_type')
-    page = request.args.get('page', 1, type=int)
+    sort = request.args.get('sort', 'relevance')  # 'relevance' or 'recent'
     per_page = 10  # Number of search results per page
 
     # Get current user if logged in
@@ -218,111 +237,89 @@ def search():
     results_query = None
 
     if query:
-        # Ensure the query and search type are handled properly
-        query = f"%{query}%"
-
-        if search_type == 'Titles':
-            # Search by post titles
-            results_query = Post.query.filter(Post.title.ilike(query))
-        elif search_type == 'Descriptions':
-            # Search by post descriptions
-            results_query = Post.query.filter(Post.content.ilike(query))
+        # Use the full-text index when it exists and the query has searchable words
+        match = build_match(query, search_type)
+        use_index = match is not None and index_available(db.session.connection())
+        if use_index:
+            results_query = search_posts(match, sort=sort)
         else:
-            # Search by both titles and descriptions
-            results_query = Post.query.filter(
-                (Post.title.ilike(query)) | (Post.content.ilike(query))
-            )
-
-        # Order by last_reply_date before pagination
-        results_query = results_query.order_by(Post.last_reply_date.desc())
-
-        # Paginate the results
-        results = results_query.paginate(page=page, per_page=per_page)
-
-        # fetch the last replier's username and last reply date for each post
-        for post in results.items:
-            last_reply = Reply.query.filter_by(post_id=post.id).order_by(Reply.created_at.desc()).first()
-            if last_reply:
-                post.last_replier_username = last_reply.user.username
-                post.last_reply_date = last_reply.created_at
+            # Fall back to LIKE matching, which can only be ordered by recency
+            sort = 'recent'
+            pattern = f"%{query}%"
+
+            if search_type == 'Titles':
+                # Search by post titles
+                results_query = Post.query.filter(Post.title.ilike(pattern))
+            elif search_type == 'Descriptions':
+                # Search by post descriptions
+                results_query = Post.query.filter(Post.content.ilike(pattern))
             else:
-                post.last_replier_username = 'No replies'
-                post.last_reply_date = post.created_at
+                # Search by both titles and descriptions
+                results_query = Post.query.filter(
+                    (Post.title.ilike(pattern)) | (Post.content.ilike(pattern))
+                )
+
+        results_query = results_query.options(joinedload(Post.user), joinedload(Post.last_replier))
+
+        # Paginate the results; relevance order is only offered by page number
+        if sort == 'recent':
+            results = paginate(results_query, (Post.last_reply_date, Post.id), per_page=per_page)
+        else:
+            results = paginate(results_query, per_page=per_page)
+
+        # Full-text rows come back as (post, snippet) pairs
+        if use_index:
+            for post, snippet in results.items:
+                post.search_snippet = highlight(snippet)
+            results.items = [post for post, snippet in results.items]
     else:
         results = None
 
-    return render_template('posts/search_results.html', results=results, query=query, user=user)
+    return render_template('posts/search_results.html', results=results, query=query,
+                           search_type=search_type, sort=sort, user=user)
 
 
 
 #######################1.1 new features likes 
+# Upper bound on the ids of each type accepted by one vote state request
+MAX_VOTE_STATE_ITEMS = 200
+
 @pr.route('/vote/<string:type>/<int:id>/<string:action>', methods=['POST'])
 @login_required
 def vote(type, id, action):
+    # Cached thread page that shows the item's like count
+    page_keys = lambda post_id: ['post:%d' % post_id]
     try:
-        # Determine the item type (post or reply)
-        if type == 'post':
-            item = Post.query.get_or_404(id)
-        elif type == 'reply':
-            item = Reply.query.get_or_404(id)
-        else:
-            return jsonify({'success': False, 'error': 'Invalid type'}), 400
-
-        # Check if the user has already voted on this item
-        existing_vote = Vote.query.filter_by(
-            user_id=current_user.id,
-            post_id=id if type == 'post' else None,
-            reply_id=id if type == 'reply' else None
-        ).first()
-
-        if existing_vote:
-            if existing_vote.vote_type == action:
-                # User is trying to vote the same way again, do nothing
-                return jsonify({'success': False, 'error': 'You have already voted this way'}), 400
-            
-            # User is changing their vote
-            if existing_vote.vote_type == 'like' and action == 'dislike':
-                item.likes -= 1  # Remove the like
-            elif existing_vote.vote_type == 'dislike' and action == 'like':
-                item.likes += 1  # Remove the dislike
-
-            # Remove the existing vote
-            db.session.delete(existing_vote)
-            db.session.commit()
-
-            # Allow user to vote again
-            return jsonify({'success': True, 'likes': item.likes, 'neutral': True})
-
-        else:
-            # Create a new vote record
-            vote = Vote(
-                user_id=current_user.id,
-                post_id=id if type == 'post' else None,
-                reply_id=id if type == 'reply' else None,
-                vote_type=action
-            )
-            if action == 'like':
-                item.likes += 1
-            else:
-                item.likes -= 1
-            db.session.add(vote)
-
-            db.session.commit()
-
-            return jsonify({'success': True, 'likes': item.likes, 'neutral': False})
-
+        # Vote row and like count change together in one atomic transaction,
+        # which also finds the item and the thread it belongs to
+        likes, neutral, post_id = cast_vote(current_user.id, type, id, action, surrogate_keys=page_keys)
+        purge_pages(*page_keys(post_id))
+        return jsonify({'success': True, 'likes': likes, 'neutral': neutral})
+
+    except VoteRejected as e:
+        return jsonify({'success': False, 'error': e.message}), e.status
     except Exception as e:
         db.session.rollback()
         print(f"Error in vote route: {e}")  # Log the error
         return jsonify({'success': False, 'error': 'Internal server error'}), 500
 
+
+# Current user's votes on a page of items, e.g. /vote/state?post=1&reply=4&reply=5
+@pr.route('/vote/state')
+def vote_state():
+    post_ids = request.args.getlist('post', type=int)[:MAX_VOTE_STATE_ITEMS]
+    reply_ids = request.args.getlist('reply', type=int)[:MAX_VOTE_STATE_ITEMS]
+    # Anonymous visitors simply have no votes to highlight
+    user_id = current_user.id if current_user.is_authenticated else None
+    return jsonify({'success': True, 'votes': vote_states(user_id, post_ids, reply_ids)})
+
 #######################
 
 
 ############1.1 new feature see news
 @pr.route('/news')
 def news():
-    api_key = 'eb24ca091e3a4ffa8ee813dd7ca5195b'  # Replace with NewsAPI key
-    articles = fetch_car_news(api_key)
+    # Served from the news cache, refreshed in the background when stale
+    articles = latest_news()
     return render_template('posts/news.html', articles=articles)
 ##########
\ No newline at end of file
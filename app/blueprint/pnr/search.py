@@ -0,0 +1,231 @@
+# search.py
+# Full-text search over post titles, post content and reply content backed by
+# an SQLite FTS5 table. The index is kept in sync from ORM events, so every
+# insert, update and delete of a post or reply updates only its own row.
+import html
+import re
+import weakref
+
+import click
+import sqlalchemy as sa
+from markupsafe import Markup, escape
+from sqlalchemy import event, func
+
+from . import pr
+from .filters import strip_html
+from app.models.models import Post, Reply, db
+
+SEARCH_TABLE = 'post_search'
+
+# bm25 weights for the title, body and reply columns
+BM25_WEIGHTS = (10.0, 5.0, 1.0)
+
+# Column filters for the search_type values offered in the navbar
+SEARCH_COLUMNS = {
+    'Titles': 'title',
+    'Descriptions': 'body',
+}
+
+# Control characters are used as snippet markers so they survive HTML escaping
+_MARK_OPEN = '\x02'
+_MARK_CLOSE = '\x03'
+
+_fts = sa.table(SEARCH_TABLE, sa.column('rowid'), sa.column('post_id'))
+_fts_table = sa.literal_column(SEARCH_TABLE)
+
+# engine -> whether the index table exists, so the check runs once per engine
+_available = weakref.WeakKeyDictionary()
+
+
+# Posts and replies share one index; even rowids are posts, odd rowids replies
+def _post_rowid(post_id):
+    return post_id * 2
+
+
+def _reply_rowid(reply_id):
+    return reply_id * 2 + 1
+
+
+def _plain_text(value):
+    """Convert stored rich text to the plain text that gets indexed."""
+    return html.unescape(strip_html(value or ''))
+
+
+def fts5_supported(connection):
+    """Check whether the SQLite library was compiled with FTS5."""
+    if connection.dialect.name != 'sqlite':
+        return False
+    return bool(connection.exec_driver_sql("SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar())
+
+
+def index_available(connection):
+    """Return True when the FTS5 index table exists on this connection's database."""
+    engine = connection.engine
+    if engine not in _available:
+        _available[engine] = connection.dialect.name == 'sqlite' and connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SEARCH_TABLE,)
+        ).first() is not None
+    return _available[engine]
+
+
+def create_index(connection):
+    """Create the FTS5 table if it does not exist yet."""
+    connection.exec_driver_sql(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+        "title, body, reply, post_id UNINDEXED, "
+        "tokenize = 'porter unicode61 remove_diacritics 2')"
+    )
+    _available[connection.engine] = True
+
+
+def drop_index(connection):
+    """Drop the FTS5 table."""
+    connection.exec_driver_sql(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+    _available[connection.engine] = False
+
+
+def rebuild_index(connection, batch_size=1000):
+    """Re-index every post and reply from scratch."""
+    create_index(connection)
+    connection.exec_driver_sql(f"DELETE FROM {SEARCH_TABLE}")
+
+    insert = sa.text(
+        f"INSERT INTO {SEARCH_TABLE} (rowid, title, body, reply, post_id) "
+        "VALUES (:rowid, :title, :body, :reply, :post_id)"
+    )
+    posts = connection.execute(sa.select(Post.id, Post.title, Post.content))
+    while batch := posts.fetchmany(batch_size):
+        connection.execute(insert, [
+            {'rowid': _post_rowid(id), 'title': _plain_text(title), 'body': _plain_text(content), 'reply': None, 'post_id': id}
+            for id, title, content in batch
+        ])
+    replies = connection.execute(sa.select(Reply.id, Reply.post_id, Reply.content))
+    while batch := replies.fetchmany(batch_size):
+        connection.execute(insert, [
+            {'rowid': _reply_rowid(id), 'title': None, 'body': None, 'reply': _plain_text(content), 'post_id': post_id}
+            for id, post_id, content in batch
+        ])
+
+
+def _index_row(connection, rowid, post_id, title=None, body=None, reply=None):
+    connection.execute(sa.text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :rowid"), {'rowid': rowid})
+    connection.execute(
+        sa.text(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, title, body, reply, post_id) "
+            "VALUES (:rowid, :title, :body, :reply, :post_id)"
+        ),
+        {'rowid': rowid, 'title': title, 'body': body, 'reply': reply, 'post_id': post_id},
+    )
+
+
+def _unindex_row(connection, rowid):
+    connection.execute(sa.text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :rowid"), {'rowid': rowid})
+
+
+# Keep the index in step with the ORM
+@event.listens_for(Post, 'after_insert')
+@event.listens_for(Post, 'after_update')
+def _index_post(mapper, connection, target):
+    if not index_available(connection):
+        return
+    state = sa.inspect(target)
+    if state.attrs.title.history.has_changes() or state.attrs.content.history.has_changes():
+        _index_row(connection, _post_rowid(target.id), target.id,
+                   title=_plain_text(target.title), body=_plain_text(target.content))
+
+
+@event.listens_for(Post, 'after_delete')
+def _unindex_post(mapper, connection, target):
+    if index_available(connection):
+        _unindex_row(connection, _post_rowid(target.id))
+
+
+@event.listens_for(Reply, 'after_insert')
+@event.listens_for(Reply, 'after_update')
+def _index_reply(mapper, connection, target):
+    if not index_available(connection):
+        return
+    if sa.inspect(target).attrs.content.history.has_changes():
+        _index_row(connection, _reply_rowid(target.id), target.post_id, reply=_plain_text(target.content))
+
+
+@event.listens_for(Reply, 'after_delete')
+def _unindex_reply(mapper, connection, target):
+    if index_available(connection):
+        _unindex_row(connection, _reply_rowid(target.id))
+
+
+# Create and drop the index together with the rest of the schema
+@event.listens_for(db.metadata, 'after_create')
+def _create_index_with_schema(target, connection, **kw):
+    if fts5_supported(connection):
+        create_index(connection)
+
+
+@event.listens_for(db.metadata, 'before_drop')
+def _drop_index_with_schema(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        drop_index(connection)
+
+
+def build_match(query, search_type=None):
+    """Turn user input into an FTS5 MATCH expression, or None if it has no words.
+
+    Every word is quoted so punctuation in the input cannot be read as FTS5
+    syntax, and gets a prefix wildcard so partially typed words still match.
+    """
+    words = re.findall(r'\w+', query or '')
+    if not words:
+        return None
+    terms = ' '.join('"{}"*'.format(word) for word in words)
+    column = SEARCH_COLUMNS.get(search_type)
+    if column:
+        return '{%s}: (%s)' % (column, terms)
+    return terms
+
+
+def search_posts(match, sort='relevance'):
+    """Return a query of (Post, snippet) rows matching an FTS5 expression.
+
+    Each post is ranked by its best matching row (the post itself or one of
+    its replies) and the snippet is taken from that same row.
+    """
+    matches = (
+        sa.select(
+            _fts.c.post_id.label('post_id'),
+            func.bm25(_fts_table, *BM25_WEIGHTS).label('score'),
+            func.snippet(_fts_table, -1, _MARK_OPEN, _MARK_CLOSE, '…', 12).label('snippet'),
+        )
+        .select_from(_fts)
+        .where(_fts_table.op('MATCH')(match))
+        # LIMIT stops SQLite from flattening bm25() into the aggregate below
+        .limit(-1)
+        .subquery()
+    )
+    hits = (
+        sa.select(matches.c.post_id, func.min(matches.c.score).label('score'), matches.c.snippet)
+        .group_by(matches.c.post_id)
+        .subquery()
+    )
+    query = Post.query.join(hits, hits.c.post_id == Post.id).add_columns(hits.c.snippet)
+    if sort == 'recent':
+        return query.order_by(Post.last_reply_date.desc(), Post.id.desc())
+    return query.order_by(hits.c.score.asc(), Post.id.desc())
+
+
+def highlight(snippet):
+    """Escape a snippet and wrap the matched terms in <mark> tags."""
+    if not snippet:
+        return None
+    escaped = str(escape(snippet))
+    return Markup(escaped.replace(_MARK_OPEN, '<mark>').replace(_MARK_CLOSE, '</mark>'))
+
+
+@pr.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Rebuild the full-text search index from the post and reply tables."""
+    with db.engine.begin() as connection:
+        if not fts5_supported(connection):
+            raise click.ClickException('SQLite was built without FTS5; search will use LIKE matching.')
+        rebuild_index(connection)
+    click.echo('Search index rebuilt.')
@@ -0,0 +1,97 @@
+# threads.py
+# Threaded reply display. A thread page is paginated by its top-level replies;
+# everything beneath the replies of a page is then fetched, authors included,
+# by one recursive CTE and assembled into a tree in memory, so rendering a
+# nested thread never touches the lazy Reply.children relationship. Pages
+# whose replies have no answers, most of them, skip the CTE altogether.
+from functools import lru_cache
+
+import sqlalchemy as sa
+from flask import current_app
+from sqlalchemy.orm import aliased, contains_eager, joinedload
+
+from app.models.models import Reply, db
+
+
+class ReplyNode:
+    """A reply with its loaded children, depth below the page's roots, and
+    whether it has further replies cut off by the depth limit."""
+
+    def __init__(self, reply, depth=0, has_more=False):
+        self.reply = reply
+        self.depth = depth
+        self.has_more = has_more
+        self.children = []
+
+    def walk(self):
+        """Yield this node and every node beneath it, depth first."""
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+
+def max_reply_depth():
+    """Return how many levels of replies are shown beneath a top-level reply."""
+    return current_app.config.get('REPLY_TREE_MAX_DEPTH', 4)
+
+
+# Correlated to the Reply rows of the query it is added to
+_child = aliased(Reply)
+_has_children = sa.exists().where(_child.parent_id == Reply.id).label('has_children')
+
+
+@lru_cache()
+def _tree_statement(max_depth):
+    # Built once per depth limit; the roots are bound as the expanding root_ids
+    descendant = aliased(Reply)
+    tree = (sa.select(Reply.id, Reply.parent_id, sa.literal(1).label('depth'))
+            .where(Reply.parent_id.in_(sa.bindparam('root_ids', expanding=True)))
+            .cte('reply_tree', recursive=True))
+    # The walk goes one level past the limit, only to tell which replies on
+    # the last level have more beneath them; those rows load no Reply
+    tree = tree.union_all(
+        sa.select(descendant.id, descendant.parent_id, tree.c.depth + 1)
+        .where(descendant.parent_id == tree.c.id, tree.c.depth <= max_depth))
+    return (sa.select(Reply, tree.c.parent_id, tree.c.depth)
+            .select_from(tree)
+            .outerjoin(Reply, sa.and_(Reply.id == tree.c.id, tree.c.depth <= max_depth))
+            .outerjoin(Reply.user)
+            .options(contains_eager(Reply.user)))
+
+
+def load_reply_tree(roots, max_depth=None, parents=None):
+    """Return a ReplyNode for each reply in roots, with its replies loaded up to max_depth levels down.
+
+    parents, when given, holds the ids of the roots known to have replies,
+    as flagged by top_level_replies; the others are not looked up, and
+    without any the tree query is not run.
+    """
+    if max_depth is None:
+        max_depth = max_reply_depth()
+    nodes = {reply.id: ReplyNode(reply) for reply in roots}
+    root_ids = [reply_id for reply_id in nodes if parents is None or reply_id in parents]
+    if not root_ids or max_depth < 1:
+        return list(nodes.values())
+
+    rows = db.session.execute(_tree_statement(max_depth), {'root_ids': root_ids}).all()
+    cut_off = {parent_id for reply, parent_id, depth in rows if reply is None}
+    # Sorted here rather than in SQL, which would sort the CTE in a temporary b-tree
+    rows = sorted((row for row in rows if row[0] is not None), key=lambda row: (row[0].created_at, row[0].id))
+    for reply, parent_id, depth in rows:
+        nodes[reply.id] = ReplyNode(reply, depth, reply.id in cut_off)
+    for reply, parent_id, depth in rows:
+        parent = nodes.get(parent_id)
+        if parent is not None:
+            parent.children.append(nodes[reply.id])
+    return [nodes[reply.id] for reply in roots]
+
+
+def top_level_replies(post_id):
+    """Query for the replies of a post that answer the post itself rather than another reply.
+
+    Rows are (reply, has_children) pairs; has_children tells load_reply_tree
+    which of a page's replies have anything beneath them.
+    """
+    return (Reply.query.options(joinedload(Reply.user))
+            .add_columns(_has_children)
+            .filter(Reply.post_id == post_id, Reply.parent_id.is_(None)))
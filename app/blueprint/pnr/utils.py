@@ -1,9 +1,7 @@
 import requests
 
-def fetch_car_news(api_key):
-    url = f'https://newsapi.org/v2/everything?q=car&apiKey={api_key}'
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json().get('articles', [])
-    else:
-        return []
+def fetch_car_news(api_key, session=None, url='https://newsapi.org/v2/everything', query='car', timeout=5):
+    """Fetch car news articles, raising requests.RequestException if the upstream fails."""
+    response = (session or requests).get(url, params={'q': query, 'apiKey': api_key}, timeout=timeout)
+    response.raise_for_status()
+    return response.json().get('articles', [])
@@ -0,0 +1,104 @@
+# votes.py
+# Atomic like/dislike writes. A vote is recorded with a single INSERT guarded
+# by the unique (user, item) indexes on Vote, and the item's like count is
+# adjusted in the database with likes = likes + delta, so concurrent voters
+# can neither lose updates nor record the same vote twice.
+import sqlalchemy as sa
+from sqlalchemy.dialects.sqlite import insert
+
+from app.cache import bump_versions
+from app.models.models import Post, Reply, Vote, db
+
+VOTE_MODELS = {'post': Post, 'reply': Reply}
+VOTE_ACTIONS = ('like', 'dislike')
+
+
+class VoteRejected(Exception):
+    """A vote that cannot be applied, carrying the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def cast_vote(user_id, item_type, item_id, action, surrogate_keys=None):
+    """Apply a like or dislike and return (likes, neutral, post_id), committing on success.
+
+    Voting against an existing vote removes it and leaves the user neutral,
+    matching the toggle behaviour of the vote buttons. Voting the same way
+    twice raises VoteRejected. post_id is the thread the item belongs to;
+    surrogate_keys is called with it and returns the keys of the pages
+    showing the item, whose versions are bumped in the same transaction.
+
+    The item is looked up by the UPDATE of its like count rather than read
+    beforehand, so the transaction starts with a write: SQLite cannot always
+    upgrade a WAL read transaction to a write once another writer committed.
+    """
+    model = VOTE_MODELS.get(item_type)
+    if model is None:
+        raise VoteRejected('Invalid type')
+    if action not in VOTE_ACTIONS:
+        raise VoteRejected('Invalid action')
+
+    column = Vote.post_id if item_type == 'post' else Vote.reply_id
+    # Adding a like and withdrawing a dislike both raise the count by one
+    delta = 1 if action == 'like' else -1
+    try:
+        # Withdrawing the opposite vote returns the user to neutral
+        neutral = bool(db.session.execute(
+            sa.delete(Vote).where(Vote.user_id == user_id, column == item_id, Vote.vote_type != action)
+        ).rowcount)
+        if not neutral:
+            inserted = db.session.execute(
+                insert(Vote)
+                .values(user_id=user_id, vote_type=action, **{column.key: item_id})
+                .on_conflict_do_nothing()
+            ).rowcount
+            if not inserted:
+                raise VoteRejected('You have already voted this way')
+
+        updated = db.session.execute(
+            sa.update(model)
+            .where(model.id == item_id)
+            .values(likes=sa.func.coalesce(model.likes, 0) + delta)
+            .returning(model.likes, model.id if model is Post else model.post_id),
+            execution_options={'synchronize_session': False},
+        ).first()
+        if updated is None:
+            raise VoteRejected('Not found', 404)
+        likes, post_id = updated
+        if surrogate_keys is not None:
+            bump_versions(*surrogate_keys(post_id))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return likes, neutral, post_id
+
+
+def vote_states(user_id, post_ids=(), reply_ids=()):
+    """Return the user's votes on the given items as {'post': {id: vote_type}, 'reply': {...}}.
+
+    All items are looked up in one query served by the unique (user, item)
+    vote indexes, however many posts and replies a page shows.
+    """
+    states = {'post': {}, 'reply': {}}
+    conditions = []
+    if post_ids:
+        conditions.append(Vote.post_id.in_(post_ids))
+    if reply_ids:
+        conditions.append(Vote.reply_id.in_(reply_ids))
+    if user_id is None or not conditions:
+        return states
+
+    rows = db.session.execute(
+        sa.select(Vote.post_id, Vote.reply_id, Vote.vote_type)
+        .where(Vote.user_id == user_id, sa.or_(*conditions))
+    )
+    for post_id, reply_id, vote_type in rows:
+        if post_id is not None:
+            states['post'][post_id] = vote_type
+        else:
+            states['reply'][reply_id] = vote_type
+    return states
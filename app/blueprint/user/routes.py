@@ -2,8 +2,10 @@ from flask import render_template, request, redirect, url_for, flash, current_ap
 from flask_login import current_user, login_required, login_user
 from . import user
 from app.models.models import Post, Reply, User, db
-import os
-from werkzeug.utils import secure_filename
+from sqlalchemy.orm import joinedload
+from app.pagination import paginate
+from app.identity import forget_users
+from app.avatars import AvatarRejected
 from .forms import UpdatePictureForm, ChangePasswordForm
 from werkzeug.security import generate_password_hash,check_password_hash
 
@@ -13,13 +15,13 @@ from werkzeug.security import generate_password_hash,check_password_hash
 def user_profile(user_id, tab='posts'):
 
     user = User.query.get_or_404(user_id)
-    post_page = request.args.get('post_page', 1, type=int)
-    reply_page = request.args.get('reply_page', 1, type=int)
     per_page = 5  # Number of items per page
     
     # Query posts and replies associated with the user
-    posts = Post.query.filter_by(user_id=user_id).order_by(Post.created_at.desc()).paginate(page=post_page, per_page=per_page)
-    replies = Reply.query.filter_by(user_id=user_id).order_by(Reply.created_at.desc()).paginate(page=reply_page, per_page=per_page)
+    posts_query = Post.query.options(joinedload(Post.user), joinedload(Post.last_replier)).filter_by(user_id=user_id)
+    replies_query = Reply.query.options(joinedload(Reply.post)).filter_by(user_id=user_id)
+    posts = paginate(posts_query, (Post.created_at, Post.id), per_page=per_page, prefix='post_')
+    replies = paginate(replies_query, (Reply.created_at, Reply.id), per_page=per_page, prefix='reply_')
 
     return render_template('user/user_profile.html', user=user, posts=posts, replies=replies, active_tab=tab)
 
@@ -34,11 +36,13 @@ def user_settings():
     # Handle profile picture update form submission
     if picture_form.validate_on_submit() and 'submit_picture' in request.form:
         if picture_form.picture.data:
-            filename = secure_filename(picture_form.picture.data.filename)
-            filepath = os.path.join(current_app.root_path, 'static/uploads', filename)
-            picture_form.picture.data.save(filepath)
-            current_user.profile_image_url = url_for('static', filename='uploads/' + filename)
-            db.session.commit()
+            # Stored by content hash; thumbnails are cut in the background
+            try:
+                current_app.extensions['avatars'].update_avatar(current_user, picture_form.picture.data)
+            except AvatarRejected as exc:
+                flash(exc.message, 'danger')
+                return redirect(url_for('user.user_settings'))
+            forget_users([current_user.id])
             flash('Profile picture updated successfully.','success')
         return redirect(url_for('user.user_settings'))
 
@@ -52,6 +56,7 @@ def user_settings():
             # Generate password hash and update user's password in database
             current_user.password_hash = generate_password_hash(password_form.password.data)
             db.session.commit()
+            forget_users([current_user.id])
             flash('Password updated successfully.','success')
             return redirect(url_for('user.user_settings'))
 
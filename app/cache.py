@@ -0,0 +1,329 @@
+# cache.py
+# Full-page cache for anonymous GET requests. Each entry is tagged with
+# surrogate keys such as 'post:12' or 'list:news', so a write only purges the
+# pages it can have changed instead of flushing the whole cache.
+#
+# Every surrogate key also has a version in the page_version table, bumped by
+# the writes that change its pages. A page's ETag is built from the versions
+# of its keys and the viewer, so a conditional GET is answered with 304 after
+# one primary-key lookup, before the view queries or renders anything. Only
+# requests carrying If-None-Match pay for that lookup: a first visit gets the
+# hash of the rendered page as its ETag, and its first revalidation, if still
+# current, swaps it for the version-based one.
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+from urllib.parse import urlencode
+
+import sqlalchemy as sa
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from app.models.models import PageVersion, db
+
+CachedPage = namedtuple('CachedPage', 'body status headers expires surrogate_keys')
+
+# Headers that belong to one response and must never be replayed to others
+_UNCACHEABLE_HEADERS = {'set-cookie', 'content-length'}
+
+
+class PageCache:
+    """In-memory LRU of rendered pages with a TTL and surrogate-key purging."""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._surrogates = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._build = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PAGE_CACHE_ENABLED', True)
+        app.config.setdefault('PAGE_CACHE_TTL', 30)
+        app.config.setdefault('PAGE_CACHE_MAX_ENTRIES', 500)
+        app.config.setdefault('PAGE_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+        app.config.setdefault('PAGE_ETAGS_ENABLED', True)
+        app.extensions['page_cache'] = self
+        self.app = app
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, body, status, headers, surrogate_keys, ttl=None):
+        ttl = self.app.config['PAGE_CACHE_TTL'] if ttl is None else ttl
+        entry = CachedPage(body, status, headers, time.monotonic() + ttl, tuple(surrogate_keys))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += len(body)
+            for surrogate_key in entry.surrogate_keys:
+                self._surrogates.setdefault(surrogate_key, set()).add(key)
+            # Evict least recently used pages until both limits hold
+            while self._entries and (len(self._entries) > self.app.config['PAGE_CACHE_MAX_ENTRIES']
+                                     or self._bytes > self.app.config['PAGE_CACHE_MAX_BYTES']):
+                self._remove(next(iter(self._entries)))
+
+    def purge(self, *surrogate_keys):
+        """Drop every page tagged with any of the given surrogate keys."""
+        with self._lock:
+            keys = set()
+            for surrogate_key in surrogate_keys:
+                keys.update(self._surrogates.get(surrogate_key, ()))
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._surrogates.clear()
+            self._bytes = 0
+
+    def build_token(self):
+        """Return a hash of the deployed code, templates and static files, part of every ETag."""
+        if self._build is None:
+            # Modification times are enough: a deploy rewrites the files it changes
+            digest = hashlib.sha1()
+            static = os.path.abspath(self.app.static_folder)
+            for root, dirs, files in os.walk(self.app.root_path):
+                dirs[:] = sorted(name for name in dirs if os.path.join(root, name) != static
+                                 and name != '__pycache__')
+                for name in sorted(files):
+                    if name.endswith(('.py', '.html')):
+                        path = os.path.join(root, name)
+                        digest.update(('%s:%s\n' % (path, os.path.getmtime(path))).encode())
+            # Pages link static files by content hash
+            assets = self.app.extensions.get('static_assets')
+            if assets is not None:
+                digest.update(repr(sorted(assets.originals)).encode())
+            self._build = digest.hexdigest()
+        return self._build
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self._bytes}
+
+    def _remove(self, key):
+        # Caller holds the lock
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= len(entry.body)
+        for surrogate_key in entry.surrogate_keys:
+            keys = self._surrogates.get(surrogate_key)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._surrogates[surrogate_key]
+
+
+def _cacheable_request():
+    return (current_app.config['PAGE_CACHE_ENABLED']
+            and request.method == 'GET'
+            and not current_user.is_authenticated
+            and '_flashes' not in session)
+
+
+def _cache_key():
+    # Encoded, so an argument holding '&' or '=' cannot pose as several
+    args = urlencode(sorted(request.args.items(multi=True)))
+    return '{}:{}?{}'.format(request.endpoint, request.path, args)
+
+
+def _conditional_request():
+    # Flashed messages are shown once, so a page holding some is always rendered
+    return (current_app.config['PAGE_ETAGS_ENABLED']
+            and request.method in ('GET', 'HEAD')
+            and '_flashes' not in session)
+
+
+def page_etag(surrogate_keys):
+    """Return the ETag of the current request's page, which shows the given surrogate keys.
+
+    It changes whenever one of the keys is bumped, the code is redeployed or
+    the viewer's navbar changes. Costs one query, on the version table.
+    """
+    surrogate_keys = sorted(set(surrogate_keys))
+    versions = dict(db.session.execute(
+        sa.select(PageVersion.key, PageVersion.version).where(PageVersion.key.in_(surrogate_keys))).all())
+    if current_user.is_authenticated:
+        viewer = (current_user.id, current_user.username, current_user.unread_notifications,
+                  current_user.profile_image_url, current_user.avatar_key)
+    else:
+        viewer = None
+    parts = (current_app.extensions['page_cache'].build_token(), viewer,
+             [(key, versions.get(key, 0)) for key in surrogate_keys])
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:24]
+
+
+def _body_etag(response):
+    return hashlib.sha1(response.get_data()).hexdigest()[:24]
+
+
+def _not_modified(etag):
+    response = current_app.response_class(status=304)
+    _set_validators(response, etag)
+    return response
+
+
+def _set_validators(response, etag):
+    response.set_etag(etag, weak=True)
+    # Always revalidated; pages of logged-in users are for their browser only
+    response.headers['Cache-Control'] = 'private, no-cache' if current_user.is_authenticated else 'no-cache'
+    response.vary.add('Cookie')
+
+
+def _render_conditional(view, args, kwargs, surrogate_keys, on_hit=None):
+    # 304 when the client's copy is current; otherwise the page, with its ETag
+    etag = None
+    if request.if_none_match:
+        etag = page_etag(surrogate_keys(*args, **kwargs))
+        if request.if_none_match.contains_weak(etag):
+            if on_hit is not None:
+                on_hit(*args, **kwargs)
+            return _not_modified(etag)
+    response = make_response(view(*args, **kwargs))
+    if response.status_code != 200 or response.is_streamed or response.direct_passthrough:
+        return response
+    if etag is None:
+        # Nothing to compare with, so the version lookup is skipped
+        etag = _body_etag(response)
+    elif request.if_none_match.contains_weak(_body_etag(response)):
+        # Rendered the client's copy, which holds an ETag from the page's
+        # hash; the version-based one lets its next revalidation skip the view
+        return _not_modified(etag)
+    _set_validators(response, etag)
+    return response
+
+
+def conditional_page(surrogate_keys):
+    """Answer conditional GETs of a view with 304 while its surrogate keys are unchanged.
+
+    For views not in the page cache, such as the JSON polled by logged-in users.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not _conditional_request():
+                return view(*args, **kwargs)
+            return _render_conditional(view, args, kwargs, surrogate_keys)
+        return wrapper
+    return decorator
+
+
+def cache_page(surrogate_keys, on_hit=None):
+    """Cache a view's response for anonymous visitors, and answer conditional GETs.
+
+    surrogate_keys is called with the view arguments and returns the keys the
+    page is tagged with. on_hit, if given, is called with the same arguments
+    whenever the page is served from the cache or found unchanged.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            conditional = _conditional_request()
+            if not _cacheable_request():
+                if not conditional:
+                    return view(*args, **kwargs)
+                return _render_conditional(view, args, kwargs, surrogate_keys, on_hit)
+
+            cache = current_app.extensions['page_cache']
+            key = _cache_key()
+            entry = cache.get(key)
+            if entry is not None:
+                if on_hit is not None:
+                    on_hit(*args, **kwargs)
+                response = current_app.response_class(entry.body, status=entry.status, headers=entry.headers)
+                # The entry keeps the ETag it was rendered with, so no query is needed
+                etag, _ = response.get_etag()
+                if conditional and etag is not None and request.if_none_match.contains_weak(etag):
+                    response = _not_modified(etag)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+            if conditional:
+                response = _render_conditional(view, args, kwargs, surrogate_keys, on_hit)
+            else:
+                response = make_response(view(*args, **kwargs))
+            if response.status_code == 304:
+                return response
+            # Pages that touched the session (CSRF tokens, flashes) are per visitor
+            if (response.status_code == 200 and not response.direct_passthrough
+                    and not session.modified and 'Set-Cookie' not in response.headers):
+                headers = [(name, value) for name, value in response.headers
+                           if name.lower() not in _UNCACHEABLE_HEADERS]
+                cache.set(key, response.get_data(), response.status_code, headers,
+                          surrogate_keys(*args, **kwargs))
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+
+def bump_versions(*surrogate_keys, connection=None):
+    """Increment the versions of the given surrogate keys, without committing.
+
+    Called by every write that purges pages, so the new versions, and so the
+    pages' ETags, change in the same transaction as the data. With connection
+    the statement runs there right away; otherwise the keys are queued on the
+    session and bumped by one statement as it commits, however many writes of
+    the transaction queued them.
+    """
+    if not surrogate_keys:
+        return
+    if connection is not None:
+        connection.execute(_bump_statement(surrogate_keys))
+    else:
+        db.session.info.setdefault('bumped_versions', set()).update(surrogate_keys)
+
+
+def _bump_statement(surrogate_keys):
+    return (insert(PageVersion)
+            .values([{'key': key, 'version': 1} for key in sorted(set(surrogate_keys))])
+            .on_conflict_do_update(index_elements=[PageVersion.key],
+                                   set_={'version': PageVersion.version + 1}))
+
+
+@event.listens_for(Session, 'before_commit')
+def _bump_queued_versions(session):
+    surrogate_keys = session.info.pop('bumped_versions', None)
+    if surrogate_keys:
+        session.execute(_bump_statement(surrogate_keys))
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_queued_versions(session, transaction):
+    # Runs after the commit has taken the queue, so whatever is left was rolled back
+    if transaction.parent is None:
+        session.info.pop('bumped_versions', None)
+
+
+def purge_pages(*surrogate_keys):
+    """Purge cached pages tagged with any of the given surrogate keys."""
+    return current_app.extensions['page_cache'].purge(*surrogate_keys)
+
+
+def thread_list_keys(category):
+    """Surrogate keys of the thread list pages a post in this category shows up on."""
+    return ('list:all', 'list:%s' % category)
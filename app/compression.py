@@ -0,0 +1,46 @@
+# compression.py
+# Gzip for dynamic responses. HTML pages and JSON above COMPRESS_MIN_SIZE are
+# compressed after the view has run, so the page cache keeps plain bodies and
+# any client gets the encoding it accepts. Static files bring their own
+# precompressed variants (see assets.py) and streamed responses are left alone.
+import gzip
+
+from flask import request
+
+
+class Compression:
+    """Gzip HTML and JSON responses for clients that accept it."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_ENABLED', True)
+        app.config.setdefault('COMPRESS_MIMETYPES', ('text/html', 'application/json'))
+        # Smaller bodies fit in a packet or two and are not worth the CPU
+        app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+        app.config.setdefault('COMPRESS_LEVEL', 6)
+        app.extensions['compression'] = self
+        self.app = app
+        app.after_request(self.compress)
+
+    def compress(self, response):
+        config = self.app.config
+        if (not config['COMPRESS_ENABLED']
+                or response.mimetype not in config['COMPRESS_MIMETYPES']
+                or response.status_code != 200
+                or response.direct_passthrough
+                or response.is_streamed
+                or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+        if not request.accept_encodings['gzip'] or len(response.get_data()) < config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(gzip.compress(response.get_data(), compresslevel=config['COMPRESS_LEVEL'], mtime=0))
+        response.headers['Content-Encoding'] = 'gzip'
+        # A strong ETag names exact bytes, so the compressed body needs its own
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag + '-gzip')
+        return response
@@ -0,0 +1,68 @@
+# database.py
+# SQLite connection setup. Every new connection gets the PRAGMAs listed in
+# SQLITE_PRAGMAS, and when a 'read' bind is configured the queries of GET and
+# HEAD requests go to its read-only connections, so page views never wait for
+# a free writer connection. The read bind needs WAL journaling: in the default
+# rollback journal a reader would block the writer of the same request.
+from flask import has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.sql.dml import UpdateBase
+
+READ_BIND = 'read'
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+class RoutingSession(Session):
+    """Session sending the reads of GET requests to the read-only bind.
+
+    Flushes and INSERT/UPDATE/DELETE statements always use the primary
+    engine, and so does everything after them until the transaction ends,
+    so a request keeps seeing its own uncommitted changes.
+    """
+
+    def __init__(self, db, **kwargs):
+        super().__init__(db, **kwargs)
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self._use_read_bind(clause):
+            return self._db.engines[READ_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _use_read_bind(self, clause):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.wrote = True
+            return False
+        return (not self.wrote and has_request_context() and request.method in READ_METHODS
+                and READ_BIND in self._db.engines)
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _reset_routing(session, transaction):
+    if transaction.parent is None:
+        session.wrote = False
+
+
+def _pragma_listener(app, read_only):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in app.config['SQLITE_PRAGMAS'].items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        if read_only:
+            cursor.execute('PRAGMA query_only = ON')
+        cursor.close()
+    return set_pragmas
+
+
+def init_database(app, db):
+    """Apply SQLITE_PRAGMAS to every new SQLite connection of every engine."""
+    app.config.setdefault('SQLITE_PRAGMAS', {})
+    # No model lives in the read bind; without its empty metadata create_all
+    # and drop_all keep working for apps that do not configure the bind
+    db.metadatas.pop(READ_BIND, None)
+    with app.app_context():
+        for key, engine in db.engines.items():
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', _pragma_listener(app, read_only=key == READ_BIND))
@@ -0,0 +1,143 @@
+# events.py
+# In-process publish/subscribe for pushing changes to browsers. Writers queue
+# events on the database session, and they are published once the
+# transaction commits, so a rolled back write never reaches anyone. Each
+# subscriber, typically one Server-Sent Events connection, has a bounded
+# buffer: a client too slow to keep up loses its oldest events and is told to
+# resync instead of making the process hold on to everything.
+#
+# Subscribers only hear events published by the same process; with several
+# worker processes a client sees the writes of the worker it is connected to.
+import json
+import threading
+from collections import deque
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class Subscription:
+    """Events published to one channel, waiting to be read by one client."""
+
+    def __init__(self, bus, channel, size):
+        self.bus = bus
+        self.channel = channel
+        self.size = size
+        self.events = deque()
+        # Set when events were dropped because the buffer was full
+        self.overflowed = False
+        self.closed = False
+        self._ready = threading.Condition()
+
+    def push(self, item):
+        """Add an event, dropping the oldest one if the buffer is full; return whether one was dropped."""
+        with self._ready:
+            dropped = len(self.events) >= self.size
+            if dropped:
+                self.events.popleft()
+                self.overflowed = True
+            self.events.append(item)
+            self._ready.notify()
+        return dropped
+
+    def get(self, timeout):
+        """Return the next (name, data) event, or None if none arrives within timeout seconds."""
+        with self._ready:
+            if not self.events and not self.closed:
+                self._ready.wait(timeout)
+            return self.events.popleft() if self.events else None
+
+    def take_overflow(self):
+        """Return whether events were dropped since the last call."""
+        with self._ready:
+            overflowed, self.overflowed = self.overflowed, False
+        return overflowed
+
+    def close(self):
+        self.bus.unsubscribe(self)
+        with self._ready:
+            self.closed = True
+            self._ready.notify()
+
+
+class EventBus:
+    """Channels of subscribers, such as 'user:12', that published events are copied to."""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._channels = {}
+        self.published = 0
+        self.dropped = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('EVENTS_CLIENT_BUFFER', 64)
+        # Seconds between comments sent on idle streams, so proxies keep them open
+        app.config.setdefault('EVENTS_HEARTBEAT', 15)
+        app.config.setdefault('EVENTS_MAX_SUBSCRIBERS', 10000)
+        app.extensions['event_bus'] = self
+        self.app = app
+
+    def subscribe(self, channel):
+        """Return a Subscription to channel, or None when EVENTS_MAX_SUBSCRIBERS are connected."""
+        subscription = Subscription(self, channel, self.app.config['EVENTS_CLIENT_BUFFER'])
+        with self._lock:
+            if self.subscribers() >= self.app.config['EVENTS_MAX_SUBSCRIBERS']:
+                return None
+            self._channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._channels.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._channels[subscription.channel]
+
+    def subscribers(self):
+        return sum(len(subscribers) for subscribers in self._channels.values())
+
+    def publish(self, channel, name, data):
+        """Send an event to every current subscriber of channel and return how many there were."""
+        with self._lock:
+            subscribers = list(self._channels.get(channel, ()))
+            item = (name, data)
+            self.published += 1
+        dropped = sum(subscription.push(item) for subscription in subscribers)
+        if dropped:
+            with self._lock:
+                self.dropped += dropped
+        return len(subscribers)
+
+    def stats(self):
+        with self._lock:
+            return {'channels': len(self._channels), 'subscribers': self.subscribers(),
+                    'published': self.published, 'dropped': self.dropped}
+
+
+def sse_event(data, event=None):
+    """Format one Server-Sent Event carrying JSON data."""
+    lines = 'event: %s\n' % event if event else ''
+    return '%sdata: %s\n\n' % (lines, json.dumps(data))
+
+
+def publish_on_commit(session, channel, name, data):
+    """Queue an event on session, to be published when its transaction commits."""
+    session.info.setdefault('pending_events', []).append(
+        (current_app.extensions['event_bus'], channel, name, data))
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_pending(session):
+    for bus, channel, name, data in session.info.pop('pending_events', ()):
+        bus.publish(channel, name, data)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_pending(session, transaction):
+    # Runs after after_commit, so whatever is left was rolled back
+    if transaction.parent is None:
+        session.info.pop('pending_events', None)
@@ -0,0 +1,109 @@
+# identity.py
+# Per-process cache for the Flask-Login user_loader. The logged-in user is
+# otherwise fetched with a SELECT at the start of every authenticated
+# request; here a detached copy is kept for IDENTITY_CACHE_TTL seconds and
+# merged into the request's session without touching the database.
+import threading
+import time
+
+import sqlalchemy as sa
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app import db
+from app.models.models import User
+
+
+class IdentityCache:
+    """TTL cache of User rows keyed by id, with explicit invalidation."""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IDENTITY_CACHE_ENABLED', True)
+        app.config.setdefault('IDENTITY_CACHE_TTL', 60)
+        app.config.setdefault('IDENTITY_CACHE_MAX_ENTRIES', 10000)
+        app.extensions['identity_cache'] = self
+        self.app = app
+
+    def load(self, user_id):
+        """Return the user attached to the current session, from the cache when possible."""
+        if not self.app.config['IDENTITY_CACHE_ENABLED']:
+            return db.session.get(User, user_id)
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                cached = entry[0]
+            else:
+                self.misses += 1
+                cached = None
+        if cached is not None:
+            # load=False copies the cached state in without emitting a SELECT
+            return db.session.merge(cached, load=False)
+
+        user = db.session.get(User, user_id)
+        if user is not None:
+            self._store(user)
+        return user
+
+    def invalidate(self, user_ids=None):
+        """Forget the given users, or everyone when user_ids is None."""
+        with self._lock:
+            if user_ids is None:
+                self._entries.clear()
+            else:
+                for user_id in user_ids:
+                    self._entries.pop(user_id, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+    def _store(self, user):
+        # A detached copy holding only committed column values can be shared
+        # between threads and merged into any session
+        copy = User()
+        for column in sa.inspect(User).column_attrs:
+            set_committed_value(copy, column.key, getattr(user, column.key))
+        make_transient_to_detached(copy)
+        with self._lock:
+            if len(self._entries) >= self.app.config['IDENTITY_CACHE_MAX_ENTRIES']:
+                self._entries.clear()
+            self._entries[user.id] = (copy, time.monotonic() + self.app.config['IDENTITY_CACHE_TTL'])
+
+
+def forget_users(user_ids=None):
+    """Drop cached users after their row changed, or all of them when user_ids is None."""
+    current_app.extensions['identity_cache'].invalidate(user_ids)
+
+
+def forget_users_on_commit(session, user_ids=None):
+    """Forget the given users, or everyone, once session's transaction commits.
+
+    Forgetting earlier would let a concurrent request cache the old row
+    again before the change is visible.
+    """
+    pending = session.info.setdefault('forget_users', [])
+    pending.append((current_app.extensions['identity_cache'], user_ids))
+
+
+@event.listens_for(Session, 'after_commit')
+def _forget_pending(session):
+    for cache, user_ids in session.info.pop('forget_users', ()):
+        cache.invalidate(user_ids)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_pending(session, transaction):
+    # Runs after after_commit; a rolled back change leaves cached rows valid
+    if transaction.parent is None:
+        session.info.pop('forget_users', None)
@@ -0,0 +1,134 @@
+# instrumentation.py
+# Per-request SQL statistics gathered from engine events. Every statement
+# run while serving a request is counted, timed and grouped by its shape, so
+# the same SELECT repeated once per row of a page (an N+1) stands out. In
+# debug mode the figures are sent back as X-DB-* response headers.
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+_IN_LIST = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SPACE = re.compile(r'\s+')
+
+# Per-thread stack of QueryStats opened by capture_queries
+_captures = threading.local()
+
+
+def fingerprint(statement):
+    """Reduce a statement to its shape: literals and IN lists of any length become '?'."""
+    statement = _SPACE.sub(' ', statement).strip()
+    statement = _LITERALS.sub('?', statement)
+    return _IN_LIST.sub('(?)', statement)
+
+
+class QueryStats:
+    """Statements executed over some span, with their total database time."""
+
+    def __init__(self, request=None):
+        # The request the statements were run for, if any
+        self.request = request
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+        # engine: Counter of the statements it ran, for telling binds apart
+        self.engines = defaultdict(Counter)
+
+    def add(self, statement, duration, engine=None):
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+        self.engines[engine][statement] += 1
+
+    def fingerprints(self):
+        shapes = Counter()
+        for statement, count in self.statements.items():
+            shapes[fingerprint(statement)] += count
+        return shapes
+
+    def repeated(self, threshold):
+        """Return {fingerprint: count} for every statement shape run more than threshold times."""
+        return {shape: count for shape, count in self.fingerprints().items() if count > threshold}
+
+    def max_repeats(self):
+        return max(self.fingerprints().values(), default=0)
+
+
+class SQLInstrumentation:
+    """Record query count, database time and statement shapes for every request."""
+
+    def __init__(self, app=None, db=None):
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        app.config.setdefault('SQL_INSTRUMENTATION_ENABLED', True)
+        # Shapes run more often than this in one request are logged in debug mode
+        app.config.setdefault('SQL_REPEATED_STATEMENT_THRESHOLD', 5)
+        app.extensions['sql_instrumentation'] = self
+        self.app = app
+        with app.app_context():
+            for engine in db.engines.values():
+                event.listen(engine, 'before_cursor_execute', self._before_execute)
+                event.listen(engine, 'after_cursor_execute', self._after_execute)
+        app.after_request(self._add_headers)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.sql_started = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not self.app.config['SQL_INSTRUMENTATION_ENABLED']:
+            return
+        started = getattr(context, 'sql_started', None)
+        duration = time.perf_counter() - started if started is not None else 0.0
+        if has_request_context() and current_app._get_current_object() is self.app:
+            stats = request_stats()
+            if stats is None:
+                stats = g.sql_stats = QueryStats(request._get_current_object())
+            stats.add(statement, duration, conn.engine)
+        for stats in getattr(_captures, 'stack', ()):
+            stats.add(statement, duration, conn.engine)
+
+    def _add_headers(self, response):
+        stats = request_stats()
+        if stats is None or not self.app.debug:
+            return response
+        repeats = stats.max_repeats()
+        response.headers['X-DB-Queries'] = str(stats.count)
+        response.headers['X-DB-Time-Ms'] = '%.2f' % (stats.duration * 1000)
+        response.headers['X-DB-Max-Repeats'] = str(repeats)
+        threshold = self.app.config['SQL_REPEATED_STATEMENT_THRESHOLD']
+        if repeats > threshold:
+            for shape, count in stats.repeated(threshold).items():
+                logger.warning('Possible N+1: statement ran %d times in one request: %s', count, shape[:300])
+        return response
+
+
+def request_stats():
+    """Return the QueryStats of the current request so far, or None if it ran no SQL."""
+    stats = g.get('sql_stats')
+    # g outlives the request when an app context was already pushed, as in tests
+    if stats is None or stats.request is not request._get_current_object():
+        return None
+    return stats
+
+
+@contextmanager
+def capture_queries():
+    """Collect every statement the current thread executes inside the block."""
+    stats = QueryStats()
+    stack = _captures.__dict__.setdefault('stack', [])
+    stack.append(stats)
+    try:
+        yield stats
+    finally:
+        stack.remove(stats)
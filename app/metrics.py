@@ -0,0 +1,224 @@
+# metrics.py
+# Request metrics served in the Prometheus text format at /metrics. Request
+# counts, latency histograms, database time and template render time are kept
+# per endpoint; cache hit ratios are read from the caches' own counters when
+# the endpoint is scraped. Each thread updates its own shard of the figures
+# without taking a lock, and a scrape adds the shards together.
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import Response, before_render_template, g, request, template_rendered
+
+from app.instrumentation import request_stats
+
+PREFIX = 'speedsters_'
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name: (type, help)
+METRICS = {
+    'http_requests_total': ('counter', 'Requests handled, by endpoint, method and status.'),
+    'http_request_duration_seconds': ('histogram', 'Time spent handling a request, by endpoint.'),
+    'db_queries_total': ('counter', 'SQL statements run while handling requests, by endpoint.'),
+    'db_duration_seconds': ('histogram', 'Database time of a request, by endpoint.'),
+    'template_render_duration_seconds': ('histogram', 'Time spent rendering a template, by template.'),
+}
+
+# Extension key: cache label, for every cache exposing stats() with hits and misses
+CACHES = {'page_cache': 'page', 'identity_cache': 'identity', 'chat_cache': 'chat', 'news_cache': 'news'}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _Shard:
+    """The counters and histograms updated by one thread."""
+
+    def __init__(self, buckets):
+        self.thread = threading.current_thread()
+        self.counters = defaultdict(float)
+        # (name, labels): [count per bucket..., count above the last bucket, sum, count]
+        self.histograms = {}
+        self.size = len(buckets) + 3
+
+    def merge(self, other):
+        for key, value in list(other.counters.items()):
+            self.counters[key] += value
+        for key, values in list(other.histograms.items()):
+            mine = self.histograms.setdefault(key, [0] * self.size)
+            for i, value in enumerate(values):
+                mine[i] += value
+
+
+class Metrics:
+    """Count and time every request, and serve the figures at METRICS_PATH."""
+
+    def __init__(self, app=None):
+        self.buckets = BUCKETS
+        self._local = threading.local()
+        self._shards = []
+        # Taken when a thread records its first figure and by scrapes, never per request
+        self._shards_lock = threading.Lock()
+        self._retired = _Shard(self.buckets)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_PATH', '/metrics')
+        app.extensions['metrics'] = self
+        self.app = app
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._end_render, app)
+        app.add_url_rule(app.config['METRICS_PATH'], 'metrics', self.view)
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard(self.buckets)
+            with self._shards_lock:
+                # A server starting a thread per request would otherwise keep
+                # one shard for every request ever served
+                if len(self._shards) >= 64:
+                    self._retire_dead_shards()
+                self._shards.append(shard)
+        return shard
+
+    def _retire_dead_shards(self):
+        # Caller holds the lock; a finished thread can no longer write to its shard
+        alive = []
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                alive.append(shard)
+            else:
+                self._retired.merge(shard)
+        self._shards = alive
+
+    def inc(self, name, labels, amount=1):
+        """Add amount to the counter name; labels is a tuple of (label, value) pairs."""
+        self._shard().counters[(name, labels)] += amount
+
+    def observe(self, name, labels, value):
+        """Record value in the histogram name."""
+        shard = self._shard()
+        values = shard.histograms.get((name, labels))
+        if values is None:
+            values = shard.histograms[(name, labels)] = [0] * shard.size
+        values[bisect_left(self.buckets, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def snapshot(self):
+        """Return the counters and histograms of all threads added together."""
+        total = _Shard(self.buckets)
+        with self._shards_lock:
+            self._retire_dead_shards()
+            total.merge(self._retired)
+            # Another thread may be updating its shard meanwhile; copying a dict
+            # with list() is atomic, so at worst a figure lags one request behind
+            for shard in self._shards:
+                total.merge(shard)
+        return total.counters, total.histograms
+
+    def _enabled(self):
+        return self.app.config['METRICS_ENABLED']
+
+    def _start_request(self):
+        g.metrics_started = time.perf_counter()
+
+    def _end_request(self, response):
+        started = g.pop('metrics_started', None)
+        if started is None or not self._enabled():
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        self.inc('http_requests_total', (('endpoint', endpoint), ('method', request.method),
+                                         ('status', str(response.status_code))))
+        self.observe('http_request_duration_seconds', (('endpoint', endpoint),), time.perf_counter() - started)
+        stats = request_stats()
+        if stats is not None:
+            self.inc('db_queries_total', (('endpoint', endpoint),), stats.count)
+            self.observe('db_duration_seconds', (('endpoint', endpoint),), stats.duration)
+        return response
+
+    def _start_render(self, sender, template, context, **extra):
+        g.setdefault('metrics_renders', []).append(time.perf_counter())
+
+    def _end_render(self, sender, template, context, **extra):
+        renders = g.get('metrics_renders')
+        if not renders:
+            return
+        started = renders.pop()
+        if self._enabled():
+            self.observe('template_render_duration_seconds', (('template', template.name or 'string'),),
+                         time.perf_counter() - started)
+
+    def cache_stats(self):
+        """Return {cache label: (hits, misses)} for the caches registered on the app."""
+        caches = {}
+        for key, label in CACHES.items():
+            cache = self.app.extensions.get(key)
+            if cache is not None:
+                stats = cache.stats()
+                caches[label] = (stats['hits'], stats['misses'])
+        return caches
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        counters, histograms = self.snapshot()
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            lines.append('# HELP %s%s %s' % (PREFIX, name, help_text))
+            lines.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+            if kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(_sample(name, labels, value))
+                continue
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), values):
+                    cumulative += count
+                    lines.append(_sample(name + '_bucket', labels + (('le', _number(bound)),), cumulative))
+                lines.append(_sample(name + '_sum', labels, values[-2]))
+                lines.append(_sample(name + '_count', labels, values[-1]))
+
+        caches = self.cache_stats()
+        for name, kind, help_text, value in (
+                ('cache_hits_total', 'counter', 'Lookups answered from the cache.', lambda h, m: h),
+                ('cache_misses_total', 'counter', 'Lookups the cache could not answer.', lambda h, m: m),
+                ('cache_hit_ratio', 'gauge', 'Share of lookups answered from the cache.',
+                 lambda h, m: h / (h + m) if h + m else 0)):
+            lines.append('# HELP %s%s %s' % (PREFIX, name, help_text))
+            lines.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+            for label, (hits, misses) in sorted(caches.items()):
+                lines.append(_sample(name, (('cache', label),), value(hits, misses)))
+        return '\n'.join(lines) + '\n'
+
+    def view(self):
+        if not self._enabled():
+            return Response('Metrics are disabled\n', status=404, mimetype='text/plain')
+        return Response(self.render(), content_type=CONTENT_TYPE)
+
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{%s}' % ','.join('%s="%s"' % (label, _escape(text)) for label, text in labels)
+    return '%s%s %s' % (PREFIX, name, _number(value))
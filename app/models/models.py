@@ -13,6 +13,12 @@ class User(UserMixin,db.Model):
 
     # new feature user profile pic
     profile_image_url = db.Column(db.String(200), default="/static/uploads/default_user.jpg")
+    # Content hash of the uploaded picture, set once its thumbnails are cut
+    avatar_key = db.Column(db.String(32), nullable=True)
+
+    # Unread notification count, maintained alongside the notification table
+    # so the navbar bell needs no query
+    unread_notifications = db.Column(db.Integer, default=0, server_default='0', nullable=False)
 
     
 
@@ -24,7 +30,12 @@ class LoginHistory(db.Model):
     logout_time = db.Column(db.DateTime)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     user = db.relationship('User', backref=db.backref('logins', lazy=True))
-    
+
+    # Logout looks up the user's open login entry
+    __table_args__ = (
+        db.Index('ix_login_history_user_id_logout_time', 'user_id', 'logout_time'),
+    )
+
 
     def __repr__(self):
         return '<LoginHistory {}>'.format(self.id)
@@ -40,7 +51,7 @@ class Post(db.Model):
     content = db.Column(db.Text, nullable=False)  # Content of the post, cannot be empty
     created_at = db.Column(db.DateTime,default=datetime.utcnow)  # Record of when the post was created, defaults to current time
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    user = db.relationship('User', backref=db.backref('posts', lazy=True))
+    user = db.relationship('User', foreign_keys=[user_id], backref=db.backref('posts', lazy=True))
 
     # Track views and replies
     views = db.Column(db.Integer, default=0)
@@ -49,21 +60,37 @@ class Post(db.Model):
     # Date of last reply
     last_reply_date = db.Column(db.DateTime,default=datetime.utcnow)
 
+    # Denormalized pointer to the latest reply, kept up to date by submit_reply
+    # so the thread list can be rendered without a query per post
+    last_reply_id = db.Column(db.Integer, db.ForeignKey('reply.id', use_alter=True, name='fk_post_last_reply_id'), nullable=True)
+    last_replier_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    last_replier = db.relationship('User', foreign_keys=[last_replier_id])
+
     ####1.1 new feature likes
     likes = db.Column(db.Integer, default=0)
     #####1.1 new feature likes
 
 
     # Relationship to Reply model, a post can have many replies
-    replies = db.relationship('Reply', backref='post', lazy='dynamic')
+    replies = db.relationship('Reply', backref='post', lazy='dynamic', foreign_keys='Reply.post_id')
 
     # get latest reply time
     def get_last_reply_date(self):
-        latest_reply = Reply.query.filter_by(post_id=self.id).order_by(Reply.created_at.desc()).first()
-        if latest_reply:
-            return latest_reply.created_at
-        else:
-            return self.created_at
+        return self.last_reply_date or self.created_at
+
+    # record a new reply as the latest one in this thread
+    def set_last_reply(self, reply):
+        self.last_reply_id = reply.id
+        self.last_replier_id = reply.user_id
+        self.last_reply_date = reply.created_at
+
+    # Thread lists are sorted by latest activity, optionally within a category,
+    # and profiles list a user's posts newest first
+    __table_args__ = (
+        db.Index('ix_post_last_reply_date', 'last_reply_date'),
+        db.Index('ix_post_category_last_reply_date', 'category', 'last_reply_date'),
+        db.Index('ix_post_user_id_created_at', 'user_id', 'created_at'),
+    )
 
 
 # Defien the reply model
@@ -83,6 +110,14 @@ class Reply(db.Model):
     likes = db.Column(db.Integer, default=0)
     #####1.1 new feature likes
 
+    # Thread pages list a post's replies oldest first, profiles a user's newest
+    # first, and reply trees are walked from parent to children
+    __table_args__ = (
+        db.Index('ix_reply_post_id_created_at', 'post_id', 'created_at'),
+        db.Index('ix_reply_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_reply_parent_id', 'parent_id'),
+    )
+
 
 #######################################1.1 new feature
 #Noification area
@@ -103,6 +138,11 @@ class Notification(db.Model):
     post = db.relationship('Post')
     reply = db.relationship('Reply')
 
+    # Covers the notification list, the unread dropdown and unread counting
+    __table_args__ = (
+        db.Index('ix_notification_user_id_is_read_created_at', 'user_id', 'is_read', 'created_at'),
+    )
+
 ########################################end of notification
 
 
@@ -119,4 +159,51 @@ class Vote(db.Model):
     user = db.relationship('User', backref=db.backref('votes', lazy=True))
     post = db.relationship('Post', backref=db.backref('votes', lazy=True))
     reply = db.relationship('Reply', backref=db.backref('votes', lazy=True))
-######################################1.1
\ No newline at end of file
+
+    # One vote per user and item, enforced by the database so concurrent
+    # requests cannot record the same vote twice
+    __table_args__ = (
+        db.Index('uq_vote_user_post', 'user_id', 'post_id', unique=True,
+                 sqlite_where=db.text('post_id IS NOT NULL')),
+        db.Index('uq_vote_user_reply', 'user_id', 'reply_id', unique=True,
+                 sqlite_where=db.text('reply_id IS NOT NULL')),
+    )
+######################################1.1
+
+# Chatbot history, kept server-side; the session only holds the conversation id
+class ChatConversation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    user = db.relationship('User', backref=db.backref('chat_conversations', lazy=True))
+
+
+class ChatMessage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('chat_conversation.id'), nullable=False)
+    role = db.Column(db.String(20), nullable=False)  # 'user' or 'assistant'
+    content = db.Column(db.Text, nullable=False)
+    tokens = db.Column(db.Integer, nullable=False)  # Estimated prompt tokens, counted once on insert
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    conversation = db.relationship('ChatConversation', backref=db.backref('messages', lazy='dynamic'))
+
+    # Prompts are assembled from the newest messages of one conversation
+    __table_args__ = (
+        db.Index('ix_chat_message_conversation_id_id', 'conversation_id', 'id'),
+    )
+
+
+# Server-side session data, see app/sessions.py
+class StoredSession(db.Model):
+    id = db.Column(db.String(255), primary_key=True)  # Key prefix plus session id
+    data = db.Column(db.LargeBinary, nullable=False)
+    expiry = db.Column(db.DateTime, nullable=False, index=True)
+
+
+# Version counter of each surrogate key of the page cache, bumped in the same
+# transaction as every write that changes the key's pages; see app/cache.py
+class PageVersion(db.Model):
+    key = db.Column(db.String(100), primary_key=True)  # e.g. 'post:12' or 'list:news'
+    version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
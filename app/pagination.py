@@ -0,0 +1,164 @@
+# pagination.py
+# Page-number and keyset (cursor) pagination behind one helper. Keyset pages
+# are addressed by the sort key of their first or last row rather than an
+# OFFSET, so a deep page costs the same as the first one. Neither kind runs a
+# COUNT(*): a page reads one row more than it shows to learn if another follows.
+import base64
+import json
+from datetime import datetime
+
+import sqlalchemy as sa
+from flask import abort, current_app, request, url_for
+
+
+class KeysetPagination:
+    """A page of results addressed by opaque next/prev cursors."""
+
+    keyset = True
+
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+class NumberedPagination:
+    """A page of results addressed by page number, without a total count."""
+
+    keyset = False
+
+    def __init__(self, items, page, per_page, has_next, next_cursor=None):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.has_next = has_next
+        self.next_cursor = next_cursor
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+    def iter_pages(self, edge=None):
+        """Yield the page numbers known to exist, up to the next page.
+
+        With edge, only the first edge pages and the current one are yielded,
+        and None stands for the pages left out between them.
+        """
+        for page in range(1, (self.next_num or self.page) + 1):
+            if edge is None or page <= edge or page == self.page:
+                yield page
+            elif page == edge + 1:
+                yield None
+
+
+def encode_cursor(values):
+    """Encode a sort key as an opaque URL-safe token."""
+    payload = [{'dt': value.isoformat()} if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Decode a token produced by encode_cursor, raising ValueError if it is malformed."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        return [datetime.fromisoformat(value['dt']) if isinstance(value, dict) else value for value in payload]
+    except (TypeError, KeyError, ValueError) as exc:
+        raise ValueError('Invalid cursor') from exc
+
+
+def _row_key(item, columns):
+    # Queries with extra columns return rows whose first entry is the model
+    entity = item[0] if isinstance(item, sa.Row) else item
+    return [getattr(entity, column.key) for column in columns]
+
+
+def keyset_paginate(query, columns, per_page, after=None, before=None, descending=True):
+    """Return the page of query after or before a cursor, ordered by columns."""
+    token = after or before
+    ordered_desc = descending != bool(before)
+    query = query.order_by(None).order_by(*[column.desc() if ordered_desc else column.asc() for column in columns])
+
+    if token:
+        try:
+            values = decode_cursor(token)
+        except ValueError:
+            abort(400)
+        if len(values) != len(columns):
+            abort(400)
+        key = sa.tuple_(*columns)
+        bound = sa.tuple_(*[sa.bindparam(None, value, type_=column.type) for column, value in zip(columns, values)])
+        query = query.filter(key < bound if ordered_desc else key > bound)
+
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        # Going forward there is a previous page whenever we started from a
+        # cursor; going backward there is always a next page
+        if has_more if not before else True:
+            next_cursor = encode_cursor(_row_key(rows[-1], columns))
+        if has_more if before else bool(after):
+            prev_cursor = encode_cursor(_row_key(rows[0], columns))
+    return KeysetPagination(rows, per_page, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+def paginate(query, columns=None, per_page=10, prefix='', descending=True):
+    """Paginate a query using the page/after/before arguments of the current request.
+
+    columns is a unique sort key such as (Post.last_reply_date, Post.id). With
+    an after or before cursor the keyset path is used; otherwise the query is
+    paginated by page number, without counting the rows. Without columns only
+    page numbers are available and the query keeps its own ordering.
+    """
+    after = request.args.get(prefix + 'after')
+    before = request.args.get(prefix + 'before')
+    if columns and (after or before):
+        return keyset_paginate(query, columns, per_page, after=after, before=before, descending=descending)
+
+    if columns:
+        query = query.order_by(None).order_by(*[column.desc() if descending else column.asc() for column in columns])
+    page = request.args.get(prefix + 'page', 1, type=int)
+    if page < 1:
+        abort(404)
+    rows = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+    if not rows and page > 1:
+        abort(404)
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+
+    # Let the last numbered page hand over to cursors for deeper pages
+    next_cursor = None
+    if columns and has_next:
+        next_cursor = encode_cursor(_row_key(rows[-1], columns))
+    return NumberedPagination(rows, page, per_page, has_next, next_cursor=next_cursor)
+
+
+def page_url(endpoint, params, overrides):
+    """Build a pagination link from the page's fixed params plus per-link overrides."""
+    return url_for(endpoint, **{**params, **overrides})
+
+
+def max_numbered_pages():
+    """Return how many page numbers are offered before switching to cursors."""
+    return current_app.config.get('PAGINATION_MAX_NUMBERED_PAGES', 5)
@@ -0,0 +1,106 @@
+# sessions.py
+# Server-side sessions stored in the app's own database, one row per
+# session. Unlike the filesystem backend a request only writes when the
+# session data actually changed, and expired rows are swept in small
+# batches instead of piling up forever.
+import threading
+from datetime import datetime
+
+import sqlalchemy as sa
+from flask_session import Session
+from flask_session.base import ServerSideSessionInterface
+from flask_session.defaults import Defaults
+from sqlalchemy.dialects.sqlite import insert
+
+from app import db
+from app.models.models import StoredSession
+
+
+class DatabaseSessionInterface(ServerSideSessionInterface):
+    """Flask-Session backend keeping sessions in the stored_session table."""
+
+    ttl = False
+
+    def __init__(self, app, sweep_batch_size=500, **kwargs):
+        self.sweep_batch_size = sweep_batch_size
+        # Expiry of the row loaded by the current thread's open_session
+        self._loaded = threading.local()
+        super().__init__(app, **kwargs)
+
+    def open_session(self, app, request):
+        self._loaded.expiry = None
+        session = super().open_session(app, request)
+        # Remember what was loaded so save_session can tell whether anything changed
+        session.stored_data = self.serializer.encode(session) if session else None
+        session.stored_expiry = self._loaded.expiry if session else None
+        return session
+
+    def should_set_storage(self, app, session):
+        if session.modified or self.serializer.encode(session) != session.stored_data:
+            return True
+        # Unchanged data: only push the expiry out once half the lifetime has passed
+        if session.stored_expiry is None or not app.config['SESSION_REFRESH_EACH_REQUEST']:
+            return False
+        return session.stored_expiry - datetime.utcnow() < app.permanent_session_lifetime / 2
+
+    def _retrieve_session_data(self, store_id):
+        # A connection of its own keeps session I/O out of the request's transaction
+        with db.engine.connect() as connection:
+            row = connection.execute(
+                sa.select(StoredSession.data, StoredSession.expiry).where(StoredSession.id == store_id)
+            ).first()
+        if row is None or row.expiry <= datetime.utcnow():
+            return None
+        self._loaded.expiry = row.expiry
+        return self.serializer.decode(row.data)
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        data = self.serializer.encode(session)
+        expiry = datetime.utcnow() + session_lifetime
+        statement = insert(StoredSession).values(id=store_id, data=data, expiry=expiry)
+        statement = statement.on_conflict_do_update(index_elements=[StoredSession.id],
+                                                    set_={'data': data, 'expiry': expiry})
+        with db.engine.begin() as connection:
+            connection.execute(statement)
+        session.stored_data = data
+        session.stored_expiry = expiry
+
+    def _delete_session(self, store_id):
+        with db.engine.begin() as connection:
+            connection.execute(sa.delete(StoredSession).where(StoredSession.id == store_id))
+
+    def _delete_expired_sessions(self):
+        """Delete expired sessions a batch at a time, each batch in its own short transaction."""
+        table = StoredSession.__table__
+        now = datetime.utcnow()
+        expired = (sa.select(table.c.id).where(table.c.expiry <= now)
+                   .limit(self.sweep_batch_size).scalar_subquery())
+        deleted = 0
+        while True:
+            with db.engine.begin() as connection:
+                count = connection.execute(sa.delete(table).where(table.c.id.in_(expired))).rowcount
+            deleted += count
+            if count < self.sweep_batch_size:
+                return deleted
+
+
+def init_sessions(app):
+    """Install the session backend named by SESSION_TYPE.
+
+    'database' selects DatabaseSessionInterface; any other value is handed
+    to Flask-Session as before.
+    """
+    config = app.config
+    if config.get('SESSION_TYPE') != 'database':
+        Session(app)
+        return
+    app.session_interface = DatabaseSessionInterface(
+        app,
+        sweep_batch_size=config.get('SESSION_SWEEP_BATCH_SIZE', 500),
+        key_prefix=config.get('SESSION_KEY_PREFIX', Defaults.SESSION_KEY_PREFIX),
+        use_signer=config.get('SESSION_USE_SIGNER', Defaults.SESSION_USE_SIGNER),
+        permanent=config.get('SESSION_PERMANENT', Defaults.SESSION_PERMANENT),
+        sid_length=config.get('SESSION_ID_LENGTH', Defaults.SESSION_ID_LENGTH),
+        serialization_format=config.get('SESSION_SERIALIZATION_FORMAT', Defaults.SESSION_SERIALIZATION_FORMAT),
+        cleanup_n_requests=config.get('SESSION_CLEANUP_N_REQUESTS', Defaults.SESSION_CLEANUP_N_REQUESTS),
+    )
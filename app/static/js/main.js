@@ -107,9 +107,75 @@ document.addEventListener("DOMContentLoaded", () => {
     // Stop the event from propagating to parent elements
     event.stopPropagation();
   });
+
+  // Live badge: the server pushes unread counts and new notifications
+  const streamUrl = notificationBell.dataset.stream;
+  if (streamUrl && window.EventSource) {
+    const bellIcon = notificationBell.querySelector("img");
+    const showUnread = (count) => {
+      bellIcon.src = count > 0 ? notificationBell.dataset.iconNew : notificationBell.dataset.iconNone;
+      bellIcon.alt = count > 0 ? "New Notifications" : "No New Notifications";
+    };
+    // The browser reconnects by itself if the stream drops
+    const stream = new EventSource(streamUrl);
+    stream.addEventListener("unread", (event) => {
+      showUnread(JSON.parse(event.data).count);
+    });
+    stream.addEventListener("notification", () => {
+      showUnread(1);
+    });
+    // Some events were dropped; ask for the current state instead
+    stream.addEventListener("resync", () => {
+      fetch("/notifications/latest")
+        .then((response) => response.json())
+        .then((data) => showUnread(data.length))
+        .catch((error) => console.error("Error fetching notifications:", error));
+    });
+  }
 });
 
 // 1.1 handle likes
+// Highlight the icon matching the user's vote on one post or reply
+function showVote(type, id, voteType) {
+  document
+    .querySelectorAll(`.icon-like[data-type="${type}"][data-id="${id}"], .icon-dislike[data-type="${type}"][data-id="${id}"]`)
+    .forEach((icon) => {
+      const action = icon.classList.contains("icon-like") ? "like" : "dislike";
+      icon.classList.toggle("voted", action === voteType);
+    });
+}
+
+// Highlight every vote in a {post: {id: voteType}, reply: {...}} state object
+function showVotes(votes) {
+  Object.entries(votes).forEach(([type, items]) => {
+    Object.entries(items).forEach(([id, voteType]) => showVote(type, id, voteType));
+  });
+}
+
+document.addEventListener("DOMContentLoaded", () => {
+  const icons = document.querySelectorAll(".icon-like, .icon-dislike");
+  if (icons.length === 0) {
+    return;
+  }
+  const embedded = document.getElementById("vote-state");
+  if (embedded) {
+    // Rendered into the page, no request needed
+    showVotes(JSON.parse(embedded.textContent));
+    return;
+  }
+  // Otherwise ask for the state of every item on the page in one request
+  const params = new URLSearchParams();
+  icons.forEach((icon) => {
+    if (icon.classList.contains("icon-like")) {
+      params.append(icon.getAttribute("data-type"), icon.getAttribute("data-id"));
+    }
+  });
+  fetch(`/vote/state?${params}`)
+    .then((response) => response.json())
+    .then((data) => showVotes(data.votes))
+    .catch((error) => console.error("Error:", error));
+});
+
 document.addEventListener("DOMContentLoaded", () => {
   // This event listener ensures that the code runs after the DOM has fully loaded
 
@@ -137,8 +203,9 @@ document.addEventListener("DOMContentLoaded", () => {
         .then((data) => {
           if (data.success) {
             // If the vote was successful, update the like count on the page
-            const likeCountElem = document.getElementById(`like-count-${id}`);
+            const likeCountElem = document.getElementById(`like-count-${type}-${id}`);
             likeCountElem.textContent = data.likes;
+            showVote(type, id, data.neutral ? null : action);
             if (data.neutral) {
               // If the vote was reset to neutral, log a message
               console.log("Vote reset to neutral. You can vote again.");
@@ -0,0 +1,125 @@
+"""Benchmark the default SQLite setup against the production database profile.
+
+Reader threads keep loading thread lists and thread pages while writer
+threads keep voting, all through the real routes. Completed requests per
+second and failed requests are printed for both profiles; with the default
+rollback journal readers and writers block each other, with WAL and the
+read-only bind they do not.
+
+    python benchmarks/bench_database.py --readers 8 --writers 4 --seconds 10
+
+Each profile runs against its own throwaway SQLite database, app.db is
+never touched.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+TMP = tempfile.mkdtemp(prefix='bench_database_')
+
+from sqlalchemy import insert  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.models.models import Post, Reply, User  # noqa: E402
+from config import Config, ProductionConfig  # noqa: E402
+
+POSTS = 200
+REPLIES_PER_POST = 20
+
+
+def make_app(name, profile):
+    uri = 'sqlite:///' + os.path.join(TMP, name + '.db')
+
+    class BenchConfig(profile):
+        SQLALCHEMY_DATABASE_URI = uri
+        PAGE_CACHE_ENABLED = False
+        NEWS_CACHE_FILE = None
+        SESSION_CLEANUP_N_REQUESTS = None
+        if 'read' in getattr(profile, 'SQLALCHEMY_BINDS', {}):
+            SQLALCHEMY_BINDS = {'read': dict(profile.SQLALCHEMY_BINDS['read'], url=uri)}
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        password_hash = generate_password_hash('bench')
+        db.session.execute(insert(User), [
+            {'username': 'writer%d' % i, 'email': 'writer%d@example.com' % i, 'password_hash': password_hash}
+            for i in range(32)
+        ])
+        db.session.execute(insert(Post), [
+            {'title': 'Post %d' % i, 'content': 'Content %d' % i, 'category': 'SUV', 'user_id': 1,
+             'views': 0, 'likes': 0, 'replies_count': REPLIES_PER_POST}
+            for i in range(POSTS)
+        ])
+        db.session.execute(insert(Reply), [
+            {'content': 'Reply %d' % j, 'post_id': post_id, 'user_id': 1, 'likes': 0}
+            for post_id in range(1, POSTS + 1) for j in range(REPLIES_PER_POST)
+        ])
+        db.session.commit()
+    return app
+
+
+def reader(app, stop, counts):
+    client = app.test_client()
+    n = 0
+    while not stop.is_set():
+        url = '/view_posts' if n % 2 else '/detail/%d' % (n % POSTS + 1)
+        response = client.get(url)
+        counts['reads' if response.status_code == 200 else 'errors'] += 1
+        n += 1
+
+
+def writer(app, index, stop, counts):
+    client = app.test_client()
+    client.post('/login', data={'username': 'writer%d' % index, 'password': 'bench'})
+    n = 0
+    while not stop.is_set():
+        # Alternating like and dislike adds a vote, then takes it back
+        action = 'dislike' if n % 2 else 'like'
+        response = client.post('/vote/post/%d/%s' % ((n // 2) % POSTS + 1, action))
+        counts['writes' if response.status_code == 200 else 'errors'] += 1
+        n += 1
+
+
+def run(app, readers, writers, seconds):
+    stop = threading.Event()
+    per_thread = [{'reads': 0, 'writes': 0, 'errors': 0} for _ in range(readers + writers)]
+    threads = [threading.Thread(target=reader, args=(app, stop, per_thread[i])) for i in range(readers)]
+    threads += [threading.Thread(target=writer, args=(app, i, stop, per_thread[readers + i])) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    app.extensions['view_counter'].flush()
+    return {key: sum(counts[key] for counts in per_thread) for key in ('reads', 'writes', 'errors')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--readers', type=int, default=8, help='reader threads')
+    parser.add_argument('--writers', type=int, default=4, help='writer threads')
+    parser.add_argument('--seconds', type=float, default=10, help='duration of each run')
+    args = parser.parse_args()
+
+    try:
+        print('%-12s %12s %12s %10s' % ('profile', 'reads/s', 'writes/s', 'errors'))
+        for name, profile in (('default', Config), ('production', ProductionConfig)):
+            app = make_app(name, profile)
+            counts = run(app, args.readers, args.writers, args.seconds)
+            print('%-12s %12.0f %12.0f %10d' % (name, counts['reads'] / args.seconds,
+                                                counts['writes'] / args.seconds, counts['errors']))
+    finally:
+        shutil.rmtree(TMP, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+"""Load-test the forum's main routes against a seeded dataset.
+
+A deterministic dataset (see seed_data.SCALES) is generated once per scale
+and seed and kept in --data-dir; every run works on a fresh copy of it. Each
+scenario is then driven by --concurrency logged-in clients, through the
+Flask test client or, with --server, through a local threaded WSGI server.
+For every scenario the p50/p95/p99 latency, throughput, queries per
+request and server errors are printed.
+
+    python benchmarks/bench_routes.py --scale small --concurrency 8 --requests 400
+    python benchmarks/bench_routes.py --scale tiny --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_routes.py --scale tiny --compare benchmarks/baseline.json
+
+With --compare the run is checked against a stored baseline and the script
+exits with status 1 when a scenario got slower than --tolerance allows or
+issues more queries per request than before. Latencies depend on the
+machine, so record a baseline on the machine that compares against it;
+queries per request are comparable everywhere.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import requests  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+from werkzeug.utils import import_string  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from seed_data import CATEGORIES, PASSWORD, SCALES, WORDS, build_dataset  # noqa: E402
+
+# path(rng, size, worker, n) returns the URL of the n-th request of a worker
+Scenario = namedtuple('Scenario', 'name method path data')
+
+SCENARIOS = (
+    Scenario('view_post', 'GET', lambda rng, size, worker, n: '/view_posts?page=%d' % (n % 5 + 1), None),
+    Scenario('view_post_tag', 'GET', lambda rng, size, worker, n: '/view_posts?tag=%s' % rng.choice(CATEGORIES), None),
+    Scenario('details', 'GET', lambda rng, size, worker, n: '/detail/%d' % rng.randint(1, size.posts), None),
+    Scenario('search', 'GET', lambda rng, size, worker, n: '/search?q=%s' % rng.choice(WORDS), None),
+    Scenario('search_recent', 'GET',
+             lambda rng, size, worker, n: '/search?q=%s+%s&sort=recent' % (rng.choice(WORDS), rng.choice(WORDS)), None),
+    # Like, then dislike to take it back, a different post each pair
+    Scenario('vote', 'POST', lambda rng, size, worker, n: '/vote/post/%d/%s' % (
+        (worker * 7919 + n // 2) % size.posts + 1, 'dislike' if n % 2 else 'like'), None),
+    Scenario('vote_state', 'GET', lambda rng, size, worker, n: '/vote/state?' + '&'.join(
+        'post=%d' % rng.randint(1, size.posts) for _ in range(10)), None),
+    Scenario('notifications', 'GET', lambda rng, size, worker, n: '/notifications/', None),
+    Scenario('latest_notifications', 'GET', lambda rng, size, worker, n: '/notifications/latest', None),
+    Scenario('user_profile', 'GET', lambda rng, size, worker, n: '/user/profile/%d' % rng.randint(1, size.users), None),
+    Scenario('submit_reply', 'POST', lambda rng, size, worker, n: '/submit-reply/%d' % rng.randint(1, size.posts),
+             {'reply_content': 'Benchmark reply'}),
+)
+
+# Allowed growth in queries per request before it counts as a regression,
+# for statements issued in the background such as view count flushes
+QUERY_TOLERANCE = 0.5
+
+# Latency changes smaller than this are thread scheduling noise, whatever
+# their relative size
+LATENCY_NOISE_MS = 10
+
+
+class TestClientDriver:
+    def __init__(self, app, base_url=None):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        return self.client.open(path, method=method, data=data).status_code
+
+
+class HttpDriver:
+    def __init__(self, app, base_url):
+        self.session = requests.Session()
+        self.base_url = base_url
+
+    def request(self, method, path, data=None):
+        return self.session.request(method, self.base_url + path, data=data, allow_redirects=False).status_code
+
+
+class QueryCounter:
+    """Count the statements every engine of an app executes, from any thread."""
+
+    def __init__(self, app):
+        self.count = 0
+        self._lock = threading.Lock()
+        with app.app_context():
+            self.engines = list(db.engines.values())
+        for engine in self.engines:
+            event.listen(engine, 'before_cursor_execute', self._record)
+
+    def _record(self, *args):
+        with self._lock:
+            self.count += 1
+
+    def close(self):
+        for engine in self.engines:
+            event.remove(engine, 'before_cursor_execute', self._record)
+
+
+def make_config(config, uri, page_cache):
+    base = import_string(config) if isinstance(config, str) else config
+
+    class BenchConfig(base):
+        SQLALCHEMY_DATABASE_URI = uri
+        PAGE_CACHE_ENABLED = page_cache
+        NEWS_CACHE_FILE = None
+        WTF_CSRF_ENABLED = False
+        SESSION_CLEANUP_N_REQUESTS = None
+        if 'read' in getattr(base, 'SQLALCHEMY_BINDS', {}):
+            SQLALCHEMY_BINDS = {'read': dict(base.SQLALCHEMY_BINDS['read'], url=uri)}
+
+    return BenchConfig
+
+
+def dataset_file(data_dir, scale, seed):
+    """Return the path of a generated dataset, generating it on first use."""
+    path = os.path.join(data_dir, '%s-%d.db' % (scale, seed))
+    if os.path.exists(path):
+        return path
+    os.makedirs(data_dir, exist_ok=True)
+    partial = path + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    print('Generating the %s dataset in %s' % (scale, path))
+    started = time.perf_counter()
+    app = create_app(make_config('config.Config', 'sqlite:///' + partial, False))
+    with app.app_context():
+        db.create_all()
+        build_dataset(scale, seed, log=lambda message: print('  ' + message))
+        db.engine.dispose()
+    os.replace(partial, path)
+    print('Generated in %.1fs' % (time.perf_counter() - started))
+    return path
+
+
+def percentile(ordered, fraction):
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run_scenario(scenario, drivers, size, requests_per_worker, seed, counter):
+    latencies = [[] for _ in drivers]
+    errors = [0] * len(drivers)
+
+    def work(worker):
+        rng = random.Random('%d-%s-%d' % (seed, scenario.name, worker))
+        driver = drivers[worker]
+        for n in range(requests_per_worker):
+            path = scenario.path(rng, size, worker, n)
+            started = time.perf_counter()
+            status = driver.request(scenario.method, path, scenario.data)
+            latencies[worker].append(time.perf_counter() - started)
+            if status >= 500:
+                errors[worker] += 1
+
+    threads = [threading.Thread(target=work, args=(worker,)) for worker in range(len(drivers))]
+    queries_before = counter.count
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    ordered = sorted(latency for worker in latencies for latency in worker)
+    return {
+        'requests': len(ordered),
+        'errors': sum(errors),
+        'throughput': round(len(ordered) / elapsed, 1),
+        'p50_ms': round(percentile(ordered, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 2),
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 2),
+        'queries_per_request': round((counter.count - queries_before) / len(ordered), 2),
+    }
+
+
+def compare(results, baseline, tolerance, tail_tolerance):
+    """Return a list of regression messages of results against a baseline."""
+    regressions = []
+    for name, base in baseline['results'].items():
+        current = results.get(name)
+        if current is None:
+            continue
+        for key, allowed in (('p50_ms', tolerance), ('p95_ms', tail_tolerance)):
+            if current[key] > base[key] * (1 + allowed) and current[key] - base[key] > LATENCY_NOISE_MS:
+                regressions.append('%s: %s %.1fms, baseline %.1fms' % (name, key[:3], current[key], base[key]))
+        if current['throughput'] < base['throughput'] / (1 + tolerance):
+            regressions.append('%s: %.0f req/s, baseline %.0f req/s' % (name, current['throughput'], base['throughput']))
+        if current['queries_per_request'] > base['queries_per_request'] + QUERY_TOLERANCE:
+            regressions.append('%s: %.2f queries/request, baseline %.2f' % (
+                name, current['queries_per_request'], base['queries_per_request']))
+        if current['errors'] > base['errors']:
+            regressions.append('%s: %d server errors, baseline %d' % (name, current['errors'], base['errors']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', choices=sorted(SCALES), default='tiny')
+    parser.add_argument('--seed', type=int, default=5505)
+    parser.add_argument('--data-dir', default=os.path.join(ROOT, 'benchmarks', '.data'),
+                        help='where generated datasets are kept between runs')
+    parser.add_argument('--config', default='config.Config', help='config class, e.g. config.ProductionConfig')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--scenario', action='append', choices=[s.name for s in SCENARIOS],
+                        help='run only these scenarios (repeatable)')
+    parser.add_argument('--server', action='store_true', help='go through a local WSGI server instead of the test client')
+    parser.add_argument('--page-cache', action='store_true', help='keep the anonymous page cache enabled')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--save-baseline', metavar='FILE', help='store the results as the new baseline')
+    parser.add_argument('--compare', metavar='FILE', help='baseline JSON to check the results against')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed change of p50 latency and throughput')
+    parser.add_argument('--tail-tolerance', type=float, default=1.0, help='allowed change of p95 latency')
+    args = parser.parse_args()
+
+    size = SCALES[args.scale]
+    source = dataset_file(args.data_dir, args.scale, args.seed)
+    workdir = tempfile.mkdtemp(prefix='bench_routes_')
+    server = None
+    try:
+        # Work on a copy so votes and replies never change the stored dataset
+        database = os.path.join(workdir, 'bench.db')
+        shutil.copyfile(source, database)
+        app = create_app(make_config(args.config, 'sqlite:///' + database, args.page_cache))
+
+        base_url = None
+        driver_class = TestClientDriver
+        if args.server:
+            logging.getLogger('werkzeug').setLevel(logging.WARNING)
+            server = make_server('127.0.0.1', 0, app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            base_url = 'http://127.0.0.1:%d' % server.server_port
+            driver_class = HttpDriver
+
+        drivers = []
+        for worker in range(args.concurrency):
+            driver = driver_class(app, base_url)
+            driver.request('POST', '/login', {'username': 'user%d' % (worker % size.users + 1), 'password': PASSWORD})
+            drivers.append(driver)
+
+        counter = QueryCounter(app)
+        scenarios = [s for s in SCENARIOS if not args.scenario or s.name in args.scenario]
+        requests_per_worker = max(args.requests // args.concurrency, 1)
+        results = {}
+        print('%-22s %8s %9s %9s %9s %9s %9s %7s' % (
+            'scenario', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'errors'))
+        for scenario in scenarios:
+            # Warm up caches and connection pools before measuring
+            run_scenario(scenario, drivers, size, 2, args.seed + 1, counter)
+            result = results[scenario.name] = run_scenario(
+                scenario, drivers, size, requests_per_worker, args.seed, counter)
+            print('%-22s %8d %9.1f %9.2f %9.2f %9.2f %9.2f %7d' % (
+                scenario.name, result['requests'], result['throughput'], result['p50_ms'], result['p95_ms'],
+                result['p99_ms'], result['queries_per_request'], result['errors']))
+        counter.close()
+        app.extensions['view_counter'].flush()
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'scale': args.scale,
+        'seed': args.seed,
+        'config': args.config,
+        'driver': 'server' if args.server else 'test_client',
+        'concurrency': args.concurrency,
+        'results': results,
+    }
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if (baseline['scale'], baseline['driver']) != (report['scale'], report['driver']):
+            print('Note: the baseline was recorded with scale %s through the %s' % (baseline['scale'], baseline['driver']))
+        regressions = compare(results, baseline, args.tolerance, args.tail_tolerance)
+        if regressions:
+            print('\nRegressions against %s:' % args.compare)
+            for message in regressions:
+                print('  ' + message)
+            sys.exit(1)
+        print('\nNo regressions against %s' % args.compare)
+
+
+if __name__ == '__main__':
+    main()
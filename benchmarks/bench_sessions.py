@@ -0,0 +1,108 @@
+"""Benchmark the database session backend against Flask-Session's filesystem backend.
+
+Each backend serves the same workload: a number of visitors each start a
+session with one write, then browse with requests that only read it, then
+make a few more writes. Requests per second are printed for both phases,
+followed by how long the database backend takes to sweep expired sessions.
+
+    python benchmarks/bench_sessions.py --visitors 50 --reads 40
+
+A throwaway SQLite database and session directory are used, app.db is
+never touched.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+TMP = tempfile.mkdtemp(prefix='bench_sessions_')
+# Must be set before config is imported
+os.environ['DATABASE_URI'] = 'sqlite:///' + os.path.join(TMP, 'bench.db')
+
+from flask import session  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.models.models import StoredSession  # noqa: E402
+from app.sessions import init_sessions  # noqa: E402
+
+
+def make_app(backend):
+    app = create_app()
+    app.config.update(SESSION_TYPE=backend, SESSION_FILE_DIR=os.path.join(TMP, 'flask_session'),
+                      SESSION_CLEANUP_N_REQUESTS=None)
+    init_sessions(app)
+
+    @app.route('/bench/read')
+    def bench_read():
+        return str(session.get('count', 0))
+
+    @app.route('/bench/write')
+    def bench_write():
+        session['count'] = session.get('count', 0) + 1
+        return ''
+
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def run(app, visitors, reads, writes):
+    clients = [app.test_client() for _ in range(visitors)]
+    for client in clients:
+        client.get('/bench/write')
+
+    started = time.perf_counter()
+    for _ in range(reads):
+        for client in clients:
+            client.get('/bench/read')
+    read_rate = visitors * reads / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for _ in range(writes):
+        for client in clients:
+            client.get('/bench/write')
+    write_rate = visitors * writes / (time.perf_counter() - started)
+    return read_rate, write_rate
+
+
+def bench_sweep(app, expired):
+    with app.app_context():
+        db.session.execute(insert(StoredSession), [
+            {'id': 'session:expired%d' % i, 'data': b'\x80', 'expiry': datetime.utcnow() - timedelta(days=1)}
+            for i in range(expired)
+        ])
+        db.session.commit()
+        started = time.perf_counter()
+        deleted = app.session_interface._delete_expired_sessions()
+        return deleted, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--visitors', type=int, default=50)
+    parser.add_argument('--reads', type=int, default=40, help='read-only requests per visitor')
+    parser.add_argument('--writes', type=int, default=5, help='writing requests per visitor')
+    parser.add_argument('--expired', type=int, default=20000, help='expired sessions to sweep')
+    args = parser.parse_args()
+
+    try:
+        print('%-12s %12s %12s' % ('backend', 'reads/s', 'writes/s'))
+        for backend in ('filesystem', 'database'):
+            app = make_app(backend)
+            read_rate, write_rate = run(app, args.visitors, args.reads, args.writes)
+            print('%-12s %12.0f %12.0f' % (backend, read_rate, write_rate))
+
+        deleted, elapsed = bench_sweep(app, args.expired)
+        print('swept %d expired database sessions in %.3fs' % (deleted, elapsed))
+    finally:
+        shutil.rmtree(TMP, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Deterministic forum datasets for the benchmarks.
+
+build_dataset fills an empty database with users, posts, replies,
+notifications, votes and login history at one of the sizes in SCALES. The
+same scale and seed always produce the same rows, ids included, so
+benchmark runs are comparable across machines and commits.
+"""
+import random
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from werkzeug.security import generate_password_hash
+
+from app import db
+from app.blueprint.pnr.search import fts5_supported, rebuild_index
+from app.models.models import LoginHistory, Notification, Post, Reply, User, Vote
+
+Scale = namedtuple('Scale', 'users posts replies_per_post notifications_per_user votes_per_user logins_per_user')
+
+SCALES = {
+    'tiny': Scale(users=50, posts=500, replies_per_post=5, notifications_per_user=10, votes_per_user=10,
+                  logins_per_user=2),
+    'small': Scale(users=500, posts=10_000, replies_per_post=10, notifications_per_user=20, votes_per_user=20,
+                   logins_per_user=5),
+    'medium': Scale(users=2_000, posts=50_000, replies_per_post=20, notifications_per_user=50, votes_per_user=50,
+                    logins_per_user=10),
+    'large': Scale(users=10_000, posts=100_000, replies_per_post=50, notifications_per_user=100, votes_per_user=100,
+                   logins_per_user=20),
+}
+
+CATEGORIES = ('news', 'tutorial', 'discussion', 'trade', 'question', 'announcement', 'event', 'poll')
+
+WORDS = ('engine turbo brake tyre clutch gearbox oil coolant exhaust suspension spoiler diesel petrol hybrid '
+         'electric battery torque horsepower redline drift track lap wheel rim chassis sedan hatchback coupe '
+         'wagon ute roadster service warranty dealer import restore paint detail wax mileage').split()
+
+# Every user's password; it is hashed once for all of them
+PASSWORD = 'bench'
+
+START = datetime(2024, 1, 1)
+
+CHUNK = 10_000
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def _insert(connection, model, rows):
+    for start in range(0, len(rows), CHUNK):
+        connection.execute(sa.insert(model.__table__), rows[start:start + CHUNK])
+
+
+def build_dataset(scale, seed=5505, log=print):
+    """Fill the current app's empty database with the dataset named scale."""
+    size = SCALES[scale]
+    rng = random.Random(seed)
+    password_hash = generate_password_hash(PASSWORD)
+    posts_per_chunk = max(CHUNK // max(size.replies_per_post, 1), 1)
+
+    with db.engine.begin() as connection:
+        _insert(connection, User, [
+            {'id': i, 'username': 'user%d' % i, 'email': 'user%d@example.com' % i, 'password_hash': password_hash}
+            for i in range(1, size.users + 1)
+        ])
+        log('%d users' % size.users)
+
+        # Posts go in with the replies of the same chunk so last_reply_* can
+        # point at them; reply counts vary from 0 to twice the average
+        reply_id = 0
+        for first in range(1, size.posts + 1, posts_per_chunk):
+            posts, replies = [], []
+            for post_id in range(first, min(first + posts_per_chunk, size.posts + 1)):
+                created = START + timedelta(minutes=10 * post_id)
+                author = rng.randint(1, size.users)
+                count = rng.randint(0, 2 * size.replies_per_post)
+                post = {'id': post_id, 'title': _text(rng, 6).capitalize(), 'category': rng.choice(CATEGORIES),
+                        'content': _text(rng, 60), 'created_at': created, 'user_id': author,
+                        'views': rng.randint(0, 5000), 'replies_count': count, 'likes': 0,
+                        'last_reply_date': created, 'last_reply_id': None, 'last_replier_id': None}
+                for n in range(count):
+                    reply_id += 1
+                    replier = rng.randint(1, size.users)
+                    replied = created + timedelta(minutes=n + 1, seconds=rng.randint(0, 59))
+                    replies.append({'id': reply_id, 'post_id': post_id, 'user_id': replier, 'likes': 0,
+                                    'content': _text(rng, 25), 'created_at': replied})
+                    post.update(last_reply_date=replied, last_reply_id=reply_id, last_replier_id=replier)
+                posts.append(post)
+            _insert(connection, Post, posts)
+            _insert(connection, Reply, replies)
+        log('%d posts, %d replies' % (size.posts, reply_id))
+
+        notifications = []
+        for user_id in range(1, size.users + 1):
+            for n in range(size.notifications_per_user):
+                post_id = rng.randint(1, size.posts)
+                notifications.append({'user_id': user_id, 'actor_id': rng.randint(1, size.users), 'post_id': post_id,
+                                      'message': _text(rng, 12), 'notification_type': rng.choice(('mention', 'new_reply')),
+                                      'is_read': rng.random() < 0.7,
+                                      'created_at': START + timedelta(minutes=10 * post_id + n)})
+            if len(notifications) >= CHUNK:
+                _insert(connection, Notification, notifications)
+                notifications = []
+        _insert(connection, Notification, notifications)
+        unread = (sa.select(sa.func.count(Notification.id))
+                  .where(Notification.user_id == User.id, Notification.is_read.is_(False)).scalar_subquery())
+        connection.execute(sa.update(User.__table__).values(unread_notifications=unread))
+        log('%d notifications' % (size.users * size.notifications_per_user))
+
+        votes = []
+        for user_id in range(1, size.users + 1):
+            for post_id in rng.sample(range(1, size.posts + 1), min(size.votes_per_user, size.posts)):
+                votes.append({'user_id': user_id, 'post_id': post_id,
+                              'vote_type': 'like' if rng.random() < 0.8 else 'dislike'})
+            if len(votes) >= CHUNK:
+                _insert(connection, Vote, votes)
+                votes = []
+        _insert(connection, Vote, votes)
+        score = sa.case((Vote.vote_type == 'like', 1), else_=-1)
+        likes = (sa.select(sa.func.coalesce(sa.func.sum(score), 0))
+                 .where(Vote.post_id == Post.id).scalar_subquery())
+        connection.execute(sa.update(Post.__table__).values(likes=likes))
+        log('%d votes' % (size.users * size.votes_per_user))
+
+        _insert(connection, LoginHistory, [
+            {'user_id': user_id, 'username': 'user%d' % user_id,
+             'login_time': START + timedelta(days=n, minutes=user_id),
+             'logout_time': START + timedelta(days=n, minutes=user_id + 30)}
+            for user_id in range(1, size.users + 1) for n in range(size.logins_per_user)
+        ])
+
+        if fts5_supported(connection):
+            rebuild_index(connection, batch_size=CHUNK)
+            log('search index rebuilt')
@@ -14,17 +14,95 @@ class Config(object):
     # Debug mode
     DEBUG = True
 
-    SESSION_TYPE = 'filesystem'
+    # Sessions live in the stored_session table ('filesystem' still works)
+    SESSION_TYPE = 'database'
     SESSION_FILE_DIR = os.path.join(basedir, 'flask_session')
-    if not os.path.exists(SESSION_FILE_DIR):
-        os.makedirs(SESSION_FILE_DIR)
     SESSION_PERMANENT = False
     SESSION_USE_SIGNER = True
+    # Expired sessions are swept, in batches, on about one request in N
+    SESSION_CLEANUP_N_REQUESTS = 1000
+    SESSION_SWEEP_BATCH_SIZE = 500
+
+    # The logged-in user is cached per process instead of loaded on every request
+    IDENTITY_CACHE_ENABLED = True
+    IDENTITY_CACHE_TTL = 60
+
+    # Post view counts are buffered in memory and written every N seconds or N views
+    VIEW_COUNT_FLUSH_INTERVAL = 10
+    VIEW_COUNT_FLUSH_THRESHOLD = 100
+
+    # Page numbers are offered for the first N pages, deeper pages use cursors
+    PAGINATION_MAX_NUMBERED_PAGES = 5
+
+    # Largest request body accepted; uploads above 500 KB are spooled to disk
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+
+    # Profile pictures are stored up to this size, with thumbnails of these widths
+    AVATAR_MAX_BYTES = 4 * 1024 * 1024
+    AVATAR_SIZES = (48, 100, 200)
+
+    # Live notification streams: events buffered per client, and seconds between heartbeats
+    EVENTS_CLIENT_BUFFER = 64
+    EVENTS_HEARTBEAT = 15
+
+    # Levels of nested replies shown under a top-level reply before "continue this thread"
+    REPLY_TREE_MAX_DEPTH = 4
+
+    # Rendered pages for anonymous visitors, purged by surrogate key on writes
+    PAGE_CACHE_ENABLED = True
+    PAGE_CACHE_TTL = 30
+    PAGE_CACHE_MAX_ENTRIES = 500
+    PAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+    # ETags from per-key data versions, so unchanged pages are answered with 304
+    PAGE_ETAGS_ENABLED = True
+
+    # Gzip for HTML and JSON responses of at least this many bytes
+    COMPRESS_ENABLED = True
+    COMPRESS_MIN_SIZE = 1024
+
+    # Car news from NewsAPI, cached and refreshed in the background when stale
+    NEWS_API_KEY = os.environ.get('NEWS_API_KEY') or 'eb24ca091e3a4ffa8ee813dd7ca5195b'
+    NEWS_CACHE_TTL = 900
+    NEWS_REQUEST_TIMEOUT = 5
+    NEWS_CACHE_FILE = os.path.join(basedir, 'news_cache.json')
+
+    # Chatbot completions; streamed answers give up after these many seconds
+    OPENAI_MODEL = 'gpt-3.5-turbo'
+    CHAT_REQUEST_TIMEOUT = 30
+    CHAT_IDLE_TIMEOUT = 30
+    CHAT_MAX_DURATION = 120
+    # Only the newest turns fitting this many estimated tokens are sent upstream
+    CHAT_HISTORY_TOKEN_BUDGET = 3000
+    # Answers to short prompts are reused for repeated questions
+    CHAT_CACHE_ENABLED = True
+    CHAT_CACHE_TTL = 24 * 60 * 60
+    CHAT_CACHE_MAX_ENTRIES = 1000
+
+class ProductionConfig(Config):
+    DEBUG = False
+
+    # Applied to every new SQLite connection. WAL lets readers carry on while
+    # a write commits; with it synchronous=NORMAL is still safe against
+    # application crashes. cache_size is in KiB when negative.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'cache_size': -32000,
+        'mmap_size': 256 * 1024 * 1024,
+    }
+
+    # SQLite runs one write at a time, so a few writer connections suffice;
+    # GET requests read through the larger read-only pool
+    SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 4, 'max_overflow': 4, 'pool_timeout': 10}
+    SQLALCHEMY_BINDS = {
+        'read': {'url': Config.SQLALCHEMY_DATABASE_URI, 'pool_size': 16, 'max_overflow': 16, 'pool_timeout': 10},
+    }
 
 class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = 'test_secret_key'
-    SESSION_TYPE = 'null'  # Use 'null' session type for testing
-    SERVER_NAME = 'localhost.localdomain'  # Add this line
\ No newline at end of file
+    SERVER_NAME = 'localhost.localdomain'  # Add this line
+    NEWS_CACHE_FILE = None
\ No newline at end of file
@@ -0,0 +1,67 @@
+"""Add FTS5 full-text search index over posts and replies
+
+Revision ID: 4e1f0c2a7d55
+Revises: b8d96e21db94
+Create Date: 2026-10-18 10:41:07.218530
+
+"""
+from alembic import op
+import html
+import re
+
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e1f0c2a7d55'
+down_revision = 'b8d96e21db94'
+branch_labels = None
+depends_on = None
+
+# The index as it was defined in this revision; later changes to the search
+# module must not change what replaying this migration does
+SEARCH_TABLE = 'post_search'
+
+_TAG = re.compile('<.*?>')
+
+
+def _plain_text(value):
+    return html.unescape(_TAG.sub('', value or ''))
+
+
+def upgrade():
+    # Without FTS5 the search route keeps using LIKE matching
+    connection = op.get_bind()
+    if connection.dialect.name != 'sqlite' or not connection.exec_driver_sql(
+            "SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar():
+        return
+    connection.exec_driver_sql(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+        "title, body, reply, post_id UNINDEXED, "
+        "tokenize = 'porter unicode61 remove_diacritics 2')"
+    )
+    connection.exec_driver_sql(f"DELETE FROM {SEARCH_TABLE}")
+
+    # Posts and replies share one index; even rowids are posts, odd rowids replies
+    insert = sa.text(
+        f"INSERT INTO {SEARCH_TABLE} (rowid, title, body, reply, post_id) "
+        "VALUES (:rowid, :title, :body, :reply, :post_id)"
+    )
+    posts = connection.exec_driver_sql("SELECT id, title, content FROM post")
+    while batch := posts.fetchmany(1000):
+        connection.execute(insert, [
+            {'rowid': id * 2, 'title': _plain_text(title), 'body': _plain_text(content), 'reply': None, 'post_id': id}
+            for id, title, content in batch
+        ])
+    replies = connection.exec_driver_sql("SELECT id, post_id, content FROM reply")
+    while batch := replies.fetchmany(1000):
+        connection.execute(insert, [
+            {'rowid': id * 2 + 1, 'title': None, 'body': None, 'reply': _plain_text(content), 'post_id': post_id}
+            for id, post_id, content in batch
+        ])
+
+
+def downgrade():
+    connection = op.get_bind()
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
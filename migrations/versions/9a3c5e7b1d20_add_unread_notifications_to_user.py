@@ -0,0 +1,34 @@
+"""Add cached unread notification count to user
+
+Revision ID: 9a3c5e7b1d20
+Revises: 4e1f0c2a7d55
+Create Date: 2026-10-18 13:05:11.204317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a3c5e7b1d20'
+down_revision = '4e1f0c2a7d55'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('unread_notifications', sa.Integer(), server_default='0', nullable=False))
+
+    # Seed the counter from the notifications that already exist
+    op.execute("""
+        UPDATE user SET unread_notifications = (
+            SELECT COUNT(notification.id) FROM notification
+            WHERE notification.user_id = user.id AND notification.is_read = 0
+        )
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('unread_notifications')
@@ -0,0 +1,26 @@
+"""Add an index on reply.parent_id for loading reply trees
+
+Revision ID: a7d3e5b1c960
+Revises: f4c9a2d7b318
+Create Date: 2026-10-18 19:12:40.318506
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d3e5b1c960'
+down_revision = 'f4c9a2d7b318'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('reply', schema=None) as batch_op:
+        batch_op.create_index('ix_reply_parent_id', ['parent_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('reply', schema=None) as batch_op:
+        batch_op.drop_index('ix_reply_parent_id')
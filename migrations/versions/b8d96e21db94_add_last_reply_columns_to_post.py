@@ -0,0 +1,50 @@
+"""Add denormalized last reply columns to post
+
+Revision ID: b8d96e21db94
+Revises: 802f83ad9167
+Create Date: 2026-10-18 09:12:40.512031
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8d96e21db94'
+down_revision = '802f83ad9167'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('last_reply_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('last_replier_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_post_last_reply_id', 'reply', ['last_reply_id'], ['id'])
+        batch_op.create_foreign_key('fk_post_last_replier_id', 'user', ['last_replier_id'], ['id'])
+
+    # One-shot backfill of the latest reply for every existing thread
+    op.execute("""
+        UPDATE post SET last_reply_id = (
+            SELECT reply.id FROM reply
+            WHERE reply.post_id = post.id
+            ORDER BY reply.created_at DESC, reply.id DESC
+            LIMIT 1
+        )
+    """)
+    op.execute("""
+        UPDATE post SET
+            last_replier_id = (SELECT reply.user_id FROM reply WHERE reply.id = post.last_reply_id),
+            last_reply_date = COALESCE(
+                (SELECT reply.created_at FROM reply WHERE reply.id = post.last_reply_id),
+                post.created_at
+            )
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_post_last_replier_id', type_='foreignkey')
+        batch_op.drop_constraint('fk_post_last_reply_id', type_='foreignkey')
+        batch_op.drop_column('last_replier_id')
+        batch_op.drop_column('last_reply_id')
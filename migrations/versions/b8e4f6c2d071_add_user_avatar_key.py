@@ -0,0 +1,26 @@
+"""Add the content hash of the user's avatar
+
+Revision ID: b8e4f6c2d071
+Revises: a7d3e5b1c960
+Create Date: 2026-10-18 20:05:11.472930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8e4f6c2d071'
+down_revision = 'a7d3e5b1c960'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('avatar_key', sa.String(length=32), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('avatar_key')
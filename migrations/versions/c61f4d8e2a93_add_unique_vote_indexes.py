@@ -0,0 +1,47 @@
+"""Add unique per-user vote indexes
+
+Revision ID: c61f4d8e2a93
+Revises: 9a3c5e7b1d20
+Create Date: 2026-10-18 14:21:37.880412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c61f4d8e2a93'
+down_revision = '9a3c5e7b1d20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Duplicate votes left by racing requests would block the unique indexes.
+    # Keep each user's latest vote per item and take the effect of the
+    # removed ones back out of the like counts first.
+    for table, column in (('post', 'post_id'), ('reply', 'reply_id')):
+        duplicates = """
+            vote.{column} IS NOT NULL AND vote.id NOT IN (
+                SELECT MAX(id) FROM vote WHERE {column} IS NOT NULL GROUP BY user_id, {column}
+            )
+        """.format(column=column)
+        op.execute("""
+            UPDATE {table} SET likes = COALESCE(likes, 0) - (
+                SELECT COALESCE(SUM(CASE vote.vote_type WHEN 'like' THEN 1 ELSE -1 END), 0)
+                FROM vote WHERE vote.{column} = {table}.id AND {duplicates}
+            )
+        """.format(table=table, column=column, duplicates=duplicates))
+        op.execute("DELETE FROM vote WHERE " + duplicates)
+
+    with op.batch_alter_table('vote', schema=None) as batch_op:
+        batch_op.create_index('uq_vote_user_post', ['user_id', 'post_id'], unique=True,
+                              sqlite_where=sa.text('post_id IS NOT NULL'))
+        batch_op.create_index('uq_vote_user_reply', ['user_id', 'reply_id'], unique=True,
+                              sqlite_where=sa.text('reply_id IS NOT NULL'))
+
+
+def downgrade():
+    with op.batch_alter_table('vote', schema=None) as batch_op:
+        batch_op.drop_index('uq_vote_user_reply')
+        batch_op.drop_index('uq_vote_user_post')
@@ -0,0 +1,28 @@
+"""Add the page version table behind page ETags
+
+Revision ID: c9f5a7d3e182
+Revises: b8e4f6c2d071
+Create Date: 2026-10-18 21:12:40.318554
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9f5a7d3e182'
+down_revision = 'b8e4f6c2d071'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('page_version',
+    sa.Column('key', sa.String(length=100), nullable=False),
+    sa.Column('version', sa.Integer(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+
+
+def downgrade():
+    op.drop_table('page_version')
@@ -0,0 +1,52 @@
+"""Add server-side chat history tables
+
+Revision ID: d7e2a9c4b815
+Revises: c61f4d8e2a93
+Create Date: 2026-10-18 15:02:48.117290
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7e2a9c4b815'
+down_revision = 'c61f4d8e2a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('chat_conversation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('chat_conversation', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_chat_conversation_user_id'), ['user_id'], unique=False)
+
+    op.create_table('chat_message',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('conversation_id', sa.Integer(), nullable=False),
+    sa.Column('role', sa.String(length=20), nullable=False),
+    sa.Column('content', sa.Text(), nullable=False),
+    sa.Column('tokens', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['conversation_id'], ['chat_conversation.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('chat_message', schema=None) as batch_op:
+        batch_op.create_index('ix_chat_message_conversation_id_id', ['conversation_id', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('chat_message', schema=None) as batch_op:
+        batch_op.drop_index('ix_chat_message_conversation_id_id')
+
+    op.drop_table('chat_message')
+    with op.batch_alter_table('chat_conversation', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_chat_conversation_user_id'))
+
+    op.drop_table('chat_conversation')
@@ -0,0 +1,34 @@
+"""Add stored_session table for database-backed sessions
+
+Revision ID: e3b8f1a6c402
+Revises: d7e2a9c4b815
+Create Date: 2026-10-18 16:10:05.631958
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3b8f1a6c402'
+down_revision = 'd7e2a9c4b815'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stored_session',
+    sa.Column('id', sa.String(length=255), nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.Column('expiry', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('stored_session', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_stored_session_expiry'), ['expiry'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('stored_session', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_stored_session_expiry'))
+
+    op.drop_table('stored_session')
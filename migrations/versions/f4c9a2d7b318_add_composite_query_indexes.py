@@ -0,0 +1,52 @@
+"""Add composite indexes for the thread, reply, notification and login queries
+
+Revision ID: f4c9a2d7b318
+Revises: e3b8f1a6c402
+Create Date: 2026-10-18 16:48:22.904117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4c9a2d7b318'
+down_revision = 'e3b8f1a6c402'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Votes are already covered by uq_vote_user_post and uq_vote_user_reply
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.create_index('ix_post_last_reply_date', ['last_reply_date'], unique=False)
+        batch_op.create_index('ix_post_category_last_reply_date', ['category', 'last_reply_date'], unique=False)
+        batch_op.create_index('ix_post_user_id_created_at', ['user_id', 'created_at'], unique=False)
+
+    with op.batch_alter_table('reply', schema=None) as batch_op:
+        batch_op.create_index('ix_reply_post_id_created_at', ['post_id', 'created_at'], unique=False)
+        batch_op.create_index('ix_reply_user_id_created_at', ['user_id', 'created_at'], unique=False)
+
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.create_index('ix_notification_user_id_is_read_created_at',
+                              ['user_id', 'is_read', 'created_at'], unique=False)
+
+    with op.batch_alter_table('login_history', schema=None) as batch_op:
+        batch_op.create_index('ix_login_history_user_id_logout_time', ['user_id', 'logout_time'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('login_history', schema=None) as batch_op:
+        batch_op.drop_index('ix_login_history_user_id_logout_time')
+
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.drop_index('ix_notification_user_id_is_read_created_at')
+
+    with op.batch_alter_table('reply', schema=None) as batch_op:
+        batch_op.drop_index('ix_reply_user_id_created_at')
+        batch_op.drop_index('ix_reply_post_id_created_at')
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_index('ix_post_user_id_created_at')
+        batch_op.drop_index('ix_post_category_last_reply_date')
+        batch_op.drop_index('ix_post_last_reply_date')
@@ -0,0 +1,121 @@
+"""Local HTTP servers standing in for third-party APIs during tests."""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubServer:
+    """Serve canned responses on a free localhost port from a background thread.
+
+    Subclasses implement handle(handler) and may use self.requests, the list
+    of request paths received so far.
+    """
+
+    def __init__(self):
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests.append(self.path)
+                stub.handle(self)
+
+            do_POST = do_GET
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, handler):
+        raise NotImplementedError
+
+    @staticmethod
+    def send_json(handler, payload, status=200):
+        body = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+class StubNewsServer(StubServer):
+    """Minimal NewsAPI /v2/everything endpoint.
+
+    Set articles to change what is served, status to simulate an upstream
+    error and delay to simulate a slow upstream.
+    """
+
+    def __init__(self, articles=None):
+        super().__init__()
+        self.articles = articles or []
+        self.status = 200
+        self.delay = 0
+
+    def handle(self, handler):
+        if self.delay:
+            time.sleep(self.delay)
+        if self.status != 200:
+            self.send_json(handler, {'status': 'error', 'message': 'Upstream failure'}, self.status)
+        else:
+            self.send_json(handler, {'status': 'ok', 'totalResults': len(self.articles), 'articles': self.articles})
+
+
+class StubOpenAIServer(StubServer):
+    """Minimal OpenAI /v1/chat/completions endpoint, streaming or not.
+
+    The answer is served as the pieces in tokens, delay seconds apart when
+    streaming. The JSON request bodies received are kept in self.bodies.
+    """
+
+    def __init__(self, tokens=('Hello', ' there', '!')):
+        super().__init__()
+        self.tokens = list(tokens)
+        self.delay = 0
+        self.bodies = []
+        self.disconnected = threading.Event()
+
+    @property
+    def api_base(self):
+        return self.url + '/v1'
+
+    def handle(self, handler):
+        body = json.loads(handler.rfile.read(int(handler.headers.get('Content-Length', 0))) or b'{}')
+        self.bodies.append(body)
+        if not body.get('stream'):
+            self.send_json(handler, {
+                'id': 'chatcmpl-stub', 'object': 'chat.completion', 'model': body.get('model'),
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': ''.join(self.tokens)}}],
+            })
+            return
+
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.end_headers()
+        chunks = [{'role': 'assistant'}] + [{'content': token} for token in self.tokens]
+        try:
+            for delta in chunks:
+                chunk = {'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'model': body.get('model'),
+                         'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]}
+                handler.wfile.write(b'data: ' + json.dumps(chunk).encode() + b'\n\n')
+                handler.wfile.flush()
+                if self.delay:
+                    time.sleep(self.delay)
+            handler.wfile.write(b'data: [DONE]\n\n')
+            handler.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            self.disconnected.set()
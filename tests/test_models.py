@@ -11,8 +11,7 @@ class BaseTestCase(unittest.TestCase):
 
     def setUp(self):
         """Set up test variables and initialize app context and database."""
-        self.app = create_app()
-        self.app.config.from_object(TestingConfig)
+        self.app = create_app('config.TestingConfig')
         self.client = self.app.test_client()
         self.app_context = self.app.app_context()
         self.app_context.push()
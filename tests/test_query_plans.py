@@ -0,0 +1,172 @@
+"""Query-plan regression tests.
+
+A realistic amount of forum data is seeded, the blueprints' pages and
+actions are driven through the test client, and every statement they send
+to the database is run again under EXPLAIN QUERY PLAN. A statement whose
+plan scans a whole table, or sorts rows it could have read in index order,
+fails the test with its SQL and plan.
+"""
+import re
+import unittest
+from datetime import datetime, timedelta
+
+from flask import url_for
+from sqlalchemy import event, insert
+
+from app import db
+from app.blueprint.pnr.search import SEARCH_TABLE
+from app.models.models import LoginHistory, Notification, Post, Reply, User, Vote
+from tests.test_routes import BaseTestCase
+
+USERS = 50
+POSTS = 500
+REPLIES_PER_POST = 10
+CATEGORIES = ('Sedan', 'SUV', 'Truck', 'Electric', 'Classic')
+
+_SCAN = re.compile(r'^SCAN (\S+)(.*)$')
+_SUBQUERY = re.compile(r'^(?:MATERIALIZE|CO-ROUTINE) (\S+)')
+_TEMP_SORT = re.compile(r'^USE TEMP B-TREE FOR (?:ORDER|GROUP) BY')
+
+
+def plan_problems(statement, plan):
+    """Return the steps of a query plan that read a whole table or sort one.
+
+    Scans of subqueries and of the full-text index are fine, as is walking an
+    index in order. Search queries may sort, since they rank the matches of
+    the full-text index rather than a table.
+    """
+    subqueries = {match.group(1) for match in map(_SUBQUERY.match, plan) if match}
+    problems = []
+    for step in plan:
+        scan = _SCAN.match(step)
+        if scan and scan.group(1) not in subqueries and 'USING' not in scan.group(2) \
+                and 'VIRTUAL TABLE' not in scan.group(2):
+            problems.append(step)
+        elif _TEMP_SORT.match(step) and SEARCH_TABLE not in statement:
+            problems.append(step)
+    return problems
+
+
+class QueryPlanTestCase(BaseTestCase):
+    """Every query issued while serving requests must be able to use an index."""
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app.config['PAGE_CACHE_ENABLED'] = False
+        self.seed()
+        self.statements = []
+
+    def seed(self):
+        """Insert users, posts, replies, notifications, votes and logins in bulk."""
+        start = datetime(2024, 1, 1)
+        db.session.execute(insert(User), [
+            {'username': 'user%d' % i, 'email': 'user%d@example.com' % i, 'password_hash': 'x'}
+            for i in range(USERS)
+        ])
+        user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+        db.session.execute(insert(Post), [
+            {'title': 'Post %d' % i, 'content': 'Content of post %d' % i, 'category': CATEGORIES[i % len(CATEGORIES)],
+             'user_id': user_ids[i % len(user_ids)], 'created_at': start + timedelta(hours=i),
+             'last_reply_date': start + timedelta(hours=i, minutes=REPLIES_PER_POST), 'replies_count': REPLIES_PER_POST,
+             'views': 0, 'likes': 0}
+            for i in range(POSTS)
+        ])
+        post_ids = [post_id for (post_id,) in db.session.query(Post.id)]
+        db.session.execute(insert(Reply), [
+            {'content': 'Reply %d to post %d' % (j, post_id), 'post_id': post_id,
+             'user_id': user_ids[(post_id + j) % len(user_ids)],
+             'created_at': start + timedelta(hours=i, minutes=j + 1), 'likes': 0}
+            for i, post_id in enumerate(post_ids) for j in range(REPLIES_PER_POST)
+        ])
+        db.session.execute(insert(Notification), [
+            {'user_id': user_ids[i % len(user_ids)], 'actor_id': user_ids[(i + 1) % len(user_ids)],
+             'post_id': post_ids[i % len(post_ids)], 'message': 'Notification %d' % i,
+             'notification_type': 'new_reply', 'is_read': i % 3 == 0, 'created_at': start + timedelta(minutes=i)}
+            for i in range(len(post_ids) * 4)
+        ])
+        db.session.execute(insert(Vote), [
+            {'user_id': user_id, 'post_id': post_id, 'vote_type': 'like'}
+            for user_id in user_ids[:20] for post_id in post_ids[:100]
+        ])
+        db.session.execute(insert(LoginHistory), [
+            {'user_id': user_ids[i % len(user_ids)], 'login_time': start + timedelta(hours=i),
+             'logout_time': start + timedelta(hours=i + 1)}
+            for i in range(1000)
+        ])
+        db.session.commit()
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE'):
+            self.statements.append((statement, parameters))
+
+    def issue_requests(self):
+        """Drive every page and action of the blueprints as a logged-in user."""
+        user = User.query.filter_by(username='testuser').first()
+        post = db.session.get(Post, 250)
+        reply = Reply.query.filter_by(post_id=post.id).first()
+        notification = Notification.query.filter_by(user_id=user.id).first()
+
+        self.login_test_user()
+        requests = [
+            ('get', url_for('pr.view_post')),
+            ('get', url_for('pr.view_post', tag='SUV')),
+            ('get', url_for('pr.view_post', page=3)),
+            ('post', url_for('pr.submit_reply', post_id=post.id), {'reply_content': 'Nested', 'parent_id': reply.id}),
+            ('get', url_for('pr.details', post_id=post.id)),
+            ('get', url_for('pr.details', post_id=post.id, page=2)),
+            ('get', url_for('pr.reply_thread', reply_id=reply.id)),
+            ('post', url_for('pr.submit_reply', post_id=post.id), {'reply_content': 'Hello @user1'}),
+            ('post', url_for('pr.vote', type='post', id=post.id, action='like')),
+            ('post', url_for('pr.vote', type='reply', id=5, action='dislike')),
+            ('get', url_for('pr.vote_state', post=[post.id, 3], reply=[1, 2])),
+            ('get', url_for('pr.search', q='post', search_type='Both')),
+            ('get', url_for('pr.search', q='reply', sort='recent')),
+            ('get', url_for('pr.search', q='content', search_type='Titles')),
+            ('get', url_for('pr.chat')),
+            ('post', url_for('pr.create_post'), {'title': 'New', 'category': 'SUV', 'content': 'Hi @user2'}),
+            ('get', url_for('user.user_profile', user_id=user.id + 1)),
+            ('get', url_for('user.user_settings')),
+            ('get', url_for('notifications.notifications')),
+            ('get', url_for('notifications.latest_notifications')),
+            ('get', url_for('notifications.mark_as_read', notification_id=notification.id)),
+            ('get', url_for('notifications.delete_notification', notification_id=notification.id)),
+            ('get', url_for('auth.logout')),
+        ]
+        event.listen(db.engine, 'before_cursor_execute', self.record)
+        try:
+            for method, url, *data in requests:
+                response = getattr(self.client, method)(url, data=data[0] if data else None)
+                self.assertLess(response.status_code, 500, url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', self.record)
+
+    def plan(self, statement, parameters):
+        with db.engine.connect() as connection:
+            return [row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+
+    def test_no_full_table_scans(self):
+        self.issue_requests()
+        self.assertGreater(len(self.statements), 20)
+        failures = []
+        for statement, parameters in self.statements:
+            plan = self.plan(statement, parameters)
+            if plan_problems(statement, plan):
+                failures.append('%s\n  %s' % (' '.join(statement.split()), '\n  '.join(plan)))
+        self.assertFalse(failures, 'Queries without a usable index:\n\n' + '\n\n'.join(failures))
+
+    def test_plan_problems(self):
+        """Test that the plan checker tells table scans from index use."""
+        self.assertEqual(plan_problems('SELECT', ['SCAN reply']), ['SCAN reply'])
+        self.assertEqual(plan_problems('SELECT', ['SEARCH reply USING INDEX ix (post_id=?)',
+                                                  'USE TEMP B-TREE FOR ORDER BY']),
+                         ['USE TEMP B-TREE FOR ORDER BY'])
+        self.assertEqual(plan_problems('SELECT', ['SCAN post USING INDEX ix_post_last_reply_date',
+                                                  'SEARCH user_1 USING INTEGER PRIMARY KEY (rowid=?)']), [])
+        self.assertEqual(plan_problems('SELECT FROM post_search', ['CO-ROUTINE anon_1',
+                                                                   'SCAN post_search VIRTUAL TABLE INDEX 0:M4',
+                                                                   'SCAN anon_1', 'USE TEMP B-TREE FOR ORDER BY']), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,21 +1,37 @@
 import unittest
+from contextlib import contextmanager
 from flask import url_for
 from app import create_app, db
-from app.models.models import User, LoginHistory,Post, Reply,Notification
+from app.models.models import User, LoginHistory,Post, Reply,Notification, Vote, ChatMessage
 from config import TestingConfig
 from werkzeug.security import generate_password_hash
 import os
 import openai
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 from datetime import datetime
+import time
+from tests.stub_servers import StubNewsServer, StubOpenAIServer
+from app.instrumentation import capture_queries
+import json
+import io
+import gzip
+import shutil
+import tempfile
+from PIL import Image
 
 class BaseTestCase(unittest.TestCase):
     """Base test case for setting up the application context and database."""
 
     def setUp(self):
         """Set up test variables and initialize app context and database."""
-        self.app = create_app()
-        self.app.config.from_object(TestingConfig)
+        # A database file of its own, so tests with threads get real separate connections
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        class Config(TestingConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory.name, 'test.db')
+
+        self.app = create_app(Config)
         self.client = self.app.test_client()
         self.app_context = self.app.app_context()
         self.app_context.push()
@@ -24,8 +40,11 @@ class BaseTestCase(unittest.TestCase):
 
     def tearDown(self):
         """Remove session and drop all tables after each test."""
+        self.app.extensions['view_counter'].flush()
         db.session.remove()
         db.drop_all()
+        for engine in db.engines.values():
+            engine.dispose()
         self.app_context.pop()
 
     def create_test_user(self):
@@ -34,6 +53,15 @@ class BaseTestCase(unittest.TestCase):
         db.session.add(user)
         db.session.commit()
 
+    @contextmanager
+    def assertQueryBudget(self, max_queries, max_repeats=2):
+        """Fail if the block runs more than max_queries statements or one statement shape more than max_repeats times."""
+        with capture_queries() as stats:
+            yield stats
+        self.assertLessEqual(stats.count, max_queries,
+                             'Ran %d queries:\n%s' % (stats.count, '\n'.join(stats.statements)))
+        self.assertEqual(stats.repeated(max_repeats), {}, 'Statement shapes repeated more than %d times' % max_repeats)
+
     def login_test_user(self):
         """Log in the test user."""
         return self.client.post(url_for('auth.login'), data={
@@ -325,6 +353,535 @@ class UserRoutesTestCase(BaseTestCase):
         response = self.client.get(url_for('user.user_profile', user_id=user.id, tab='replies'))
         self.assertEqual(response.status_code, 200)
 
+class AvatarTestCase(BaseTestCase):
+    """Test cases for profile picture uploads and their thumbnails."""
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.avatar_dir = tempfile.mkdtemp()
+        self.app.config['AVATAR_DIR'] = self.avatar_dir
+        self.store = self.app.extensions['avatars']
+
+    def tearDown(self):
+        self.store.wait()
+        shutil.rmtree(self.avatar_dir, ignore_errors=True)
+        super().tearDown()
+
+    def picture(self, image_format='PNG', size=(300, 200), color=(200, 30, 30)):
+        data = io.BytesIO()
+        Image.new('RGB', size, color).save(data, image_format)
+        data.seek(0)
+        return data
+
+    def upload(self, data, filename='me.png'):
+        return self.client.post(url_for('user.user_settings'), data={'picture': (data, filename), 'submit_picture': True},
+                                content_type='multipart/form-data', follow_redirects=True)
+
+    def test_upload_makes_thumbnails(self):
+        """Test that an upload is stored by content hash and cut into square thumbnails."""
+        self.login_test_user()
+        self.upload(self.picture())
+        self.store.wait()
+
+        user = User.query.filter_by(username='testuser').first()
+        db.session.refresh(user)
+        self.assertIsNotNone(user.avatar_key)
+        self.assertEqual(user.profile_image_url, '/static/avatars/%s.png' % user.avatar_key)
+        for size in (48, 100, 200):
+            with Image.open(os.path.join(self.avatar_dir, '%s-%d.jpg' % (user.avatar_key, size))) as thumbnail:
+                self.assertEqual(thumbnail.size, (size, size))
+        self.assertEqual(self.store.url(user, 40), '/static/avatars/%s-48.jpg' % user.avatar_key)
+        self.assertEqual(self.store.url(user, 150), '/static/avatars/%s-200.jpg' % user.avatar_key)
+        self.assertEqual(self.store.url(user, 500), '/static/avatars/%s-200.jpg' % user.avatar_key)
+        self.assertNotIn('.upload', ' '.join(os.listdir(self.avatar_dir)))
+
+    def test_identical_uploads_stored_once(self):
+        """Test that a picture uploaded twice is stored once and reuses its thumbnails."""
+        self.login_test_user()
+        self.upload(self.picture())
+        self.store.wait()
+        files = sorted(os.listdir(self.avatar_dir))
+
+        other = User(username='other', email='other@example.com', password_hash=generate_password_hash('otherpass'))
+        db.session.add(other)
+        db.session.commit()
+        self.client.get(url_for('auth.logout'))
+        self.client.post(url_for('auth.login'), data={'username': 'other', 'password': 'otherpass'})
+        self.upload(self.picture(), filename='copy.png')
+
+        self.assertEqual(sorted(os.listdir(self.avatar_dir)), files)
+        # The thumbnails already exist, so the key is set without a job
+        db.session.refresh(other)
+        self.assertEqual(other.avatar_key, User.query.filter_by(username='testuser').first().avatar_key)
+
+    def test_rejected_uploads(self):
+        """Test that oversized files and files that are not pictures are refused and leave nothing behind."""
+        self.login_test_user()
+        response = self.upload(io.BytesIO(b'not a picture'))
+        self.assertIn(b'The file is not a picture.', response.data)
+
+        self.app.config['AVATAR_MAX_BYTES'] = 1024
+        response = self.upload(self.picture(image_format='JPEG', size=(400, 400)), filename='big.jpg')
+        self.assertIn(b'Pictures can be at most 1 KB.', response.data)
+
+        # No stored upload nor partial copy; thumbnails (<key>-<size>.jpg) of the
+        # default picture shown on the settings page may be there
+        self.assertEqual([name for name in os.listdir(self.avatar_dir) if '-' not in name], [])
+        self.assertEqual(User.query.filter_by(username='testuser').first().profile_image_url,
+                         '/static/uploads/default_user.jpg')
+
+    def test_pages_show_thumbnails(self):
+        """Test that reply cards link the 100 px thumbnail instead of the full upload."""
+        self.login_test_user()
+        self.upload(self.picture())
+        self.store.wait()
+        user = User.query.filter_by(username='testuser').first()
+        db.session.refresh(user)
+        post = Post(title='Avatars', content='Content', category='news', user_id=user.id)
+        db.session.add(post)
+        db.session.commit()
+        db.session.add(Reply(content='Hello', post_id=post.id, user_id=user.id))
+        db.session.commit()
+
+        response = self.client.get(url_for('pr.details', post_id=post.id))
+        self.assertIn(('/static/avatars/%s-100.jpg' % user.avatar_key).encode(), response.data)
+        self.assertNotIn(user.profile_image_url.encode(), response.data)
+
+    def test_upload_shown_until_thumbnails_exist(self):
+        """Test that the uploaded picture is linked while its thumbnails are being cut."""
+        user = User.query.filter_by(username='testuser').first()
+        user.profile_image_url = '/static/avatars/pending.png'
+        self.assertEqual(self.store.url(user, 100), '/static/avatars/pending.png')
+
+
+class PostRoutesTestCase(BaseTestCase):
+    """Test cases for post and reply routes."""
+
+    def test_submit_reply_updates_last_reply(self):
+        """Test that a new reply is recorded as the latest reply of the post."""
+        self.login_test_user()
+        user = User.query.filter_by(username='testuser').first()
+        post = self.create_test_post('Reply Post', 'A post to reply to')
+
+        response = self.client.post(url_for('pr.submit_reply', post_id=post.id), data={'reply_content': 'First reply'})
+        self.assertEqual(response.status_code, 302)
+
+        db.session.refresh(post)
+        reply = Reply.query.filter_by(post_id=post.id).first()
+        self.assertEqual(post.replies_count, 1)
+        self.assertEqual(post.last_reply_id, reply.id)
+        self.assertEqual(post.last_replier_id, user.id)
+        self.assertEqual(post.last_reply_date, reply.created_at)
+
+    def test_view_posts_shows_last_replier(self):
+        """Test that the thread list shows the last replier from the stored columns."""
+        another_user = User(username='replier', email='replier@example.com', password_hash=generate_password_hash('replierpass'))
+        db.session.add(another_user)
+        post = self.create_test_post('Busy Post', 'A post with replies')
+        post.category = 'discussion'
+        reply = Reply(content='A reply', post_id=post.id, user_id=another_user.id)
+        db.session.add(reply)
+        db.session.flush()
+        post.set_last_reply(reply)
+        self.create_test_post('Quiet Post', 'A post without replies').category = 'news'
+        db.session.commit()
+
+        response = self.client.get(url_for('pr.view_post'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'replier', response.data)
+        self.assertIn(b'No replies', response.data)
+
+
+    def test_details_buffers_view_count(self):
+        """Test that page views are buffered and written in one flush."""
+        post = self.create_test_post('Viewed Post', 'A post with views')
+        post.category = 'discussion'
+        db.session.commit()
+
+        for _ in range(3):
+            response = self.client.get(url_for('pr.details', post_id=post.id))
+            self.assertEqual(response.status_code, 200)
+
+        # Nothing is written yet, but the list already shows the pending views
+        db.session.refresh(post)
+        self.assertEqual(post.views, 0)
+        response = self.client.get(url_for('pr.view_post'))
+        self.assertIn(b'3 views', response.data)
+
+        self.assertEqual(self.app.extensions['view_counter'].flush(), 1)
+        db.session.refresh(post)
+        self.assertEqual(post.views, 3)
+
+    def test_view_count_flushes_at_threshold(self):
+        """Test that reaching the size threshold triggers a flush."""
+        self.app.config['VIEW_COUNT_FLUSH_THRESHOLD'] = 2
+        post = self.create_test_post('Viewed Post', 'A post with views')
+
+        self.client.get(url_for('pr.details', post_id=post.id))
+        self.client.get(url_for('pr.details', post_id=post.id))
+
+        db.session.refresh(post)
+        self.assertEqual(post.views, 2)
+        self.assertEqual(self.app.extensions['view_counter'].pending(post.id), 0)
+
+    def test_view_count_flushes_on_quiet_site(self):
+        """Test that buffered views are written after the interval without another view."""
+        self.app.config['VIEW_COUNT_FLUSH_INTERVAL'] = 0.1
+        post = self.create_test_post('Viewed Post', 'A post with views')
+        counter = self.app.extensions['view_counter']
+        counter.flush()
+        counter.add(post.id)
+
+        # Wait for the timer's flush to finish writing, not just to take the views
+        counter._timer.join(5)
+        db.session.refresh(post)
+        self.assertEqual(post.views, 1)
+
+    def test_exit_hook_registered_once(self):
+        """Test that initialising a counter again does not register another exit flush."""
+        from app.blueprint.pnr.counters import ViewCounter
+        with patch('atexit.register') as register:
+            counter = ViewCounter(self.app)
+            counter.init_app(self.app)
+        self.assertEqual(register.call_count, 1)
+
+    def test_failed_flush_retried_on_timer(self):
+        """Test that views put back by a failed flush are written later without another view."""
+        from sqlalchemy.exc import OperationalError
+        self.app.config['VIEW_COUNT_FLUSH_INTERVAL'] = 0.1
+        post = self.create_test_post('Viewed Post', 'A post with views')
+        counter = self.app.extensions['view_counter']
+        counter.flush()
+        counter.add(post.id)
+
+        with patch('app.blueprint.pnr.counters.bump_versions', side_effect=OperationalError('UPDATE', {}, None)):
+            self.assertEqual(counter.flush(), 0)
+        self.assertEqual(counter.pending(post.id), 1)
+        self.assertIsNotNone(counter._timer)
+
+        counter._timer.join(5)
+        db.session.refresh(post)
+        self.assertEqual(post.views, 1)
+        self.assertEqual(counter.pending(post.id), 0)
+
+    def test_views_counted_while_flush_writes(self):
+        """Test that views taken by a running flush still count until its write commits."""
+        post = self.create_test_post('Viewed Post', 'A post with views')
+        counter = self.app.extensions['view_counter']
+        counter.flush()
+        counter.add(post.id, 3)
+
+        seen = []
+        with patch('app.blueprint.pnr.counters.bump_versions', side_effect=lambda *keys, **kwargs: seen.append(
+                counter.pending(post.id))):
+            counter.flush()
+        self.assertEqual(seen, [3])
+        self.assertEqual(counter.pending(post.id), 0)
+
+
+class PaginationTestCase(BaseTestCase):
+    """Test cases for page-number and cursor pagination."""
+
+    def create_posts(self, count):
+        user = User.query.filter_by(username='testuser').first()
+        for i in range(count):
+            db.session.add(Post(title='Thread %02d' % i, content='Content %d' % i, category='discussion',
+                                user_id=user.id, last_reply_date=datetime(2024, 1, 1, 0, i)))
+        db.session.commit()
+
+    def test_cursor_roundtrip(self):
+        """Test that cursors decode to the values they were built from."""
+        from app.pagination import decode_cursor, encode_cursor
+        values = [datetime(2024, 5, 17, 8, 11, 58, 773595), 42]
+        self.assertEqual(decode_cursor(encode_cursor(values)), values)
+        with self.assertRaises(ValueError):
+            decode_cursor('not-a-cursor')
+
+    def test_view_posts_keyset_pages(self):
+        """Test walking the thread list forward and back with cursors."""
+        self.app.config['PAGINATION_MAX_NUMBERED_PAGES'] = 1
+        self.create_posts(25)
+
+        # The first page is numbered and its Next link carries a cursor
+        response = self.client.get(url_for('pr.view_post'))
+        self.assertIn(b'Thread 24', response.data)
+        self.assertNotIn(b'Thread 14', response.data)
+        from app.pagination import encode_cursor
+        last_on_page = Post.query.filter_by(title='Thread 15').first()
+        after = encode_cursor([last_on_page.last_reply_date, last_on_page.id])
+        self.assertIn(('after=' + after).encode(), response.data)
+
+        response = self.client.get(url_for('pr.view_post', after=after))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Thread 14', response.data)
+        self.assertIn(b'Thread 05', response.data)
+        self.assertNotIn(b'Thread 15', response.data)
+        self.assertNotIn(b'Thread 04', response.data)
+
+        first_on_page = Post.query.filter_by(title='Thread 14').first()
+        before = encode_cursor([first_on_page.last_reply_date, first_on_page.id])
+        response = self.client.get(url_for('pr.view_post', before=before))
+        self.assertIn(b'Thread 24', response.data)
+        self.assertIn(b'Thread 15', response.data)
+        self.assertNotIn(b'Thread 14', response.data)
+
+    def test_numbered_pages_run_no_count(self):
+        """Test that numbered pages tell whether another page follows without counting the threads."""
+        self.create_posts(25)
+
+        with capture_queries() as stats:
+            response = self.client.get(url_for('pr.view_post'))
+        self.assertFalse([s for s in stats.statements if 'count(' in s.lower()], stats.statements)
+        self.assertIn(b'page=2', response.data)
+        self.assertNotIn(b'page=3', response.data)
+
+        response = self.client.get(url_for('pr.view_post', page=3))
+        self.assertIn(b'Thread 00', response.data)
+        self.assertIn(b'page=2', response.data)
+        self.assertNotIn(b'page=4', response.data)
+        self.assertEqual(self.client.get(url_for('pr.view_post', page=4)).status_code, 404)
+
+    def test_invalid_cursor(self):
+        """Test that a malformed cursor is rejected."""
+        response = self.client.get(url_for('pr.view_post', after='garbage'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_detail_replies_keyset(self):
+        """Test cursor pagination of replies in creation order."""
+        user = User.query.filter_by(username='testuser').first()
+        post = self.create_test_post('Long Thread', 'Many replies')
+        for i in range(8):
+            db.session.add(Reply(content='Reply number %d' % i, post_id=post.id, user_id=user.id,
+                                 created_at=datetime(2024, 1, 1, 0, i)))
+        db.session.commit()
+
+        from app.pagination import encode_cursor
+        sixth = Reply.query.filter_by(content='Reply number 5').first()
+        response = self.client.get(url_for('pr.details', post_id=post.id,
+                                           after=encode_cursor([sixth.created_at, sixth.id])))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Reply number 6', response.data)
+        self.assertIn(b'Reply number 7', response.data)
+        self.assertNotIn(b'Reply number 5', response.data)
+
+
+class PageCacheTestCase(BaseTestCase):
+    """Test cases for the anonymous full-page cache."""
+
+    def test_anonymous_pages_are_cached(self):
+        """Test that a repeated anonymous GET is served from the cache."""
+        response = self.client.get(url_for('pr.view_post'))
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        response = self.client.get(url_for('pr.view_post'))
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        # A different tag is a different page
+        response = self.client.get(url_for('pr.view_post', tag='news'))
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+
+    def test_logged_in_pages_are_not_cached(self):
+        """Test that pages for logged-in users bypass the cache."""
+        self.login_test_user()
+        self.client.get(url_for('pr.view_post'))
+        response = self.client.get(url_for('pr.view_post'))
+        self.assertNotIn('X-Cache', response.headers)
+
+    def test_create_post_purges_only_affected_lists(self):
+        """Test that a new post purges its own category list and the full list."""
+        for tag in (None, 'news', 'trade'):
+            self.client.get(url_for('pr.view_post', tag=tag))
+
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.login_test_user()
+        self.client.post(url_for('pr.create_post'), data={'title': 'New', 'category': 'news', 'content': 'Body'},
+                         follow_redirects=True)
+        self.client.get(url_for('auth.logout'), follow_redirects=True)
+
+        self.assertEqual(self.client.get(url_for('pr.view_post', tag='trade')).headers['X-Cache'], 'HIT')
+        response = self.client.get(url_for('pr.view_post', tag='news'))
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertIn(b'New', response.data)
+        self.assertEqual(self.client.get(url_for('pr.view_post')).headers['X-Cache'], 'MISS')
+
+    def test_cache_key_keeps_arguments_apart(self):
+        """Test that an argument holding an encoded '&' does not share a key with two arguments."""
+        user = User.query.filter_by(username='testuser').first()
+        db.session.add_all([Post(title='News %d' % i, content='Body', category='news', user_id=user.id)
+                            for i in range(11)])
+        db.session.add(Post(title='Trade post', content='Body', category='trade', user_id=user.id))
+        db.session.commit()
+
+        self.assertIn(b'Trade post', self.client.get('/view_posts?page=2%26tag%3Dnews').data)
+        response = self.client.get('/view_posts?page=2&tag=news')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertNotIn(b'Trade post', response.data)
+
+    def test_reply_purges_thread_page(self):
+        """Test that replying to a post purges its cached detail page."""
+        post = self.create_test_post('Cached Post', 'Cached content')
+        post.category = 'news'
+        db.session.commit()
+        self.client.get(url_for('pr.details', post_id=post.id))
+        self.assertEqual(self.client.get(url_for('pr.details', post_id=post.id)).headers['X-Cache'], 'HIT')
+
+        self.login_test_user()
+        self.client.post(url_for('pr.submit_reply', post_id=post.id), data={'reply_content': 'Fresh reply'}, follow_redirects=True)
+        self.client.get(url_for('auth.logout'))
+
+        response = self.client.get(url_for('pr.details', post_id=post.id))
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertIn(b'Fresh reply', response.data)
+
+    def test_lru_eviction(self):
+        """Test that the least recently used page is evicted at the entry limit."""
+        from app.cache import PageCache
+        self.app.config['PAGE_CACHE_MAX_ENTRIES'] = 2
+        cache = PageCache()
+        cache.app = self.app
+        cache.set('a', b'A', 200, [], ['x'])
+        cache.set('b', b'B', 200, [], ['x'])
+        cache.get('a')
+        cache.set('c', b'C', 200, [], ['y'])
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.purge('x'), 1)
+        self.assertEqual(cache.stats()['entries'], 1)
+
+
+class ConditionalGetTestCase(BaseTestCase):
+    """Test cases for page ETags, 304 responses and gzip of dynamic responses."""
+
+    def create_news_post(self):
+        user = User.query.filter_by(username='testuser').first()
+        post = Post(title='Versioned Post', content='Versioned content', category='news', user_id=user.id)
+        db.session.add(post)
+        db.session.commit()
+        return post
+
+    def test_unchanged_list_is_not_modified(self):
+        """Test that a thread list answers 304 until a new post or a view count flush changes it."""
+        response = self.client.get(url_for('pr.view_post'))
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        # Served from the page cache with the stored ETag, without a query
+        with capture_queries() as stats:
+            response = self.client.get(url_for('pr.view_post'), headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(stats.count, 0)
+
+        self.app.config['PAGE_CACHE_ENABLED'] = False
+        self.assertEqual(self.client.get(url_for('pr.view_post'), headers={'If-None-Match': etag}).status_code, 304)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.login_test_user()
+        self.client.post(url_for('pr.create_post'), data={'title': 'New', 'category': 'news', 'content': 'Body'},
+                         follow_redirects=True)
+        self.client.get(url_for('auth.logout'), follow_redirects=True)
+        response = self.client.get(url_for('pr.view_post'), headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        etag = response.headers['ETag']
+        from app.blueprint.pnr.counters import record_view
+        record_view(Post.query.first().id)
+        self.app.extensions['view_counter'].flush()
+        self.assertEqual(self.client.get(url_for('pr.view_post'), headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_first_visit_skips_version_lookup(self):
+        """Test that a request without If-None-Match gets the page's hash as ETag without reading versions."""
+        post = self.create_news_post()
+        self.login_test_user()
+        with capture_queries() as stats:
+            response = self.client.get(url_for('pr.details', post_id=post.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['ETag'].startswith('W/'))
+        self.assertFalse([s for s in stats.statements if 'page_version' in s], stats.statements)
+
+    def test_detail_checked_before_rendering(self):
+        """Test that a logged-in 304 for a thread loads no post or reply, and a vote changes the ETag."""
+        post = self.create_news_post()
+        self.login_test_user()
+        url = url_for('pr.details', post_id=post.id)
+        response = self.client.get(url)
+        self.assertIn('Cookie', response.headers['Vary'])
+
+        # The first revalidation renders the page and trades its hash for the version-based ETag
+        response = self.client.get(url, headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        etag = response.headers['ETag']
+
+        with capture_queries() as stats:
+            response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+        self.assertFalse([s for s in stats.statements if 'FROM post' in s or 'FROM reply' in s], stats.statements)
+
+        self.client.post(url_for('pr.vote', type='post', id=post.id, action='like'))
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_versions_bumped_once_per_transaction(self):
+        """Test that a reply notifying its author bumps all its keys in one statement, and a rollback none."""
+        from app.cache import bump_versions
+        from app.models.models import PageVersion
+        author = User(username='author', email='author@example.com', password_hash='x')
+        db.session.add(author)
+        db.session.commit()
+        post = Post(title='Author Post', content='Content', category='news', user_id=author.id)
+        db.session.add(post)
+        db.session.commit()
+        self.login_test_user()
+
+        with capture_queries() as stats:
+            self.client.post(url_for('pr.submit_reply', post_id=post.id), data={'reply_content': 'Hi @author'})
+        self.assertEqual(sum(n for s, n in stats.statements.items() if 'INTO page_version' in s), 1)
+        versions = dict(db.session.query(PageVersion.key, PageVersion.version))
+        self.assertEqual(versions, {'post:%d' % post.id: 1, 'list:all': 1, 'list:news': 1,
+                                    'notifications:%d' % author.id: 1})
+
+        bump_versions('list:all')
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(db.session.get(PageVersion, 'list:all').version, 1)
+
+    def test_latest_notifications_not_modified(self):
+        """Test that the polled notification JSON answers 304 until a notification arrives."""
+        from app.blueprint.notifications.utils import create_notification
+        self.login_test_user()
+        user = User.query.filter_by(username='testuser').first()
+        response = self.client.get(url_for('notifications.latest_notifications'))
+        self.assertEqual(response.json, [])
+        etag = response.headers['ETag']
+        response = self.client.get(url_for('notifications.latest_notifications'), headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        other = User(username='other', email='other@example.com', password_hash='x')
+        db.session.add(other)
+        db.session.commit()
+        create_notification(user.id, other.id, message='Hello', notification_type='mention')
+        response = self.client.get(url_for('notifications.latest_notifications'), headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([n['message'] for n in response.json], ['Hello'])
+
+    def test_large_responses_are_gzipped(self):
+        """Test that HTML above the size threshold is gzipped for clients accepting it, and small JSON is not."""
+        self.create_news_post()
+        response = self.client.get(url_for('pr.view_post'), headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertIn(b'Versioned Post', gzip.decompress(response.data))
+
+        response = self.client.get(url_for('pr.view_post'))
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn(b'Versioned Post', response.data)
+
+        response = self.client.get(url_for('pr.vote_state'), headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertTrue(response.json['success'])
+
+
 class ChatbotTestCase(BaseTestCase):
     """Test case for chatbot route."""
 
@@ -332,18 +889,1024 @@ class ChatbotTestCase(BaseTestCase):
     def test_chatbot_response(self, mock_openai_create):
         """Test the chatbot response."""
         self.login_test_user()
+        mock_openai_create.return_value.choices = [MagicMock(message={'content': 'Paris'})]
 
         # Simulate sending a question to the chatbot
         response = self.client.post(url_for('pr.chat'), data={
             'question': 'What is the capital of France?'
         }, follow_redirects=True)
 
-        # Ensure the session chat history is initialized
+        # Ensure the session only references the stored conversation
         with self.client.session_transaction() as sess:
-            sess['chat_history'] = []
+            self.assertNotIn('chat_history', sess)
+            conversation_id = sess['chat_conversation_id']
+        messages = ChatMessage.query.filter_by(conversation_id=conversation_id).order_by(ChatMessage.id).all()
+        self.assertEqual([(m.role, m.content) for m in messages],
+                         [('user', 'What is the capital of France?'), ('assistant', 'Paris')])
 
         # Ensure the response is successful
         self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Paris', response.data)
+
+    def test_question_committed_before_upstream_call(self):
+        """Test that no write transaction is held open while the answer is awaited."""
+        from sqlalchemy import insert
+        self.login_test_user()
+
+        def answer(messages):
+            # Another writer gets through at once, and sees the question
+            with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                connection.exec_driver_sql('PRAGMA busy_timeout = 100')
+                connection.execute(insert(User).values(username='writer', email='w@example.com', password_hash='x'))
+                self.assertEqual(connection.execute(ChatMessage.__table__.select()).all()[0].content, 'Hi')
+            return 'Hello'
+
+        with patch('app.blueprint.pnr.routes.complete_chat', side_effect=answer) as complete:
+            self.client.post(url_for('pr.chat'), data={'question': 'Hi'})
+        complete.assert_called_once()
+        self.assertEqual([m.content for m in ChatMessage.query.order_by(ChatMessage.id)], ['Hi', 'Hello'])
+
+    def test_prompt_trimmed_to_token_budget(self):
+        """Test that only the newest turns fitting the token budget are sent upstream."""
+        from app.blueprint.pnr.chatbot import add_message, build_prompt, estimate_tokens
+        from app.models.models import ChatConversation
+        user = User.query.filter_by(username='testuser').first()
+        conversation = ChatConversation(user_id=user.id)
+        db.session.add(conversation)
+        db.session.flush()
+        for i in range(20):
+            add_message(conversation.id, 'user' if i % 2 == 0 else 'assistant', 'message %02d ' % i + 'x' * 400)
+        db.session.commit()
+
+        per_message = estimate_tokens('message 00 ' + 'x' * 400)
+        prompt = build_prompt(conversation.id, budget=per_message * 5 + 1)
+        self.assertEqual(len(prompt), 5)
+        self.assertTrue(prompt[0]['content'].startswith('message 15'))
+        self.assertTrue(prompt[-1]['content'].startswith('message 19'))
+
+        # The newest message is sent even when it alone exceeds the budget
+        self.assertEqual(len(build_prompt(conversation.id, budget=1)), 1)
+
+    def test_conversation_id_of_other_user_ignored(self):
+        """Test that a conversation id in the session cannot read another user's history."""
+        from app.models.models import ChatConversation
+        other = User(username='other', email='other@example.com', password_hash='x')
+        db.session.add(other)
+        db.session.flush()
+        conversation = ChatConversation(user_id=other.id)
+        db.session.add(conversation)
+        db.session.flush()
+        db.session.add(ChatMessage(conversation_id=conversation.id, role='user', content='Secret question', tokens=5))
+        db.session.commit()
+
+        self.login_test_user()
+        with self.client.session_transaction() as sess:
+            sess['chat_conversation_id'] = conversation.id
+        response = self.client.get(url_for('pr.chat'))
+        self.assertNotIn(b'Secret question', response.data)
+
+    def start_stub(self, **attributes):
+        stub = StubOpenAIServer().__enter__()
+        self.addCleanup(stub.__exit__, None, None, None)
+        for name, value in attributes.items():
+            setattr(stub, name, value)
+        self.app.config['OPENAI_API_BASE'] = stub.api_base
+        self.app.config['OPENAI_API_KEY'] = 'test-key'
+        return stub
+
+    @staticmethod
+    def parse_events(body):
+        """Split a Server-Sent Events body into (event, data) pairs, skipping comments."""
+        events = []
+        for block in body.strip().split('\n\n'):
+            lines = [line for line in block.split('\n') if not line.startswith(':')]
+            if not lines:
+                continue
+            fields = dict(line.split(': ', 1) for line in lines)
+            events.append((fields.get('event', 'message'), json.loads(fields['data'])))
+        return events
+
+    def test_chat_stream_relays_tokens(self):
+        """Test that the answer arrives as token events followed by a done event."""
+        stub = self.start_stub(tokens=['Vroom', ' vroom', '.'])
+        self.login_test_user()
+
+        response = self.client.post(url_for('pr.chat_stream'), data={'question': 'Fastest car?'})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = self.parse_events(response.get_data(as_text=True))
+
+        self.assertEqual(events[:3], [('message', {'token': 'Vroom'}), ('message', {'token': ' vroom'}),
+                                      ('message', {'token': '.'})])
+        self.assertEqual(events[-1], ('done', {'answer': 'Vroom vroom.'}))
+        self.assertTrue(stub.bodies[0]['stream'])
+        self.assertEqual(stub.bodies[0]['messages'][-1], {'role': 'user', 'content': 'Fastest car?'})
+
+        # The streamed answer is stored with the conversation
+        response = self.client.get(url_for('pr.chat'))
+        self.assertIn(b'Fastest car?', response.data)
+        self.assertIn(b'Vroom vroom.', response.data)
+
+    def test_chat_stream_idle_timeout(self):
+        """Test that a stalled upstream ends the stream with an error event after keepalives."""
+        self.start_stub(delay=1)
+        self.app.config['CHAT_IDLE_TIMEOUT'] = 0.3
+        self.app.config['CHAT_KEEPALIVE_INTERVAL'] = 0.1
+        self.login_test_user()
+
+        response = self.client.post(url_for('pr.chat_stream'), data={'question': 'Hello?'})
+        body = response.get_data(as_text=True)
+
+        self.assertIn(': keepalive', body)
+        self.assertEqual(self.parse_events(body)[-1], ('error', {'error': 'The assistant stopped responding'}))
+
+    def test_chat_stream_cancelled_on_disconnect(self):
+        """Test that closing the response stops the upstream reader thread."""
+        import threading
+        self.start_stub(tokens=['token'] * 200, delay=0.02)
+        self.login_test_user()
+
+        response = self.client.post(url_for('pr.chat_stream'), data={'question': 'Long answer'}, buffered=False)
+        first = next(iter(response.response))
+        self.assertIn('token', first if isinstance(first, str) else first.decode())
+        response.close()
+
+        for _ in range(100):
+            if not any(thread.name == 'chat-stream' for thread in threading.enumerate()):
+                break
+            time.sleep(0.02)
+        self.assertFalse(any(thread.name == 'chat-stream' for thread in threading.enumerate()))
+
+    def test_repeated_question_served_from_cache(self):
+        """Test that the same question asked again, however spelled, skips the upstream."""
+        stub = self.start_stub(tokens=['32', ' psi'])
+        self.login_test_user()
+        cache = self.app.extensions['chat_cache']
+
+        self.client.post(url_for('pr.chat_stream'), data={'question': 'What tyre pressure?'}).get_data()
+        # A new conversation asking the same thing differently
+        with self.client.session_transaction() as sess:
+            sess.pop('chat_conversation_id')
+        started = time.monotonic()
+        response = self.client.post(url_for('pr.chat_stream'), data={'question': '  what TYRE   pressure ?? '})
+        events = self.parse_events(response.get_data(as_text=True))
+
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(events[-1], ('done', {'answer': '32 psi'}))
+        self.assertEqual(len(stub.bodies), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # The plain form post shares the same cache
+        with self.client.session_transaction() as sess:
+            sess.pop('chat_conversation_id')
+        self.client.post(url_for('pr.chat'), data={'question': 'What tyre pressure'})
+        self.assertEqual(len(stub.bodies), 1)
+        self.assertEqual(cache.stats()['hits'], 2)
+
+    def test_long_conversations_not_cached(self):
+        """Test that prompts with more context than CHAT_CACHE_MAX_MESSAGES always go upstream."""
+        stub = self.start_stub(tokens=['Answer'])
+        self.app.config['CHAT_CACHE_MAX_MESSAGES'] = 1
+        self.login_test_user()
+
+        for _ in range(2):
+            self.client.post(url_for('pr.chat'), data={'question': 'Same question'})
+        self.assertEqual(len(stub.bodies), 2)
+        self.assertEqual(self.app.extensions['chat_cache'].stats()['entries'], 1)
+
+    def test_chat_cache_expiry_and_eviction(self):
+        """Test that cached answers expire after the TTL and the oldest is evicted first."""
+        cache = self.app.extensions['chat_cache']
+        self.app.config['CHAT_CACHE_MAX_ENTRIES'] = 2
+        keys = [cache.key([{'role': 'user', 'content': 'question %d' % i}]) for i in range(3)]
+        for i, key in enumerate(keys):
+            cache.set(key, 'answer %d' % i)
+        self.assertIsNone(cache.get(keys[0]))
+        self.assertEqual(cache.get(keys[2]), 'answer 2')
+
+        self.app.config['CHAT_CACHE_TTL'] = 0
+        cache.set(keys[1], 'answer 1')
+        self.assertIsNone(cache.get(keys[1]))
+
+    def test_chat_without_streaming(self):
+        """Test that the plain form post still stores the whole answer."""
+        self.start_stub(tokens=['Four', ' wheels'])
+        self.login_test_user()
+
+        self.client.post(url_for('pr.chat'), data={'question': 'How many wheels?'})
+        response = self.client.get(url_for('pr.chat'))
+        self.assertIn(b'Four wheels', response.data)
+
+class SessionBackendTestCase(BaseTestCase):
+    """Test cases for the database session backend."""
+
+    @staticmethod
+    def session_writes(stats):
+        return [s for s in stats.statements.elements() if 'stored_session' in s and not s.startswith('SELECT')]
+
+    def test_login_session_stored_in_database(self):
+        """Test that logging in stores one session row that later requests load."""
+        from app.models.models import StoredSession
+        self.login_test_user()
+        self.assertEqual(StoredSession.query.count(), 1)
+        response = self.client.get(url_for('user.user_settings'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_unchanged_session_not_written(self):
+        """Test that requests which only read the session do not write it back."""
+        self.login_test_user()
+        self.client.get(url_for('user.user_settings'))  # First render adds a CSRF token
+        with capture_queries() as stats:
+            for _ in range(3):
+                self.client.get(url_for('user.user_settings'))
+        self.assertEqual(self.session_writes(stats), [])
+
+        with capture_queries() as stats:
+            with self.client.session_transaction() as sess:
+                sess['theme'] = 'dark'
+        self.assertEqual(len(self.session_writes(stats)), 1)
+
+    def test_expired_sessions_swept_in_batches(self):
+        """Test that the sweep removes every expired row, a batch at a time, and keeps live ones."""
+        from datetime import timedelta
+        from sqlalchemy import insert
+        from app.models.models import StoredSession
+        now = datetime.utcnow()
+        db.session.execute(insert(StoredSession), [
+            {'id': 'session:old%d' % i, 'data': b'\x80', 'expiry': now - timedelta(minutes=1)} for i in range(25)
+        ] + [{'id': 'session:live', 'data': b'\x80', 'expiry': now + timedelta(days=1)}])
+        db.session.commit()
+
+        interface = self.app.session_interface
+        interface.sweep_batch_size = 10
+        self.assertEqual(interface._delete_expired_sessions(), 25)
+        self.assertEqual([row.id for row in StoredSession.query.all()], ['session:live'])
+
+    def test_expired_session_not_loaded(self):
+        """Test that a session past its expiry is treated as missing."""
+        from datetime import timedelta
+        from app.models.models import StoredSession
+        interface = self.app.session_interface
+        data = interface.serializer.encode({'_user_id': '1'})
+        db.session.add_all([
+            StoredSession(id='session:old', data=data, expiry=datetime.utcnow() - timedelta(seconds=1)),
+            StoredSession(id='session:live', data=data, expiry=datetime.utcnow() + timedelta(days=1)),
+        ])
+        db.session.commit()
+        self.assertIsNone(interface._retrieve_session_data('session:old'))
+        self.assertEqual(interface._retrieve_session_data('session:live'), {'_user_id': '1'})
+
+
+class ProductionDatabaseTestCase(unittest.TestCase):
+    """Test cases for the production SQLite profile: PRAGMAs and read/write routing."""
+
+    def setUp(self):
+        import tempfile
+        from config import ProductionConfig
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        uri = 'sqlite:///' + os.path.join(directory.name, 'production.db')
+
+        class Config(ProductionConfig):
+            SQLALCHEMY_DATABASE_URI = uri
+            SQLALCHEMY_BINDS = {'read': dict(ProductionConfig.SQLALCHEMY_BINDS['read'], url=uri)}
+            NEWS_CACHE_FILE = None
+            SERVER_NAME = 'localhost.localdomain'
+
+        self.app = create_app(Config)
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        user = User(username='testuser', email='test@example.com', password_hash=generate_password_hash('testpass'))
+        db.session.add(user)
+        db.session.add(Post(title='Hello', category='SUV', content='First post', user=user))
+        db.session.commit()
+
+    def tearDown(self):
+        self.app.extensions['view_counter'].flush()
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+        self.app_context.pop()
+
+    @staticmethod
+    def verbs(stats, bind_key):
+        """Return the leading keyword of each statement the bind ran, leaving out session storage."""
+        statements = stats.engines[db.engines[bind_key]]
+        return [s.split(None, 1)[0] for s in statements.elements() if 'stored_session' not in s]
+
+    def test_pragmas_applied(self):
+        """Test that connections use WAL and the configured PRAGMAs, and reader connections cannot write."""
+        from sqlalchemy.exc import OperationalError
+        with db.engines[None].connect() as connection:
+            self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(connection.exec_driver_sql('PRAGMA synchronous').scalar(), 1)  # NORMAL
+            self.assertEqual(connection.exec_driver_sql('PRAGMA busy_timeout').scalar(), 5000)
+            self.assertEqual(connection.exec_driver_sql('PRAGMA cache_size').scalar(), -32000)
+        with db.engines['read'].connect() as connection:
+            self.assertEqual(connection.exec_driver_sql('PRAGMA query_only').scalar(), 1)
+            with self.assertRaises(OperationalError):
+                connection.exec_driver_sql('DELETE FROM post')
+
+    def test_get_requests_read_from_read_bind(self):
+        """Test that GET pages read through the read bind and writes go to the primary engine."""
+        self.client.post(url_for('auth.login'), data={'username': 'testuser', 'password': 'testpass'})
+        with capture_queries() as stats:
+            response = self.client.get(url_for('pr.view_post'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('SELECT', self.verbs(stats, 'read'))
+        self.assertEqual(self.verbs(stats, None), [])
+
+        post = Post.query.first()
+        with capture_queries() as stats:
+            self.client.post(url_for('pr.submit_reply', post_id=post.id), data={'reply_content': 'A reply'})
+        self.assertIn('INSERT', self.verbs(stats, None))
+        self.assertEqual(Reply.query.filter_by(post_id=post.id).count(), 1)
+
+    def test_get_request_can_write(self):
+        """Test that a GET handler which writes, like logout, still commits through the primary engine."""
+        self.client.post(url_for('auth.login'), data={'username': 'testuser', 'password': 'testpass'})
+        with capture_queries() as stats:
+            response = self.client.get(url_for('auth.logout'))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('UPDATE', self.verbs(stats, None))
+        self.assertIsNotNone(LoginHistory.query.one().logout_time)
+
+
+class SQLInstrumentationTestCase(BaseTestCase):
+    """Test cases for per-request SQL statistics and the query budgets of the main pages."""
+
+    def create_users(self, count):
+        users = [User(username='member%d' % i, email='member%d@example.com' % i) for i in range(count)]
+        db.session.add_all(users)
+        db.session.commit()
+        return users
+
+    def test_debug_headers(self):
+        """Test that debug responses carry the query count, database time and worst repetition."""
+        db.session.add(Post(title='Hello', content='World', category='news'))
+        db.session.commit()
+        response = self.client.get(url_for('pr.view_post'))
+        self.assertGreater(int(response.headers['X-DB-Queries']), 0)
+        self.assertGreaterEqual(float(response.headers['X-DB-Time-Ms']), 0)
+        self.assertGreaterEqual(int(response.headers['X-DB-Max-Repeats']), 1)
+
+        self.app.debug = False
+        response = self.client.get(url_for('pr.view_post'))
+        self.assertNotIn('X-DB-Queries', response.headers)
+
+    def test_repeated_statement_shapes_detected(self):
+        """Test that statements differing only in literals or IN list length count as one shape."""
+        user_ids = [user.id for user in self.create_users(4)]
+        with capture_queries() as stats:
+            for user_id in user_ids:
+                db.session.execute(db.select(User.username).where(User.id == user_id))
+            db.session.execute(db.select(User.id).where(User.id.in_([1, 2])))
+            db.session.execute(db.select(User.id).where(User.id.in_([1, 2, 3])))
+        self.assertEqual(stats.count, 6)
+        self.assertEqual(sorted(stats.repeated(1).values()), [2, 4])
+        self.assertEqual(stats.repeated(4), {})
+
+    def test_thread_page_query_budget(self):
+        """Test that a thread page costs the same few queries however many people replied."""
+        post = self.create_test_post('Busy thread', 'Lots of replies')
+        for user in self.create_users(6):
+            db.session.add(Reply(content='Reply from %s' % user.username, post_id=post.id, user_id=user.id))
+        db.session.commit()
+        self.login_test_user()
+        with self.assertQueryBudget(8):
+            response = self.client.get(url_for('pr.details', post_id=post.id))
+        self.assertIn(b'Reply from member5', response.data)
+
+    def test_notifications_page_query_budget(self):
+        """Test that the notifications page loads the actors with the notifications."""
+        user = User.query.filter_by(username='testuser').first()
+        post = self.create_test_post('Mentioned', 'Content')
+        for actor in self.create_users(6):
+            db.session.add(Notification(user_id=user.id, actor_id=actor.id, post_id=post.id,
+                                        message='Hello from %s' % actor.username, notification_type='mention'))
+        db.session.commit()
+        self.login_test_user()
+        with self.assertQueryBudget(6):
+            response = self.client.get(url_for('notifications.notifications'))
+        self.assertIn(b'member5', response.data)
+
+    def test_thread_list_and_search_query_budget(self):
+        """Test that thread lists and search results load authors and last repliers with the posts."""
+        users = self.create_users(6)
+        for user in users:
+            post = Post(title='Thread by %s' % user.username, content='Engine talk', category='discussion',
+                        user_id=user.id)
+            db.session.add(post)
+            db.session.flush()
+            reply = Reply(content='Reply', post_id=post.id, user_id=users[-1 - users.index(user)].id)
+            db.session.add(reply)
+            db.session.flush()
+            post.set_last_reply(reply)
+        db.session.commit()
+        self.login_test_user()
+        with self.assertQueryBudget(6):
+            self.client.get(url_for('pr.view_post'))
+        with self.assertQueryBudget(6):
+            self.client.get(url_for('pr.search', q='engine'))
+
+
+class MetricsTestCase(BaseTestCase):
+    """Test cases for the Prometheus metrics endpoint."""
+
+    def add_post(self, title):
+        post = Post(title=title, content='Content', category='news')
+        db.session.add(post)
+        db.session.commit()
+        return post
+
+    def scrape(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        return response.get_data(as_text=True)
+
+    def test_request_counts_and_latency_per_endpoint(self):
+        """Test that requests are counted and timed under their blueprint endpoint."""
+        self.app.config['PAGE_CACHE_ENABLED'] = False
+        post = self.add_post('Measured')
+        for _ in range(2):
+            self.client.get(url_for('pr.view_post'))
+        self.client.get(url_for('pr.details', post_id=post.id))
+        self.client.get('/no-such-page')
+        text = self.scrape()
+        self.assertIn('speedsters_http_requests_total{endpoint="pr.view_post",method="GET",status="200"} 2', text)
+        self.assertIn('speedsters_http_requests_total{endpoint="unmatched",method="GET",status="404"} 1', text)
+        self.assertIn('speedsters_http_request_duration_seconds_bucket{endpoint="pr.view_post",le="+Inf"} 2', text)
+        self.assertIn('speedsters_http_request_duration_seconds_count{endpoint="pr.details"} 1', text)
+        self.assertIn('speedsters_db_duration_seconds_count{endpoint="pr.view_post"} 2', text)
+        self.assertIn('speedsters_db_queries_total{endpoint="pr.details"}', text)
+        self.assertIn('speedsters_template_render_duration_seconds_count{template="posts/view_posts.html"} 2', text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        """Test that each bucket counts every observation at or below its bound."""
+        metrics = self.app.extensions['metrics']
+        for value in (0.001, 0.05, 0.3, 20):
+            metrics.observe('http_request_duration_seconds', (('endpoint', 'test'),), value)
+        text = metrics.render()
+        self.assertIn('speedsters_http_request_duration_seconds_bucket{endpoint="test",le="0.005"} 1', text)
+        self.assertIn('speedsters_http_request_duration_seconds_bucket{endpoint="test",le="0.05"} 2', text)
+        self.assertIn('speedsters_http_request_duration_seconds_bucket{endpoint="test",le="0.5"} 3', text)
+        self.assertIn('speedsters_http_request_duration_seconds_bucket{endpoint="test",le="10"} 3', text)
+        self.assertIn('speedsters_http_request_duration_seconds_bucket{endpoint="test",le="+Inf"} 4', text)
+        self.assertIn('speedsters_http_request_duration_seconds_sum{endpoint="test"} 20.351', text)
+
+    def test_counts_from_all_threads_are_added(self):
+        """Test that figures recorded by many threads, finished or not, are all reported."""
+        import threading
+        metrics = self.app.extensions['metrics']
+
+        def work():
+            for _ in range(1000):
+                metrics.inc('http_requests_total', (('endpoint', 'threaded'), ('method', 'GET'), ('status', '200')))
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        work()
+        counters, histograms = metrics.snapshot()
+        self.assertEqual(counters[('http_requests_total', (('endpoint', 'threaded'), ('method', 'GET'),
+                                                           ('status', '200')))], 9000)
+
+    def test_cache_hit_ratios(self):
+        """Test that the page cache's hits and misses are reported with their ratio."""
+        self.add_post('Cached')
+        for _ in range(4):
+            self.client.get(url_for('pr.view_post'))
+        text = self.scrape()
+        self.assertIn('speedsters_cache_hits_total{cache="page"} 3', text)
+        self.assertIn('speedsters_cache_misses_total{cache="page"} 1', text)
+        self.assertIn('speedsters_cache_hit_ratio{cache="page"} 0.75', text)
+        self.assertIn('speedsters_cache_hit_ratio{cache="news"}', text)
+
+    def test_label_values_are_escaped(self):
+        """Test that quotes, backslashes and newlines in label values are escaped."""
+        metrics = self.app.extensions['metrics']
+        metrics.observe('template_render_duration_seconds', (('template', 'a"b\\c\nd'),), 0.01)
+        self.assertIn('{template="a\\"b\\\\c\\nd"}', metrics.render())
+
+    def test_disabled(self):
+        """Test that nothing is recorded or served when metrics are disabled."""
+        self.app.config['METRICS_ENABLED'] = False
+        self.client.get(url_for('pr.view_post'))
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.assertEqual(self.app.extensions['metrics'].snapshot(), ({}, {}))
+
+
+class ThreadedRepliesTestCase(BaseTestCase):
+    """Test cases for nested replies loaded by the reply tree query."""
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app.config['REPLY_TREE_MAX_DEPTH'] = 3
+        self.user = User.query.filter_by(username='testuser').first()
+        self.post = Post(title='Threaded', content='Content', category='news', user_id=self.user.id)
+        db.session.add(self.post)
+        db.session.commit()
+
+    def add_reply(self, content, parent=None, minutes=0):
+        reply = Reply(content=content, post_id=self.post.id, user_id=self.user.id,
+                      parent_id=parent.id if parent else None, created_at=datetime(2024, 1, 1, 0, minutes))
+        db.session.add(reply)
+        db.session.commit()
+        return reply
+
+    def add_chain(self, root, length, prefix):
+        """Add length replies beneath root, each answering the one before."""
+        parent = root
+        for depth in range(1, length + 1):
+            parent = self.add_reply('%s depth %d' % (prefix, depth), parent, minutes=depth)
+        return parent
+
+    def test_tree_is_assembled_in_order(self):
+        """Test that children hang under their parents, oldest first, with depths and cut-off branches marked."""
+        from app.blueprint.pnr.threads import load_reply_tree
+        root = self.add_reply('Root')
+        late = self.add_reply('Late child', root, minutes=30)
+        early = self.add_reply('Early child', root, minutes=10)
+        self.add_chain(early, 4, 'Deep')
+        late_id = late.id
+        db.session.expunge_all()
+        root = Reply.query.filter_by(content='Root').one()
+
+        with capture_queries() as stats:
+            tree = load_reply_tree([root])
+            contents = [(node.depth, node.reply.content, node.reply.user.username) for node in tree[0].walk()]
+        self.assertEqual(stats.count, 1)
+        self.assertEqual([(depth, content) for depth, content, _ in contents], [
+            (0, 'Root'), (1, 'Early child'), (2, 'Deep depth 1'), (3, 'Deep depth 2'), (1, 'Late child')])
+        self.assertEqual({username for _, _, username in contents}, {'testuser'})
+        deepest = tree[0].children[0].children[0].children[0]
+        self.assertTrue(deepest.has_more)
+        self.assertFalse(tree[0].children[1].has_more)
+        self.assertEqual(tree[0].children[1].reply.id, late_id)
+
+    def test_flat_thread_skips_tree_query(self):
+        """Test that a page whose replies have no answers does not run the recursive query."""
+        for i in range(3):
+            self.add_reply('Root %d' % i, minutes=i)
+        with capture_queries() as stats:
+            response = self.client.get(url_for('pr.details', post_id=self.post.id))
+        self.assertIn(b'Root 2', response.data)
+        self.assertFalse([s for s in stats.statements if 'reply_tree' in s])
+
+    def test_branch_ending_at_depth_limit_is_not_cut_off(self):
+        """Test that only replies with answers past the depth limit link to a continued thread."""
+        from app.blueprint.pnr.threads import load_reply_tree
+        root = self.add_reply('Root')
+        self.add_chain(root, 3, 'Chain')
+        tree = load_reply_tree([root])
+        last = list(tree[0].walk())[-1]
+        self.assertEqual((last.depth, last.reply.content), (3, 'Chain depth 3'))
+        self.assertFalse(last.has_more)
+
+    def test_thread_page_paginates_by_top_level_reply(self):
+        """Test that nested replies do not take up places on a page of top-level replies."""
+        roots = [self.add_reply('Root %d' % i, minutes=i) for i in range(7)]
+        for root in roots[:6]:
+            self.add_reply('Answer to %s' % root.content, root, minutes=30)
+        response = self.client.get(url_for('pr.details', post_id=self.post.id))
+        self.assertIn(b'Root 5', response.data)
+        self.assertIn(b'Answer to Root 5', response.data)
+        self.assertNotIn(b'Root 6', response.data)
+
+        response = self.client.get(url_for('pr.details', post_id=self.post.id, page=2))
+        self.assertIn(b'Root 6', response.data)
+        self.assertNotIn(b'Root 5', response.data)
+
+    def test_deep_thread_query_budget(self):
+        """Test that a thread page costs the same few queries however deep its branches go."""
+        root = self.add_reply('Root')
+        self.add_chain(root, 8, 'Chain')
+        self.add_chain(self.add_reply('Second root', minutes=1), 8, 'Other')
+        self.login_test_user()
+        with self.assertQueryBudget(8):
+            response = self.client.get(url_for('pr.details', post_id=self.post.id))
+        self.assertIn(b'Chain depth 3', response.data)
+        self.assertNotIn(b'Chain depth 4', response.data)
+        self.assertIn(b'Continue this thread', response.data)
+
+    def test_continue_deep_branch(self):
+        """Test that a branch cut off by the depth limit continues on its own page."""
+        root = self.add_reply('Root')
+        cut = self.add_chain(root, 3, 'Chain')
+        self.add_chain(cut, 4, 'More')
+        response = self.client.get(url_for('pr.reply_thread', reply_id=cut.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Chain depth 3', response.data)
+        self.assertIn(b'More depth 3', response.data)
+        self.assertNotIn(b'More depth 4', response.data)
+        self.assertEqual(self.client.get(url_for('pr.reply_thread', reply_id=999)).status_code, 404)
+
+    def test_submit_nested_reply(self):
+        """Test that a reply can answer another reply of the same thread only."""
+        root = self.add_reply('Root')
+        other = Post(title='Other', content='Content', category='news', user_id=self.user.id)
+        db.session.add(other)
+        db.session.commit()
+        foreign = Reply(content='Elsewhere', post_id=other.id, user_id=self.user.id)
+        db.session.add(foreign)
+        db.session.commit()
+        self.login_test_user()
+
+        response = self.client.get(url_for('pr.details', post_id=self.post.id, reply_to=root.id))
+        self.assertIn(b'name="parent_id" value="%d"' % root.id, response.data)
+        self.client.post(url_for('pr.submit_reply', post_id=self.post.id),
+                         data={'reply_content': 'Nested', 'parent_id': root.id})
+        self.client.post(url_for('pr.submit_reply', post_id=self.post.id),
+                         data={'reply_content': 'Misplaced', 'parent_id': foreign.id})
+        self.assertEqual(Reply.query.filter_by(content='Nested').one().parent_id, root.id)
+        self.assertIsNone(Reply.query.filter_by(content='Misplaced').one().parent_id)
+
+
+class StaticAssetsTestCase(BaseTestCase):
+    """Test cases for content-hashed static files and their compressed variants."""
+
+    def setUp(self):
+        super().setUp()
+        self.assets = self.app.extensions['static_assets']
+
+    def read_static(self, filename):
+        with open(os.path.join(self.app.static_folder, filename), 'rb') as file:
+            return file.read()
+
+    def test_links_use_hashed_names(self):
+        """Test that url_for links static files by content hash, but leaves uploads alone."""
+        with self.app.test_request_context():
+            self.assertRegex(url_for('static', filename='css/style.css'), r'^/static/css/style\.[0-9a-f]{12}\.css$')
+            self.assertEqual(url_for('static', filename='uploads/default_user.jpg'), '/static/uploads/default_user.jpg')
+            script = url_for('static', filename='js/main.js')
+        response = self.client.get(url_for('pr.view_post'))
+        self.assertIn(script.encode(), response.data)
+
+    def test_hashed_names_are_immutable(self):
+        """Test that hashed files are cached for a year and plain names are not."""
+        response = self.client.get(url_for('static', filename='icon/bell-new.png'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response.data, self.read_static('icon/bell-new.png'))
+
+        response = self.client.get('/static/icon/bell-new.png')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('immutable', response.headers.get('Cache-Control', ''))
+
+    def test_precompressed_variants(self):
+        """Test that text files are sent gzipped to clients accepting it, and as they are otherwise."""
+        url = url_for('static', filename='css/style.css')
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), self.read_static('css/style.css'))
+
+        response = self.client.get(url)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, self.read_static('css/style.css'))
+
+        # Images are already compressed
+        response = self.client.get(url_for('static', filename='images/background.jpg'),
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_outdated_hash_serves_current_file(self):
+        """Test that a link with an old hash still works, without being cached as immutable."""
+        response = self.client.get('/static/css/style.0123456789ab.css')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.read_static('css/style.css'))
+        self.assertNotIn('immutable', response.headers.get('Cache-Control', ''))
+        self.assertEqual(self.client.get('/static/css/missing.0123456789ab.css').status_code, 404)
+
+    def test_edited_file_rehashed_in_debug(self):
+        """Test that a file edited while debugging gets a new hash and the old one stops being immutable."""
+        static = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static)
+        self.app.static_folder = static
+        self.app.config['STATIC_ASSETS_CACHE_DIR'] = os.path.join(static, '.cache')
+        path = os.path.join(static, 'site.css')
+        with open(path, 'w') as file:
+            file.write('body { color: red; }')
+        self.assets.build()
+        before = url_for('static', filename='site.css')
+
+        with open(path, 'w') as file:
+            file.write('body { color: blue; }')
+        os.utime(path, (time.time() + 5, time.time() + 5))
+        after = url_for('static', filename='site.css')
+        self.assertNotEqual(before, after)
+        self.assertEqual(self.client.get(after).data, b'body { color: blue; }')
+        self.assertNotIn('immutable', self.client.get(before).headers.get('Cache-Control', ''))
+
+
+class IdentityCacheTestCase(BaseTestCase):
+    """Test cases for the cached Flask-Login user loader."""
+
+    def count_user_selects(self, func):
+        with capture_queries() as stats:
+            result = func()
+        return result, sum(n for s, n in stats.statements.items() if s.startswith('SELECT') and 'FROM user' in s)
+
+    def test_user_loaded_once_then_cached(self):
+        """Test that repeated loads of the same user skip the query and stay usable."""
+        load_user = self.app.login_manager._user_callback
+        user_id = User.query.filter_by(username='testuser').first().id
+        db.session.remove()
+
+        _, selects = self.count_user_selects(lambda: load_user(str(user_id)))
+        self.assertEqual(selects, 1)
+        db.session.remove()
+
+        user, selects = self.count_user_selects(lambda: load_user(str(user_id)))
+        self.assertEqual(selects, 0)
+        self.assertEqual(user.username, 'testuser')
+        self.assertIn(user, db.session)
+
+        # Changes to the cached user are still flushed normally
+        user.profile_image_url = '/static/uploads/new.jpg'
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(User.query.get(user_id).profile_image_url, '/static/uploads/new.jpg')
+
+    def test_password_change_invalidates_cached_user(self):
+        """Test that changing the password in user_settings drops the cached copy."""
+        from werkzeug.security import check_password_hash
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.login_test_user()
+        user_id = User.query.filter_by(username='testuser').first().id
+        load_user = self.app.login_manager._user_callback
+        load_user(str(user_id))
+
+        self.client.post(url_for('user.user_settings'), data={
+            'current_password': 'testpass', 'password': 'newpass1', 'confirm_password': 'newpass1',
+            'submit_password': 'Change Password',
+        })
+        db.session.remove()
+        user, selects = self.count_user_selects(lambda: load_user(str(user_id)))
+        self.assertEqual(selects, 1)
+        self.assertTrue(check_password_hash(user.password_hash, 'newpass1'))
+
+    def test_unread_count_change_invalidates_cached_user(self):
+        """Test that new notifications are visible to the cached user right away."""
+        from app.blueprint.notifications.utils import adjust_unread_count
+        user_id = User.query.filter_by(username='testuser').first().id
+        load_user = self.app.login_manager._user_callback
+        load_user(str(user_id))
+        adjust_unread_count([user_id], 3)
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(load_user(str(user_id)).unread_notifications, 3)
+
+    def test_user_reloaded_before_commit_is_forgotten_after_it(self):
+        """Test that a copy cached by another request before the commit is dropped by the commit."""
+        import threading
+        from app.blueprint.notifications.utils import adjust_unread_count
+        user_id = User.query.filter_by(username='testuser').first().id
+        load_user = self.app.login_manager._user_callback
+        adjust_unread_count([user_id], 2)
+
+        def concurrent_request():
+            with self.app.app_context():
+                self.assertEqual(load_user(str(user_id)).unread_notifications, 0)
+        thread = threading.Thread(target=concurrent_request)
+        thread.start()
+        thread.join()
+
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(load_user(str(user_id)).unread_notifications, 2)
+
+
+class NewsTestCase(BaseTestCase):
+    """Test cases for the cached car news page."""
+
+    ARTICLES = [{'title': 'Old Car', 'description': 'First', 'url': 'http://example.com/1', 'urlToImage': ''}]
+
+    def setUp(self):
+        super().setUp()
+        self.news = self.app.extensions['news_cache']
+        self.news.clear()
+        self.stub = StubNewsServer(list(self.ARTICLES)).__enter__()
+        self.app.config['NEWS_API_URL'] = self.stub.url + '/v2/everything'
+
+    def tearDown(self):
+        self.stub.__exit__(None, None, None)
+        super().tearDown()
+
+    def wait_for_refresh(self):
+        for _ in range(100):
+            if not self.news._refreshing:
+                return
+            time.sleep(0.02)
+
+    def test_news_fetched_once_then_cached(self):
+        """Test that repeated page views reuse the cached articles."""
+        for _ in range(3):
+            response = self.client.get(url_for('pr.news'))
+            self.assertIn(b'Old Car', response.data)
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertIn('q=car', self.stub.requests[0])
+
+    def test_stale_news_served_while_refreshing(self):
+        """Test that stale articles are returned at once and replaced in the background."""
+        self.news.articles()
+        self.stub.articles = [dict(self.ARTICLES[0], title='New Car')]
+        self.stub.delay = 0.3
+        self.news._fetched_at -= self.app.config['NEWS_CACHE_TTL']
+
+        started = time.monotonic()
+        self.assertEqual(self.news.articles()[0]['title'], 'Old Car')
+        self.assertLess(time.monotonic() - started, 0.2)
+        self.wait_for_refresh()
+        self.assertEqual(self.news.articles()[0]['title'], 'New Car')
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_failed_refresh_keeps_stale_news(self):
+        """Test that an upstream error neither drops the cached articles nor is retried at once."""
+        self.news.articles()
+        self.stub.status = 500
+        self.news._fetched_at -= self.app.config['NEWS_CACHE_TTL']
+
+        self.assertEqual(self.news.articles()[0]['title'], 'Old Car')
+        self.wait_for_refresh()
+        self.assertEqual(self.news.articles()[0]['title'], 'Old Car')
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_slow_upstream_times_out(self):
+        """Test that a cold cache gives up on a slow upstream after the request timeout."""
+        self.app.config['NEWS_REQUEST_TIMEOUT'] = 0.2
+        self.stub.delay = 1
+
+        started = time.monotonic()
+        self.assertEqual(self.news.articles(), [])
+        self.assertLess(time.monotonic() - started, 0.9)
+
+    def test_news_persisted_for_warm_start(self):
+        """Test that a new cache instance starts from the articles saved on disk."""
+        import tempfile
+        from app.blueprint.pnr.news import NewsCache
+        with tempfile.TemporaryDirectory() as tmp:
+            self.app.config['NEWS_CACHE_FILE'] = os.path.join(tmp, 'news.json')
+            self.news.articles()
+
+            restarted = NewsCache(self.app)
+            self.assertEqual(restarted.articles()[0]['title'], 'Old Car')
+            self.assertEqual(len(self.stub.requests), 1)
+
+
+class VoteRoutesTestCase(BaseTestCase):
+    """Test cases for liking and disliking posts and replies."""
+
+    def test_vote_starts_with_a_write(self):
+        """Test that a vote finds its item through its own writes instead of reading it first."""
+        self.login_test_user()
+        post = self.create_test_post('Vote Post', 'Content')
+        reply = Reply(content='A reply', post_id=post.id, user_id=post.user_id)
+        db.session.add(reply)
+        db.session.commit()
+        url = url_for('pr.vote', type='reply', id=reply.id, action='like')
+        missing_id = post.id + 100
+
+        with capture_queries() as stats:
+            response = self.client.post(url)
+        self.assertEqual(response.get_json(), {'success': True, 'likes': 1, 'neutral': False})
+        self.assertFalse([s for s in stats.statements
+                          if s.startswith('SELECT') and ('FROM post' in s or 'FROM reply' in s)], stats.statements)
+
+        response = self.client.post(url_for('pr.vote', type='post', id=missing_id, action='like'))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(Vote.query.filter_by(post_id=missing_id).count(), 0)
+
+    def test_vote_toggle_contract(self):
+        """Test like, repeated like, withdrawing and disliking keep the JSON contract."""
+        self.login_test_user()
+        post = self.create_test_post('Vote Post', 'Content')
+
+        response = self.client.post(url_for('pr.vote', type='post', id=post.id, action='like'))
+        self.assertEqual(response.get_json(), {'success': True, 'likes': 1, 'neutral': False})
+
+        response = self.client.post(url_for('pr.vote', type='post', id=post.id, action='like'))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['error'], 'You have already voted this way')
+
+        response = self.client.post(url_for('pr.vote', type='post', id=post.id, action='dislike'))
+        self.assertEqual(response.get_json(), {'success': True, 'likes': 0, 'neutral': True})
+
+        response = self.client.post(url_for('pr.vote', type='post', id=post.id, action='dislike'))
+        self.assertEqual(response.get_json(), {'success': True, 'likes': -1, 'neutral': False})
+        self.assertEqual(Vote.query.count(), 1)
+
+    def test_duplicate_vote_rejected_by_database(self):
+        """Test that the unique index refuses a second vote by the same user on an item."""
+        from sqlalchemy.exc import IntegrityError
+        user = User.query.filter_by(username='testuser').first()
+        post = self.create_test_post('Vote Post', 'Content')
+        db.session.add(Vote(user_id=user.id, post_id=post.id, vote_type='like'))
+        db.session.commit()
+        db.session.add(Vote(user_id=user.id, post_id=post.id, vote_type='dislike'))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+    def test_vote_state_in_one_query(self):
+        """Test that the vote state of a page of items comes from a single query."""
+        self.login_test_user()
+        user = User.query.filter_by(username='testuser').first()
+        post = self.create_test_post('Vote Post', 'Content')
+        replies = [Reply(content='Reply %d' % i, user_id=user.id, post_id=post.id) for i in range(20)]
+        db.session.add_all(replies)
+        db.session.commit()
+        db.session.add_all([
+            Vote(user_id=user.id, post_id=post.id, vote_type='like'),
+            Vote(user_id=user.id, reply_id=replies[3].id, vote_type='dislike'),
+        ])
+        db.session.commit()
+        url = url_for('pr.vote_state', post=[post.id], reply=[reply.id for reply in replies])
+
+        with capture_queries() as stats:
+            response = self.client.get(url)
+
+        self.assertEqual(response.get_json()['votes'], {
+            'post': {str(post.id): 'like'},
+            'reply': {str(replies[3].id): 'dislike'},
+        })
+        self.assertEqual(sum(n for s, n in stats.statements.items() if 'FROM vote' in s), 1)
+
+    def test_vote_state_embedded_in_detail_page(self):
+        """Test that the detail page carries the viewer's votes for main.js."""
+        self.login_test_user()
+        user = User.query.filter_by(username='testuser').first()
+        post = self.create_test_post('Vote Post', 'Content')
+        db.session.add(Vote(user_id=user.id, post_id=post.id, vote_type='like'))
+        db.session.commit()
+
+        response = self.client.get(url_for('pr.details', post_id=post.id))
+        self.assertIn(b'id="vote-state"', response.data)
+        self.assertIn(('{"post": {"%d": "like"}, "reply": {}}' % post.id).encode(), response.data)
+
+    def test_concurrent_votes_are_exact(self):
+        """Test that thousands of parallel votes leave exact counts and no duplicate rows."""
+        import random
+        import threading
+        from sqlalchemy import func, insert
+        from app.blueprint.pnr.votes import VoteRejected, cast_vote
+
+        db.session.execute(insert(User), [
+            {'username': 'voter%d' % i, 'email': 'voter%d@example.com' % i, 'password_hash': 'x'}
+            for i in range(300)
+        ])
+        db.session.commit()
+        voter_ids = [user_id for (user_id,) in db.session.query(User.id).filter(User.username.like('voter%'))]
+        post = self.create_test_post('Contended Post', 'Content')
+        reply = Reply(content='Contended reply', user_id=voter_ids[0], post_id=post.id)
+        db.session.add(reply)
+        db.session.commit()
+        post_id, reply_id = post.id, reply.id
+
+        def run(calls):
+            with self.app.app_context():
+                for item_type, item_id, user_id, action in calls:
+                    try:
+                        cast_vote(user_id, item_type, item_id, action)
+                    except VoteRejected:
+                        pass
+
+        def hammer(calls, workers=8):
+            threads = [threading.Thread(target=run, args=(calls[i::workers],)) for i in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # Every voter double-clicks like: exactly one vote each must count
+        calls = [('post', post_id, user_id, 'like') for user_id in voter_ids] * 2
+        random.shuffle(calls)
+        hammer(calls)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Post, post_id).likes, len(voter_ids))
+        self.assertEqual(Vote.query.filter_by(post_id=post_id).count(), len(voter_ids))
+
+        # Random likes and dislikes on both items: counts must match the votes left
+        rng = random.Random(5505)
+        calls = [(item_type, item_id, rng.choice(voter_ids), rng.choice(('like', 'dislike')))
+                 for item_type, item_id in [('post', post_id), ('reply', reply_id)] * 1000]
+        hammer(calls)
+        db.session.expire_all()
+        for model, column, item_id in ((Post, Vote.post_id, post_id), (Reply, Vote.reply_id, reply_id)):
+            votes = dict(db.session.query(Vote.vote_type, func.count()).filter(column == item_id)
+                         .group_by(Vote.vote_type).all())
+            self.assertEqual(db.session.get(model, item_id).likes,
+                             votes.get('like', 0) - votes.get('dislike', 0))
+            duplicates = (db.session.query(Vote.user_id).filter(column == item_id)
+                          .group_by(Vote.user_id).having(func.count() > 1).count())
+            self.assertEqual(duplicates, 0)
+
 
 class NotificationRoutesTestCase(BaseTestCase):
     """Test cases for notification routes."""
@@ -385,6 +1948,250 @@ class NotificationRoutesTestCase(BaseTestCase):
         self.assertEqual(len(data), 1)
         self.assertEqual(data[0]['message'], "This is a test notification")
 
+    def test_reply_notifies_author_and_mentions_once(self):
+        """Test that a reply notifies the post author and each mentioned user exactly once."""
+        self.login_test_user()
+        author = User(username='author', email='author@example.com', password_hash='x')
+        third = User(username='third', email='third@example.com', password_hash='x')
+        db.session.add_all([author, third])
+        db.session.commit()
+        post = Post(title='Author Post', content='Content', user_id=author.id, category='discussion')
+        db.session.add(post)
+        db.session.commit()
+
+        response = self.client.post(url_for('pr.submit_reply', post_id=post.id),
+                                    data={'reply_content': 'Hi @author @third @testuser @ghost @third'})
+        self.assertEqual(response.status_code, 302)
+
+        received = {(n.user_id, n.notification_type) for n in Notification.query.all()}
+        self.assertEqual(received, {(author.id, 'new_reply'), (third.id, 'mention')})
+
+    def test_mentions_resolved_and_inserted_in_bulk(self):
+        """Test that mentions cost one lookup and one insert regardless of their number."""
+        from app.blueprint.notifications.utils import notify_activity
+        users = [User(username='user%d' % i, email='user%d@example.com' % i, password_hash='x') for i in range(30)]
+        db.session.add_all(users)
+        actor = User.query.filter_by(username='testuser').first()
+        post = self.create_test_post('Mention Post', 'Content')
+        content = ' '.join('@user%d' % i for i in range(30))
+        db.session.refresh(post)
+        db.session.refresh(actor)
+
+        with capture_queries() as stats:
+            created = notify_activity(actor.id, content, post)
+        db.session.commit()
+
+        self.assertEqual(created, 30)
+        self.assertEqual(Notification.query.count(), 30)
+        self.assertEqual(sum(n for s, n in stats.statements.items() if s.startswith('SELECT')), 1)
+        self.assertEqual(sum(n for s, n in stats.statements.items() if s.startswith('INSERT INTO notification')), 1)
+
+    def test_unread_count_follows_notifications(self):
+        """Test that the cached unread count rises on notify and falls on read and delete."""
+        from app.blueprint.notifications.utils import notify_activity
+        self.login_test_user()
+        reader = User.query.filter_by(username='testuser').first()
+        actor = User(username='actor', email='actor@example.com', password_hash='x')
+        db.session.add(actor)
+        db.session.commit()
+        post = Post(title='Actor Post', content='Content', user_id=actor.id)
+        db.session.add(post)
+        db.session.commit()
+
+        notify_activity(actor.id, 'Hello @testuser', post)
+        notify_activity(actor.id, 'Again @testuser', post)
+        db.session.commit()
+        db.session.refresh(reader)
+        self.assertEqual(reader.unread_notifications, 2)
+
+        first, second = Notification.query.filter_by(user_id=reader.id).all()
+        self.client.get(url_for('notifications.mark_as_read', notification_id=first.id))
+        # Reading twice must not decrement twice
+        self.client.get(url_for('notifications.mark_as_read', notification_id=first.id))
+        db.session.refresh(reader)
+        self.assertEqual(reader.unread_notifications, 1)
+
+        self.client.get(url_for('notifications.delete_notification', notification_id=second.id))
+        db.session.refresh(reader)
+        self.assertEqual(reader.unread_notifications, 0)
+
+    def test_reconcile_unread_counts(self):
+        """Test that a drifted unread count is recomputed from the notifications."""
+        from app.blueprint.notifications.utils import reconcile_unread_counts
+        user = User.query.filter_by(username='testuser').first()
+        self.create_notification(user)
+        user.unread_notifications = 7
+        db.session.commit()
+
+        reconcile_unread_counts()
+        db.session.commit()
+        db.session.refresh(user)
+        self.assertEqual(user.unread_notifications, 1)
+
+    def test_reconcile_unread_command(self):
+        """Test that the reconcile-unread command reports through click."""
+        user = User.query.filter_by(username='testuser').first()
+        self.create_notification(user)
+        result = self.app.test_cli_runner().invoke(args=['notifications', 'reconcile-unread'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(result.output, 'Reconciled unread counts for 1 users.\n')
+
+    def test_delete_decrements_only_for_unread_rows_it_removes(self):
+        """Test that deleting a read notification, or one already deleted, leaves the unread count alone."""
+        from app.blueprint.notifications.utils import notify_activity
+        self.login_test_user()
+        reader = User.query.filter_by(username='testuser').first()
+        post = self.create_test_post('Actor Post', 'Content')
+        actor = User(username='actor', email='actor@example.com', password_hash='x')
+        db.session.add(actor)
+        db.session.commit()
+        for message in ('One @testuser', 'Two @testuser', 'Three @testuser'):
+            notify_activity(actor.id, message, post)
+        db.session.commit()
+        first, second, _ = Notification.query.filter_by(user_id=reader.id).order_by(Notification.id).all()
+        first_id, second_id = first.id, second.id
+
+        self.client.get(url_for('notifications.mark_as_read', notification_id=first_id))
+        self.client.get(url_for('notifications.delete_notification', notification_id=first_id))
+        db.session.refresh(reader)
+        self.assertEqual(reader.unread_notifications, 2)
+
+        self.client.get(url_for('notifications.delete_notification', notification_id=second_id))
+        self.client.get(url_for('notifications.delete_notification', notification_id=second_id))
+        db.session.refresh(reader)
+        self.assertEqual(reader.unread_notifications, 1)
+        self.assertEqual(Notification.query.filter_by(user_id=reader.id).count(), 1)
+
+    def test_delete_leaves_other_users_notifications(self):
+        """Test that a notification can only be deleted by the user it belongs to."""
+        other = User(username='other', email='other@example.com', password_hash='x')
+        db.session.add(other)
+        db.session.commit()
+        notification = self.create_notification(other)
+        other.unread_notifications = 1
+        db.session.commit()
+        self.login_test_user()
+
+        self.client.get(url_for('notifications.delete_notification', notification_id=notification.id))
+        self.assertIsNotNone(db.session.get(Notification, notification.id))
+        db.session.refresh(other)
+        self.assertEqual(other.unread_notifications, 1)
+
+    def test_notifications_page_does_not_write(self):
+        """Test that listing notifications leaves a drifted unread count to the reconcile job."""
+        self.login_test_user()
+        user = User.query.filter_by(username='testuser').first()
+        self.create_notification(user)
+        user.unread_notifications = 7
+        db.session.commit()
+
+        with capture_queries() as stats:
+            response = self.client.get(url_for('notifications.notifications'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([s for s in stats.statements if not s.startswith('SELECT') and 'stored_session' not in s])
+        db.session.refresh(user)
+        self.assertEqual(user.unread_notifications, 7)
+
+    def test_page_render_does_not_count_notifications(self):
+        """Test that the navbar badge is read from the user row instead of counted per request."""
+        self.login_test_user()
+        user = User.query.filter_by(username='testuser').first()
+        notification = self.create_notification(user)
+        notification.post.category = 'discussion'
+        user.unread_notifications = 1
+        db.session.commit()
+
+        with capture_queries() as stats:
+            response = self.client.get(url_for('pr.view_post'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([s for s in stats.statements if 'FROM notification' in s])
+
+class NotificationStreamTestCase(BaseTestCase):
+    """Test cases for the event bus and the live notification stream."""
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['EVENTS_HEARTBEAT'] = 0.05
+        self.bus = self.app.extensions['event_bus']
+        self.user = User.query.filter_by(username='testuser').first()
+        self.other = User(username='other', email='other@example.com', password_hash='x')
+        db.session.add(self.other)
+        db.session.commit()
+
+    def open_stream(self):
+        response = self.client.get(url_for('notifications.stream'), buffered=False)
+        self.addCleanup(response.close)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        return response, iter(response.response)
+
+    def test_stream_pushes_notifications_without_queries(self):
+        """Test that the stream starts with the unread count, then pushes notifications without touching the database."""
+        from app.blueprint.notifications.utils import create_notification
+        self.login_test_user()
+        response, events = self.open_stream()
+        self.assertEqual(next(events), b'event: unread\ndata: {"count": 0}\n\n')
+
+        create_notification(self.user.id, self.other.id, message='Hello', notification_type='mention')
+        with capture_queries() as stats:
+            notification = next(events).decode()
+            unread = next(events).decode()
+            heartbeat = next(events)
+        self.assertEqual(stats.count, 0)
+        self.assertTrue(notification.startswith('event: notification\n'))
+        self.assertEqual(json.loads(notification.split('data: ')[1])['message'], 'Hello')
+        self.assertEqual(unread, 'event: unread\ndata: {"count": 1}\n\n')
+        self.assertEqual(heartbeat, b': heartbeat\n\n')
+
+        response.close()
+        self.assertEqual(self.bus.stats()['subscribers'], 0)
+
+    def test_rolled_back_notifications_are_not_published(self):
+        """Test that events are only published when the writing transaction commits."""
+        from app.blueprint.notifications.utils import create_notifications
+        subscription = self.bus.subscribe('user:%d' % self.user.id)
+        self.addCleanup(subscription.close)
+        create_notifications(self.other.id, {self.user.id: 'mention'}, message='Draft')
+        db.session.rollback()
+        db.session.commit()
+        self.assertIsNone(subscription.get(0))
+
+        create_notifications(self.other.id, {self.user.id: 'mention'}, message='Sent')
+        db.session.commit()
+        self.assertEqual(subscription.get(0)[1]['message'], 'Sent')
+        self.assertEqual(subscription.get(0), ('unread', {'count': 1}))
+
+    def test_slow_client_buffer_is_bounded(self):
+        """Test that a full client buffer drops its oldest events and the stream asks for a resync."""
+        self.app.config['EVENTS_CLIENT_BUFFER'] = 2
+        subscription = self.bus.subscribe('user:1')
+        for count in range(5):
+            self.bus.publish('user:1', 'unread', {'count': count})
+        self.assertEqual(list(subscription.events), [('unread', {'count': 3}), ('unread', {'count': 4})])
+        self.assertTrue(subscription.take_overflow())
+        self.assertFalse(subscription.take_overflow())
+        self.assertEqual(self.bus.stats()['dropped'], 3)
+        subscription.close()
+
+        self.login_test_user()
+        response, events = self.open_stream()
+        next(events)
+        for count in range(3):
+            self.bus.publish('user:%d' % self.user.id, 'unread', {'count': count})
+        self.assertEqual(next(events), b'event: resync\ndata: {}\n\n')
+        self.assertEqual(next(events), b'event: unread\ndata: {"count": 1}\n\n')
+
+    def test_stream_requires_login(self):
+        """Test that anonymous visitors cannot open a stream and the subscriber limit is enforced."""
+        response = self.client.get(url_for('notifications.stream'))
+        self.assertEqual(response.status_code, 302)
+
+        self.app.config['EVENTS_MAX_SUBSCRIBERS'] = 0
+        self.login_test_user()
+        self.assertEqual(self.client.get(url_for('notifications.stream')).status_code, 503)
+
+
 class SearchPostTestCase(BaseTestCase):
     """Test cases for search functionality."""
 
@@ -428,6 +2235,60 @@ class SearchPostTestCase(BaseTestCase):
         self.assertNotIn(b'First Post', response.data)
         self.assertNotIn(b'Second Post', response.data)
 
+    def test_search_matches_reply_content(self):
+        """Test that a post is found through the content of its replies."""
+        user = User.query.filter_by(username='testuser').first()
+        post = self.create_test_post('Tyre Post', 'Which tyres should I buy?')
+        self.create_test_post('Oil Post', 'Which oil grade is best?')
+        db.session.add(Reply(content='<p>Check the placard for pressure</p>', post_id=post.id, user_id=user.id))
+        db.session.commit()
+
+        response = self.client.get(url_for('pr.search'), query_string={'q': 'placard'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Tyre Post', response.data)
+        self.assertNotIn(b'Oil Post', response.data)
+        self.assertIn(b'<mark>placard</mark>', response.data)
+
+    def test_search_index_follows_updates_and_deletes(self):
+        """Test that edits and deletions are reflected in search results."""
+        post = self.create_test_post('Original Title', 'Some content')
+        post.title = 'Renamed Title'
+        db.session.commit()
+
+        response = self.client.get(url_for('pr.search'), query_string={'q': 'renamed', 'search_type': 'Titles'})
+        self.assertIn(b'Renamed Title', response.data)
+        response = self.client.get(url_for('pr.search'), query_string={'q': 'original', 'search_type': 'Titles'})
+        self.assertNotIn(b'Renamed Title', response.data)
+
+        db.session.delete(post)
+        db.session.commit()
+        response = self.client.get(url_for('pr.search'), query_string={'q': 'renamed', 'search_type': 'Titles'})
+        self.assertIn(b'No results found.', response.data)
+
+    def test_search_sort_by_relevance_and_recent(self):
+        """Test that results can be ordered by relevance or by last reply date."""
+        strong = self.create_test_post('Turbo turbo turbo', 'All about the turbo')
+        weak = self.create_test_post('Engines', 'A short note on a turbo')
+        strong.last_reply_date = datetime(2024, 1, 1)
+        weak.last_reply_date = datetime(2024, 6, 1)
+        db.session.commit()
+
+        response = self.client.get(url_for('pr.search'), query_string={'q': 'turbo', 'sort': 'relevance'})
+        self.assertLess(response.data.index(b'Turbo turbo turbo'), response.data.index(b'Engines'))
+        response = self.client.get(url_for('pr.search'), query_string={'q': 'turbo', 'sort': 'recent'})
+        self.assertLess(response.data.index(b'Engines'), response.data.index(b'Turbo turbo turbo'))
+
+    def test_search_falls_back_without_index(self):
+        """Test that search still works with LIKE matching when the index is missing."""
+        from app.blueprint.pnr.search import drop_index
+        self.create_test_post('First Post', 'This is the first post')
+        with db.engine.begin() as connection:
+            drop_index(connection)
+
+        response = self.client.get(url_for('pr.search'), query_string={'q': 'First', 'search_type': 'Titles'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'First Post', response.data)
+
 
 if __name__ == '__main__':
     unittest.main()